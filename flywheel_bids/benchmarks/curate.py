@@ -0,0 +1,227 @@
+"""
+Benchmark curation of a synthetic project.
+
+Runs curation with update=False against generated project trees, both one
+pass at a time and as the single walk that curate_bids_tree does, and reports
+nodes per second, peak memory and per-pass timings.
+
+Usage:
+    python -m flywheel_bids.benchmarks.curate --subjects 50 --sessions 2 --repeat 3
+"""
+import argparse
+import contextlib
+import json
+import logging
+import os
+import sys
+import time
+
+try:
+    import tracemalloc
+except ImportError:
+    tracemalloc = None
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+from .. import curate_bids
+from . import synthetic
+
+# The passes of curation, in order, followed by the single walk that combines them
+PASSES = ['load_template', 'match_templates', 'resolve_paths', 'collect_updates']
+TIMINGS = PASSES + ['single_pass']
+
+def run_passes(project, template_file=None):
+    """
+    Run each curation pass on project, without sending updates.
+
+    Args:
+        project (TreeNode): The project tree, which is modified
+        template_file (str): The optional path to a template file
+
+    Returns:
+        dict: The number of seconds spent in each pass
+    """
+    timings = {}
+
+    start = time.time()
+    template = curate_bids.load_project_template(None, project, template_file)
+    timings['load_template'] = time.time() - start
+
+    start = time.time()
+    curate_bids.match_templates(project, template)
+    timings['match_templates'] = time.time() - start
+
+    start = time.time()
+    curate_bids.resolve_paths(project, template)
+    timings['resolve_paths'] = time.time() - start
+
+    start = time.time()
+    curate_bids.collect_updates(project)
+    timings['collect_updates'] = time.time() - start
+
+    return timings
+
+def run_single_pass(project, template_file=None):
+    """
+    Run curation on project in a single walk, like curate_bids_tree, without sending updates.
+
+    Args:
+        project (TreeNode): The project tree, which is modified
+        template_file (str): The optional path to a template file
+
+    Returns:
+        dict: The number of seconds spent curating
+    """
+    template = curate_bids.load_project_template(None, project, template_file)
+
+    start = time.time()
+    for contexts in curate_bids.curate_contexts(project, template):
+        curate_bids.collect_context_updates(contexts)
+    return {'single_pass': time.time() - start}
+
+def measure_peak_memory(func, *args):
+    """
+    Call func and measure its peak memory use.
+
+    Uses tracemalloc where available, otherwise the process max RSS,
+    which includes everything allocated before func was called.
+
+    Returns:
+        int: The peak memory in bytes, or None if it can't be measured
+    """
+    if tracemalloc is not None:
+        tracemalloc.start()
+        try:
+            func(*args)
+            return tracemalloc.get_traced_memory()[1]
+        finally:
+            tracemalloc.stop()
+
+    func(*args)
+    if resource is not None:
+        # ru_maxrss is in kilobytes on linux, and bytes on macOS
+        scale = 1 if sys.platform == 'darwin' else 1024
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * scale
+    return None
+
+@contextlib.contextmanager
+def quiet():
+    """Discard the per-node output of curation, so that it doesn't dominate the timings"""
+    stdout = sys.stdout
+    level = logging.root.manager.disable
+    with open(os.devnull, 'w') as devnull:
+        sys.stdout = devnull
+        logging.disable(logging.INFO)
+        try:
+            yield
+        finally:
+            sys.stdout = stdout
+            logging.disable(level)
+
+def run_benchmark(subjects=10, sessions=2, acquisitions=8, files=3, repeat=3, template_file=None, seed=0):
+    """
+    Benchmark curation of a synthetic project.
+
+    A new tree is generated for every run, since curation modifies it.
+    Timings are the best of repeat runs. Throughput and memory are for the
+    single walk, and memory is measured on a separate run so that tracing
+    doesn't affect the timings.
+
+    Args:
+        subjects (int): The number of subjects
+        sessions (int): The number of sessions per subject
+        acquisitions (int): The number of acquisitions per session
+        files (int): The number of files per acquisition
+        repeat (int): The number of timed runs
+        template_file (str): The optional path to a template file
+        seed (int): The random seed for the generated project
+
+    Returns:
+        dict: The benchmark results
+    """
+    def generate():
+        return synthetic.generate_project(subjects=subjects, sessions=sessions,
+                                          acquisitions=acquisitions, files=files, seed=seed)
+
+    counts = synthetic.count_nodes(generate())
+    nodes = sum(counts.values())
+
+    best = None
+    with quiet():
+        for _ in range(max(repeat, 1)):
+            timings = run_passes(generate(), template_file)
+            timings.update(run_single_pass(generate(), template_file))
+            if best is None:
+                best = timings
+            else:
+                best = dict((name, min(best[name], timings[name])) for name in TIMINGS)
+
+        peak_memory = measure_peak_memory(run_single_pass, generate(), template_file)
+
+    curate_time = best['single_pass']
+
+    return {
+        'parameters': {
+            'subjects': subjects,
+            'sessions': sessions,
+            'acquisitions': acquisitions,
+            'files': files,
+            'repeat': repeat,
+            'seed': seed
+        },
+        'nodes': counts,
+        'timings': best,
+        'nodes_per_second': nodes / curate_time if curate_time else None,
+        'peak_memory': peak_memory
+    }
+
+def format_results(results):
+    """Format benchmark results as a human readable report"""
+    lines = []
+    counts = results['nodes']
+    lines.append('Nodes: {0} ({1})'.format(sum(counts.values()),
+        ', '.join('{0} {1}'.format(counts[ctype], ctype) for ctype in sorted(counts))))
+    for name in TIMINGS:
+        lines.append('{0:>16}: {1:.4f}s'.format(name, results['timings'][name]))
+    if results['nodes_per_second'] is not None:
+        lines.append('Throughput: {0:.0f} nodes/s'.format(results['nodes_per_second']))
+    if results['peak_memory'] is not None:
+        lines.append('Peak memory: {0:.1f} MiB'.format(results['peak_memory'] / (1024.0 * 1024.0)))
+    return '\n'.join(lines)
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark BIDS curation on a synthetic project')
+    parser.add_argument('--subjects', dest='subjects', action='store',
+            type=int, default=10, help='Number of subjects')
+    parser.add_argument('--sessions', dest='sessions', action='store',
+            type=int, default=2, help='Number of sessions per subject')
+    parser.add_argument('--acquisitions', dest='acquisitions', action='store',
+            type=int, default=8, help='Number of acquisitions per session')
+    parser.add_argument('--files', dest='files', action='store',
+            type=int, default=3, help='Number of files per acquisition')
+    parser.add_argument('--repeat', dest='repeat', action='store',
+            type=int, default=3, help='Number of timed runs, the best run is reported')
+    parser.add_argument('--seed', dest='seed', action='store',
+            type=int, default=0, help='Random seed for the generated project')
+    parser.add_argument('--template-file', dest='template_file', action='store',
+            help='Template file to use')
+    parser.add_argument('--json', dest='json_file', action='store',
+            help='Write the results as json to this file')
+
+    args = parser.parse_args()
+
+    results = run_benchmark(subjects=args.subjects, sessions=args.sessions,
+                            acquisitions=args.acquisitions, files=args.files,
+                            repeat=args.repeat, template_file=args.template_file,
+                            seed=args.seed)
+    print(format_results(results))
+
+    if args.json_file:
+        with open(args.json_file, 'w') as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,87 @@
+"""
+Micro-benchmark of dotted path lookups on a realistic curation context.
+
+Compares utils.dict_lookup, which uses cached compiled accessors, with
+splitting the path on every call.
+
+Usage:
+    python -m flywheel_bids.benchmarks.lookup --number 100000
+"""
+import argparse
+import collections
+import timeit
+
+from .. import curate_bids
+from ..supporting_files import utils
+from . import synthetic
+from .curate import quiet
+
+# Paths used by the default template's rules, initializers and resolvers
+LOOKUP_PATHS = [
+    'container_type',
+    'parent_container_type',
+    'file.type',
+    'file.classification.Intent',
+    'file.classification.Measurement',
+    'acquisition.label',
+    'session.info.BIDS.Label',
+    'file.info.BIDS.Folder',
+    'file.info.BIDS.Filename',
+    'file.info.BIDS.IntendedFor',
+    'file.info.BIDS.Missing'
+]
+
+def split_lookup(obj, value, default=None):
+    """ Looks up a dotted path by splitting it on every call, like dict_lookup used to """
+    curr = obj
+    for part in value.split('.'):
+        if isinstance(curr, (dict, collections.Mapping)) and part in curr:
+            curr = curr[part]
+        elif isinstance(curr, list) and int(part) < len(curr):
+            curr = curr[int(part)]
+        else:
+            curr = default
+            break
+    return curr
+
+def get_file_context():
+    """ Get the context of a curated fieldmap file, from a synthetic project """
+    project = synthetic.generate_project(subjects=1, sessions=1, acquisitions=8, files=2, seed=0)
+    template = curate_bids.load_project_template(None, project)
+    with quiet():
+        for contexts in curate_bids.curate_contexts(project, template):
+            for context in contexts:
+                if context['container_type'] == 'file' and 'BIDS' in context['file'].get('info', {}):
+                    if context['file']['info']['BIDS'].get('Folder') == 'fmap':
+                        return context
+    raise RuntimeError('No fieldmap file in the synthetic project')
+
+def run_benchmark(number=100000):
+    """
+    Time looking up each of LOOKUP_PATHS number times.
+
+    Returns:
+        dict: The seconds per lookup, by implementation
+    """
+    context = get_file_context()
+    results = {}
+    for name, lookup in [('dict_lookup', utils.dict_lookup), ('split_lookup', split_lookup)]:
+        def run():
+            for path in LOOKUP_PATHS:
+                lookup(context, path)
+        results[name] = min(timeit.repeat(run, number=number, repeat=3)) / (number * len(LOOKUP_PATHS))
+    return results
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark dotted path lookups on a curation context')
+    parser.add_argument('--number', dest='number', action='store',
+            type=int, default=100000, help='Number of times to look up each path')
+    args = parser.parse_args()
+
+    results = run_benchmark(args.number)
+    for name in sorted(results):
+        print('{0:>12}: {1:.0f}ns per lookup'.format(name, results[name] * 1e9))
+    print('Speedup: {0:.2f}x'.format(results['split_lookup'] / results['dict_lookup']))
+
+if __name__ == '__main__':
+    main()
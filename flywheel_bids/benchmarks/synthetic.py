@@ -0,0 +1,105 @@
+import random
+
+from ..supporting_files.project_tree import TreeNode, add_file_nodes
+
+# Acquisition protocols, as a label and the (type, suffix, classification) of each file
+ACQUISITION_PROTOCOLS = [
+    ('T1w_MPRAGE', [
+        ('nifti', '.nii.gz', {'Measurement': ['T1'], 'Intent': ['Structural']}),
+        ('source code', '.json', {'Measurement': ['T1'], 'Intent': ['Structural']}),
+        ('dicom', '.dicom.zip', {'Measurement': ['T1'], 'Intent': ['Structural']})
+    ]),
+    ('T2w_SPC', [
+        ('nifti', '.nii.gz', {'Measurement': ['T2'], 'Intent': ['Structural']}),
+        ('source code', '.json', {'Measurement': ['T2'], 'Intent': ['Structural']}),
+        ('dicom', '.dicom.zip', {'Measurement': ['T2'], 'Intent': ['Structural']})
+    ]),
+    ('task-rest_bold', [
+        ('nifti', '.nii.gz', {'Intent': ['Functional']}),
+        ('source code', '.json', {'Intent': ['Functional']}),
+        ('dicom', '.dicom.zip', {'Intent': ['Functional']})
+    ]),
+    ('task-nback_bold', [
+        ('nifti', '.nii.gz', {'Intent': ['Functional']}),
+        ('tabular data', '_events.tsv', {'Intent': ['Functional']}),
+        ('dicom', '.dicom.zip', {'Intent': ['Functional']})
+    ]),
+    ('dwi_64dir', [
+        ('nifti', '.nii.gz', {'Measurement': ['Diffusion'], 'Intent': ['Structural']}),
+        ('bval', '.bval', {'Measurement': ['Diffusion'], 'Intent': ['Structural']}),
+        ('bvec', '.bvec', {'Measurement': ['Diffusion'], 'Intent': ['Structural']})
+    ]),
+    ('fmap_topup', [
+        ('nifti', '.nii.gz', {'Measurement': ['B0'], 'Intent': ['Fieldmap']}),
+        ('dicom', '.dicom.zip', {'Measurement': ['B0'], 'Intent': ['Fieldmap']})
+    ]),
+    ('fmap_phasediff', [
+        ('nifti', '.nii.gz', {'Measurement': ['B0'], 'Intent': ['Fieldmap']}),
+        ('dicom', '.dicom.zip', {'Measurement': ['B0'], 'Intent': ['Fieldmap']})
+    ]),
+    ('localizer', [
+        ('dicom', '.dicom.zip', {'Intent': ['Localizer']})
+    ])
+]
+
+def generate_project(subjects=10, sessions=2, acquisitions=8, files=3, seed=0):
+    """
+    Generate a synthetic project tree, for benchmarking curation.
+
+    Acquisitions are drawn from ACQUISITION_PROTOCOLS, so that the tree
+    exercises the same template rules and resolvers as real data.
+
+    Args:
+        subjects (int): The number of subjects
+        sessions (int): The number of sessions per subject
+        acquisitions (int): The number of acquisitions per session
+        files (int): The number of files per acquisition
+        seed (int): The random seed, the same seed always produces the same tree
+
+    Returns:
+        TreeNode: The project node
+    """
+    rng = random.Random(seed)
+    project = TreeNode('project', {
+        'id': 'project', 'label': 'Synthetic Project',
+        'files': [{'name': 'README.txt', 'type': 'text'}]
+    })
+    add_file_nodes(project)
+
+    for sub in range(subjects):
+        subject_code = 'sub{0:03d}'.format(sub + 1)
+        for ses in range(sessions):
+            session_id = '{0}_ses{1:02d}'.format(subject_code, ses + 1)
+            session = TreeNode('session', {
+                'id': session_id, 'label': 'ses{0:02d}'.format(ses + 1),
+                'subject': {'code': subject_code}, 'files': []
+            })
+            project.children.append(session)
+
+            for acq in range(acquisitions):
+                label, protocol = ACQUISITION_PROTOCOLS[rng.randrange(len(ACQUISITION_PROTOCOLS))]
+                acq_id = '{0}_acq{1:03d}'.format(session_id, acq + 1)
+                acq_files = []
+                for i in range(files):
+                    file_type, suffix, classification = protocol[i % len(protocol)]
+                    name = '{0}_{1}{2}'.format(acq + 1, label, suffix)
+                    # Number the repeats when there are more files than the protocol defines
+                    if i >= len(protocol):
+                        name = '{0}_{1}_{2}{3}'.format(acq + 1, label, i // len(protocol), suffix)
+                    acq_files.append({
+                        'name': name, 'type': file_type,
+                        'classification': dict((key, list(value)) for key, value in classification.items())
+                    })
+                acquisition = TreeNode('acquisition', {'id': acq_id, 'label': label, 'files': acq_files})
+                add_file_nodes(acquisition)
+                session.children.append(acquisition)
+
+    return project
+
+def count_nodes(project):
+    """Count the nodes of each type in the tree"""
+    counts = {}
+    for context in project.context_iter():
+        ctype = context['container_type']
+        counts[ctype] = counts.get(ctype, 0) + 1
+    return counts
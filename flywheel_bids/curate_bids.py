@@ -1,6 +1,8 @@
 import argparse
+import collections
 import logging
 import json
+import multiprocessing
 import os
 import tempfile
 import sys
@@ -8,12 +10,16 @@ import re
 
 import flywheel
 
-from .supporting_files import bidsify_flywheel, utils, templates
-from .supporting_files.project_tree import get_project_tree
+from .supporting_files import bidsify_flywheel, instrumentation, parallel, utils, templates
+from .supporting_files.errors import BIDSCurationError
+from .supporting_files.project_tree import get_project_tree, add_session_children, value_digest, TreeLoader, TreeNode
 
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger('curate-bids')
 
+# Template info keys that are not part of a container's fingerprint
+FINGERPRINT_EXCLUDED_KEYS = ('fingerprint', 'valid', 'error_message')
+
 def clear_meta_info(context, template):
     if 'info' in context and template.namespace in context['info']:
         del context['info'][template.namespace]
@@ -65,8 +71,9 @@ def validate_meta_info(container, template):
         if templateName:
             templateDef = template.definitions.get(templateName)
             if templateDef:
-                errors = template.validate(templateDef, container['info'][namespace])
-                if errors:
+                # Checking is cheaper than collecting and sorting every error, which is only needed when invalid
+                if not template.is_valid(templateDef, container['info'][namespace]):
+                    errors = template.validate(templateDef, container['info'][namespace])
                     valid = False
                     error_message = '\n'.join([format_validation_error(err) for err in errors])
             else:
@@ -119,7 +126,68 @@ def update_meta_info(fw, context):
     else:
         logger.info('Cannot determine container type: ' + context['container_type'])
 
-def curate_bids_dir(fw, project_id, session_id=None, reset=False, template_file=None, session_only=False):
+def collect_updates(project):
+    """ Collect the contexts of all modified nodes in the tree
+
+    Contexts are grouped by the container that is written to,
+    i.e. the container itself or the parent container of a file.
+    Duplicate writes to the same container or file are dropped,
+    keeping the last one.
+
+    Returns:
+        OrderedDict: {(container_type, container_id): OrderedDict({file_name: context})}
+    """
+    # context_iter modifies the context once its children are visited, so keep a copy
+    return collect_context_updates(context.copy() for context in project.context_iter())
+
+def collect_context_updates(contexts):
+    """ Collect the modified nodes of the given contexts, like collect_updates
+
+    Returns:
+        OrderedDict: {(container_type, container_id): OrderedDict({file_name: context})}
+    """
+    updates = collections.OrderedDict()
+    for context in contexts:
+        ctype = context['container_type']
+        node = context[ctype]
+        if not node.is_dirty():
+            continue
+        if ctype == 'file':
+            parent_ctype = context['parent_container_type']
+            key = (parent_ctype, context[parent_ctype]['id'])
+            name = node['name']
+        else:
+            key = (ctype, node['id'])
+            name = None
+        container_updates = updates.setdefault(key, collections.OrderedDict())
+        container_updates.pop(name, None)
+        container_updates[name] = context
+    return updates
+
+def send_updates(fw, updates, jobs=1):
+    """ Send the collected updates to the server
+
+    Each container's updates are sent in order,
+    with up to `jobs` containers being updated concurrently.
+
+    """
+    def send_container_updates(contexts):
+        for context in contexts.values():
+            parallel.retry_call(update_meta_info, (fw, context))
+
+    count = sum(len(contexts) for contexts in updates.values())
+    logger.info('Updating {0} containers and files in {1} containers'.format(count, len(updates)))
+    results = parallel.run_jobs(send_container_updates, list(updates.values()), jobs=jobs)
+
+    failed = [job_result for job_result in results if not job_result.ok]
+    for job_result in failed:
+        logger.error('Could not update {0}: {1}'.format(
+            ', '.join(name or 'info' for name in job_result.item), job_result.error))
+    if failed:
+        raise BIDSCurationError('Failed to update {0} of {1} containers'.format(len(failed), len(updates)))
+
+def curate_bids_dir(fw, project_id, session_id=None, reset=False, template_file=None, session_only=False, jobs=1,
+        cache_dir=None, lazy=False, workers=1, api_key=None, incremental=False):
     """
 
     fw: Flywheel client
@@ -128,17 +196,261 @@ def curate_bids_dir(fw, project_id, session_id=None, reset=False, template_file=
     reset: Whether or not to reset bids info before curation
     template_file: The template file to use
     session_only: If true, then only curate the provided session
+    jobs: The maximum number of concurrent requests when loading and updating the project
+    cache_dir: Optional directory to cache the project tree in between runs
+    lazy: If true, then retrieve and curate one session at a time, to limit memory use
+    workers: The number of worker processes to curate sessions on
+    api_key: The API key for the worker processes, required if workers > 1
+    incremental: If true, then skip containers and sessions that haven't changed since the last incremental run
+
+    """
+    # Lazy trees would load the whole cache into memory, and never update it
+    if cache_dir and (lazy or workers > 1):
+        raise BIDSCurationError('The tree cache can not be used with lazy trees or workers')
+
+    # Sessions are retrieved by the workers
+    with instrumentation.phase('tree_load'):
+        project = get_project_tree(fw, project_id, session_id=session_id, session_only=session_only, jobs=jobs,
+                cache_dir=cache_dir, lazy=lazy or workers > 1)
+    curate_bids_tree(fw, project, reset, template_file, True, jobs=jobs, workers=workers, api_key=api_key,
+            incremental=incremental)
+
+def curate_bids_tree(fw, project, reset=False, template_file=None, update=True, jobs=1, workers=1, api_key=None,
+        incremental=False):
+    with instrumentation.phase('template_load'):
+        template = load_project_template(fw, project, template_file)
+
+    if workers > 1 and not can_curate_sessions_separately(template):
+        logger.warning('Template has resolvers that look outside of a session, curating in a single process')
+        workers = 1
+    if workers > 1:
+        if not api_key:
+            raise BIDSCurationError('An API key is required to curate with worker processes')
+        curate_bids_workers(fw, api_key, project, template, reset=reset, update=update, jobs=jobs, workers=workers,
+                            incremental=incremental)
+        return
 
+    ##
+    # Curation is a 3-step process, done session by session in a single walk of the tree
+    # 1. Do initial template matching and updating
+    # 2. Perform any path resolutions, once the session is complete
+    # 3. Send the session's updates to server
+    # Anything outside of a session, or resolved against more than its session,
+    # is resolved and sent once the whole tree has been matched.
+    ##
+    errors = []
+    for contexts in curate_contexts(project, template, reset=reset, incremental=incremental):
+        if update:
+            try:
+                with instrumentation.phase('write_back'):
+                    send_updates(fw, collect_context_updates(contexts), jobs=jobs)
+            except BIDSCurationError as exc:
+                # Keep curating the remaining sessions
+                errors.append(exc)
+
+    if errors:
+        raise BIDSCurationError('; '.join(str(exc) for exc in errors))
+
+def curate_contexts(project, template, reset=False, incremental=False):
+    """
+    Match and resolve the tree in a single walk, one session at a time.
+
+    Each session is released once its contexts have been consumed, before the
+    next session is visited, unless some of its contexts were deferred.
+    So lazy trees only keep one session in memory.
+
+    Args:
+        project (TreeNode): The project tree
+        template (Template): The template to curate with
+        reset (bool): Whether to clear existing template info first
+        incremental (bool): Whether to skip unchanged containers, see match_context
+
+    Yields:
+        list(dict): The contexts of each completed session, and finally the deferred contexts
+    """
+    context = project.make_context()
+    with instrumentation.phase('matching'):
+        match_context(context, template, reset=reset, incremental=incremental)
+    # The context is modified once its children are visited, so keep a copy
+    deferred = [context.copy()]
+
+    for child, child_contexts in project.child_context_iters(context):
+        for contexts in curate_child_contexts(child, child_contexts, template, deferred, reset=reset,
+                                              incremental=incremental):
+            yield contexts
+
+    with instrumentation.phase('resolution'):
+        resolve_contexts(deferred, template)
+    yield deferred
+
+def curate_child_contexts(child, child_contexts, template, deferred, reset=False, incremental=False):
+    """
+    Match and resolve the subtree of a child of the project.
+
+    Args:
+        child (TreeNode): The child node, which is released once curated
+        child_contexts (iterable): The contexts of the child's subtree
+        template (Template): The template to curate with
+        deferred (list): The list of contexts to resolve at the end of the walk, which is updated
+        reset (bool): Whether to clear existing template info first
+        incremental (bool): Whether to skip unchanged containers, and unchanged sessions entirely
+
+    Yields:
+        list(dict): The contexts of the session, if child is a session
+    """
+    session_contexts = []
+    releasable = True
+    changed = False
+    for context in child_contexts:
+        with instrumentation.phase('matching'):
+            if match_context(context, template, reset=reset, incremental=incremental):
+                changed = True
+
+        # context_iter modifies the context once its children are visited, so keep a copy
+        context = context.copy()
+        if 'session' in context and is_session_resolved(context, template):
+            session_contexts.append(context)
+        else:
+            deferred.append(context)
+            releasable = False
+
+    # Resolvers only look within the session, so an unchanged session has nothing to update
+    if session_contexts and (changed or not incremental):
+        with instrumentation.phase('resolution'):
+            resolve_contexts(session_contexts, template)
+        yield session_contexts
+    if releasable:
+        child.release()
+
+def is_session_resolved(context, template):
+    """ Whether every resolver for context only looks within its session """
+    for res in bidsify_flywheel.get_resolvers(context, template):
+        if res.resolve_for not in ('session', 'acquisition'):
+            return False
+    return True
+
+def can_curate_sessions_separately(template):
+    """ Whether every resolver in template only looks within a session """
+    for res in template.resolver_map.values():
+        for r in res:
+            if r.resolve_for not in ('session', 'acquisition'):
+                return False
+    return True
+
+def curate_bids_workers(fw, api_key, project, template, reset=False, update=True, jobs=1, workers=2,
+        incremental=False):
+    """
+    Curate the sessions of project on a pool of worker processes.
+
+    The project itself is matched first, then each worker matches, resolves
+    and sends the updates for its sessions, with its own client and a copy of
+    the template. The project and its files are resolved and sent last.
+    The template must be one where can_curate_sessions_separately is true.
+
+    Args:
+        fw (Flywheel): The flywheel client
+        api_key (str): The API key for the workers' clients
+        project (TreeNode): The project tree, sessions are only iterated by the workers
+        template (Template): The template to curate with
+        reset (bool): Whether to clear existing template info first
+        update (bool): Whether to send updates to the server
+        jobs (int): The maximum number of concurrent requests per worker
+        workers (int): The number of worker processes
+        incremental (bool): Whether to skip unchanged containers, see match_context
+    """
+    context = project.make_context()
+    with instrumentation.phase('matching'):
+        match_context(context, template, reset=reset, incremental=incremental)
+    deferred = [context.copy()]
+
+    session_ids = []
+    for child, child_contexts in project.child_context_iters(context):
+        if child.type == 'session':
+            session_ids.append(child['id'])
+        else:
+            for contexts in curate_child_contexts(child, child_contexts, template, deferred, reset=reset,
+                                                  incremental=incremental):
+                pass
+
+    errors = []
+    logger.info('Curating {0} sessions on {1} workers'.format(len(session_ids), workers))
+    pool = multiprocessing.Pool(min(workers, max(len(session_ids), 1)), initializer=init_curate_worker,
+                                initargs=(api_key, project.data, template, reset, update, jobs, incremental))
+    try:
+        for session_id, error in pool.imap_unordered(curate_worker_session, session_ids):
+            if error:
+                logger.error('Could not curate session {0}: {1}'.format(session_id, error))
+                errors.append(session_id)
+    finally:
+        pool.close()
+        pool.join()
+
+    with instrumentation.phase('resolution'):
+        resolve_contexts(deferred, template)
+    if update:
+        with instrumentation.phase('write_back'):
+            send_updates(fw, collect_context_updates(deferred), jobs=jobs)
+
+    if errors:
+        raise BIDSCurationError('Failed to curate {0} of {1} sessions'.format(len(errors), len(session_ids)))
+
+# The state of a curation worker process, set by init_curate_worker
+_worker = {}
+
+def init_curate_worker(api_key, project_data, template, reset, update, jobs, incremental):
+    """ Initialize a curation worker process """
+    fw = flywheel.Flywheel(api_key)
+    _worker.update(fw=fw, project_data=project_data, template=template, reset=reset, update=update,
+                   jobs=jobs, incremental=incremental, loader=TreeLoader(fw, jobs=jobs))
+
+def curate_worker_session(session_id):
+    """
+    Retrieve, curate and send updates for a single session, in a worker process.
+
+    Returns:
+        tuple: The session id, and the error message if it failed
+    """
+    try:
+        loader = _worker['loader']
+        session_data, acqs = loader.get_session({'_id': session_id})
+        session = TreeNode('session', session_data)
+        add_session_children(session, loader.get_acquisitions(acqs))
+
+        # The project has already been matched, only its context is needed
+        project = TreeNode('project', _worker['project_data'])
+        project.children.append(session)
+
+        deferred = []
+        for child, child_contexts in project.child_context_iters(project.make_context()):
+            for contexts in curate_child_contexts(child, child_contexts, _worker['template'], deferred,
+                                                  reset=_worker['reset'], incremental=_worker['incremental']):
+                if _worker['update']:
+                    send_updates(_worker['fw'], collect_context_updates(contexts), jobs=_worker['jobs'])
+        return session_id, None
+    except Exception as exc:
+        # Exceptions may not be picklable, so only return the message
+        return session_id, str(exc) or type(exc).__name__
+
+def load_project_template(fw, project, template_file=None):
     """
-    project = get_project_tree(fw, project_id, session_id=session_id, session_only=session_only)
-    curate_bids_tree(fw, project, reset, template_file, True)
+    Load the curation template for a project.
 
-def curate_bids_tree(fw, project, reset=False, template_file=None, update=True):
+    Uses template_file if given, otherwise a project template attached to
+    the project, otherwise the default template.
+
+    Args:
+        fw (Flywheel): The flywheel client
+        project (TreeNode): The project node
+        template_file (str): The optional path to a template file
+
+    Returns:
+        Template: The loaded template
+    """
     # Get project
     project_files = project.get('files', [])
 
     # Get template (for now, just use default)
-    template = templates.DEFAULT_TEMPLATE
+    template = templates.DEFAULT_TEMPLATE.load()
 
     # Check for project file
     if not template_file:
@@ -154,63 +466,143 @@ def curate_bids_tree(fw, project, reset=False, template_file=None, update=True):
     if template_file:
         template = templates.loadTemplate(template_file)
 
-    ##
-    # Curation is now a 3-pass process
-    # 1. Do initial template matching and updating
-    # 2. Perform any path resolutions
-    # 3. Send updates to server
-    ##
+    return template
 
-    # 1. Do initial template matching and updating
+def match_templates(project, template, reset=False):
+    """
+    Do initial template matching and updating for every container in the tree.
+
+    Args:
+        project (TreeNode): The project tree
+        template (Template): The template to match
+        reset (bool): Whether to clear existing template info first
+    """
     for context in project.context_iter():
-        ctype = context['container_type']
-        parent_ctype = context['parent_container_type']
+        match_context(context, template, reset=reset)
 
-        if reset:
-            clear_meta_info(context[ctype], template)
+def match_context(context, template, reset=False, incremental=False):
+    """
+    Do initial template matching and updating for a single context.
 
-        elif context[ctype].get('info',{}).get('BIDS') == 'NA':
-            continue
+    Args:
+        context (dict): The context, as it is yielded by context_iter
+        template (Template): The template to match
+        reset (bool): Whether to clear existing template info first
+        incremental (bool): Whether to skip containers whose fingerprint hasn't changed,
+            and record the fingerprint of the others
+
+    Returns:
+        bool: False if the container was skipped
+    """
+    ctype = context['container_type']
+    parent_ctype = context['parent_container_type']
 
-        if ctype == 'project':
-            bidsify_flywheel.process_matching_templates(context, template)
-            # Validate meta information
-            # TODO: Improve the validator to understand what is valid for dataset_description file...
-            # validate_meta_info(context['project'])
+    if reset:
+        clear_meta_info(context[ctype], template)
 
-        elif ctype == 'session':
-            bidsify_flywheel.process_matching_templates(context, template)
+    elif context[ctype].get('info',{}).get('BIDS') == 'NA':
+        return False
 
-            # Add run_counter
+    elif incremental and is_unchanged(context, template):
+        if ctype == 'session':
+            # Add run_counter, for any new children
             context['run_counters'] = utils.RunCounterMap()
+        return False
 
-        elif ctype == 'acquisition':
-            bidsify_flywheel.process_matching_templates(context, template)
+    if ctype == 'project':
+        bidsify_flywheel.process_matching_templates(context, template)
+        # Validate meta information
+        # TODO: Improve the validator to understand what is valid for dataset_description file...
+        # validate_meta_info(context['project'])
 
-        elif ctype == 'file':
-            if parent_ctype == 'project' and PROJECT_TEMPLATE_FILE_NAME_REGEX.search(context['file']['name']):
-                # Don't BIDSIFY project template
-                continue
+    elif ctype == 'session':
+        bidsify_flywheel.process_matching_templates(context, template)
 
-            # Process matching
-            context['file'] = bidsify_flywheel.process_matching_templates(context, template)
-            # Validate meta information
-            validate_meta_info(context['file'], template)
+        # Add run_counter
+        context['run_counters'] = utils.RunCounterMap()
 
-    # 2. Perform any path resolutions
-    session = None
+    elif ctype == 'acquisition':
+        bidsify_flywheel.process_matching_templates(context, template)
+
+    elif ctype == 'file':
+        if parent_ctype == 'project' and utils.PROJECT_TEMPLATE_FILE_NAME_REGEX.search(context['file']['name']):
+            # Don't BIDSIFY project template
+            return False
+
+        # Process matching
+        context['file'] = bidsify_flywheel.process_matching_templates(context, template)
+        # Validate meta information
+        validate_meta_info(context['file'], template)
+
+    if incremental:
+        info = context[ctype].get('info', {}).get(template.namespace)
+        if isinstance(info, dict) and 'template' in info:
+            info['fingerprint'] = get_fingerprint(context, template)
+    return True
+
+def get_fingerprint(context, template):
+    """
+    Get the fingerprint of a container, after template matching.
+
+    The fingerprint covers everything that template matching reads for a
+    matched container: the template, the container's own properties and
+    template info, and the context values its auto_update properties use,
+    such as parent labels.
+
+    Args:
+        context (dict): The context of the container
+        template (Template): The template
+
+    Returns:
+        str: The fingerprint
+    """
+    container = context[context['container_type']]
+    info = container['info'][template.namespace]
+    paths = template.get_auto_update_paths(info.get('template'))
+    return value_digest([
+        template.fingerprint,
+        context['container_type'],
+        context['parent_container_type'],
+        container.get('name', container.get('label')),
+        container.get('type'),
+        container.get('classification'),
+        dict((key, value) for key, value in info.items() if key not in FINGERPRINT_EXCLUDED_KEYS),
+        [utils.dict_lookup(context, path) for path in paths]
+    ])
+
+def is_unchanged(context, template):
+    """ Whether the container's recorded fingerprint is still current """
+    info = context[context['container_type']].get('info', {}).get(template.namespace)
+    if not isinstance(info, dict) or not info.get('fingerprint') or 'template' not in info:
+        return False
+    return info['fingerprint'] == get_fingerprint(context, template)
+
+def resolve_paths(project, template):
+    """
+    Perform any path resolutions for every container in the tree.
+
+    Args:
+        project (TreeNode): The project tree, after template matching
+        template (Template): The template to resolve with
+    """
+    # context_iter modifies the context once its children are visited, so resolve it right away
     for context in project.context_iter():
+        resolve_contexts([context], template)
+
+def resolve_contexts(contexts, template):
+    """
+    Perform any path resolutions for the given contexts, in order.
+
+    Args:
+        contexts (list): The contexts, after template matching
+        template (Template): The template to resolve with
+    """
+    for context in contexts:
+        # Drop any index from a previous pass, children are resolved after their parent
+        context[context['container_type']].context_index = None
         # Resolution
         bidsify_flywheel.process_resolvers(context, template)
 
-    # 3. Send updates to server
-    if update:
-        for context in project.context_iter():
-            ctype = context['container_type']
-            node = context[ctype]
-            if node.is_dirty():
-                update_meta_info(fw, context)
-
 def main_with_args(api_key, session_id, reset, session_only):
 
     ### Prep
@@ -241,22 +633,40 @@ def main():
             default=False, help='Only curate the session identified by --session')
     parser.add_argument('--template-file', dest='template_file', action='store',
             default=None, help='Template file to use')
+    parser.add_argument('--jobs', dest='jobs', action='store', type=int,
+            default=parallel.DEFAULT_JOBS, help='Number of concurrent requests when loading and updating the project (default: %(default)s)')
+    parser.add_argument('--tree-cache', dest='cache_dir', action='store',
+            default=None, help='Directory to cache the project tree in, only changed containers are retrieved on later runs (not with --lazy or --workers)')
+    parser.add_argument('--lazy', dest='lazy', action='store_true',
+            default=False, help='Retrieve and curate one session at a time, to limit memory use on large projects')
+    parser.add_argument('--workers', dest='workers', action='store', type=int,
+            default=1, help='Number of processes to curate sessions on (default: %(default)s)')
+    parser.add_argument('--incremental', dest='incremental', action='store_true',
+            default=False, help='Record a fingerprint of each curated container, and skip the ones that are unchanged on later runs')
+    parser.add_argument('--report', dest='report', action='store',
+            default=None, help='Write a JSON report of phase timings and API calls to this file')
     args = parser.parse_args()
 
-    ### Prep
-    # Check API key - raises Error if key is invalid
-    fw = flywheel.Flywheel(args.api_key)
-    # Get project id from label
-    if args.project_label:
-        project_id = utils.validate_project_label(fw, args.project_label)
-    elif args.session_id:
-        project_id = utils.get_project_id_from_session_id(fw, args.session_id)
-    else:
-        print('Either project label or session id is required!')
-        sys.exit(1)
+    if args.cache_dir and (args.lazy or args.workers > 1):
+        parser.error('--tree-cache can not be used with --lazy or --workers')
+
+    with instrumentation.recording(args.report):
+        ### Prep
+        # Check API key - raises Error if key is invalid
+        fw = instrumentation.instrument(flywheel.Flywheel(args.api_key))
+        # Get project id from label
+        if args.project_label:
+            project_id = utils.validate_project_label(fw, args.project_label)
+        elif args.session_id:
+            project_id = utils.get_project_id_from_session_id(fw, args.session_id)
+        else:
+            print('Either project label or session id is required!')
+            sys.exit(1)
 
-    ### Curate BIDS project
-    curate_bids_dir(fw, project_id, args.session_id, reset=args.reset, template_file=args.template_file, session_only=args.session_only)
+        ### Curate BIDS project
+        curate_bids_dir(fw, project_id, args.session_id, reset=args.reset, template_file=args.template_file, session_only=args.session_only,
+                jobs=args.jobs, cache_dir=args.cache_dir, lazy=args.lazy, workers=args.workers, api_key=args.api_key,
+                incremental=args.incremental)
 
 if __name__ == '__main__':
     main()
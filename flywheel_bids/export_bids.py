@@ -1,22 +1,54 @@
 import argparse
 import dateutil.parser
+import io
 import logging
 import json
 import os
 import re
+import shutil
 import sys
+import tarfile
+import tempfile
+import threading
+import time
+import timeit
 import zipfile
 
 import flywheel
 
-from .supporting_files import utils
+from .supporting_files import instrumentation, parallel, utils
+from .supporting_files.blob_cache import BlobCache, DEFAULT_MAX_SIZE, LINK_MODES, parse_size
 from .supporting_files.errors import BIDSExportError
+from .supporting_files.export_query import ServerQueryBackend
 
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger('bids-exporter')
 
 EPOCH = dateutil.parser.parse('1970-01-01 00:00:0Z')
 
+# The manifest of a synced export, kept in the export directory
+MANIFEST_FILENAME = '.flywheel-bids-manifest.json'
+MANIFEST_VERSION = 1
+
+# The journal of an export in progress, kept in the export directory
+JOURNAL_FILENAME = '.flywheel-bids-journal'
+JOURNAL_VERSION = 1
+
+# Archives that exports can be streamed into, see ArchiveWriter
+ARCHIVE_FORMATS = ('tar', 'tar.gz', 'zip')
+# Files that are stored without compression in zip archives
+COMPRESSED_EXTENSIONS = ('.gz', '.zip', '.bz2', '.xz')
+
+# Project files that are extracted when exported
+PROJECT_ZIP_PATTERN = re.compile('[a-zA-Z0-9]+(.zip)')
+
+# The sdk download function for each container type
+DOWNLOAD_FUNCTIONS = {
+    'project': 'download_file_from_project',
+    'session': 'download_file_from_session',
+    'acquisition': 'download_file_from_acquisition'
+}
+
 def validate_dirname(dirname):
     """
     Check the following criteria to ensure 'dirname' is valid
@@ -59,7 +91,7 @@ def get_metadata(ctx, namespace):
 
     return ctx['info'][namespace]
 
-def is_file_excluded_options(namespace, src_data, replace):
+def is_file_excluded_options(namespace, src_data, replace, sync=False):
     def is_file_excluded(f, fpath):
         metadata = get_metadata(f, namespace)
         if not metadata:
@@ -73,8 +105,8 @@ def is_file_excluded_options(namespace, src_data, replace):
             if path and path.startswith('sourcedata'):
                 return True
 
-        # Check if file already exists
-        if os.path.isfile(fpath):
+        # Check if file already exists, a sync decides that from its manifest instead
+        if not sync and os.path.isfile(fpath):
             if not replace:
                 return True
             # Check if the file already exists and whether it is up to date
@@ -126,7 +158,37 @@ def get_folder(f, namespace):
 
     return metadata.get('Folder')
 
-def create_json(meta_info, path, namespace):
+def get_partial_path(path):
+    """ Get the temporary path that the file at path is downloaded to """
+    dirname, basename = os.path.split(path)
+    return os.path.join(dirname, '.{0}.part'.format(basename))
+
+def get_sidecar_path(path):
+    """ Get the path of the JSON sidecar for the file at path """
+    ext = utils.get_extension(path)
+    return re.sub(ext, '.json', path)
+
+def get_file_download(container_id, f, path):
+    """
+    Describe the download of file f to path, for download_bids_files.
+
+    Args:
+        container_id (str): The id of the container that f is attached to
+        f (dict): The file entry
+        path (str): The path to download the file to
+
+    Returns:
+        dict: The download function arguments, and the modified time, size, hash and id of the file
+    """
+    return {
+        'args': (container_id, f['name'], path),
+        'modified': f.get('modified'),
+        'size': f.get('size'),
+        'hash': f.get('hash'),
+        'file_id': f.get('file_id') or f.get('_id')
+    }
+
+def create_json(meta_info, path, namespace, archive=None):
     """
     Given a dictionary of the meta info
         and the path, creates a JSON file
@@ -135,6 +197,9 @@ def create_json(meta_info, path, namespace):
     namespace in the template namespace,
         in this case it is 'BIDS'
 
+    archive is the optional ArchiveWriter to write the JSON file to,
+        instead of the file system
+
     """
     # Remove the 'BIDS' value from info
     try:
@@ -160,77 +225,95 @@ def create_json(meta_info, path, namespace):
         meta_info[key] = value
 
     # Remove extension of path and replace with .json
-    ext = utils.get_extension(path)
-    new_path = re.sub(ext, '.json', path)
+    new_path = get_sidecar_path(path)
 
     # Write out contents to JSON file
+    if archive:
+        archive.add_data(json.dumps(meta_info, sort_keys=True, indent=4).encode('utf-8'), new_path)
+        return
     with open(new_path, 'w') as outfile:
         json.dump(meta_info, outfile,
                 sort_keys=True, indent=4)
 
-def download_bids_files(fw, filepath_downloads, dry_run):
+def download_bids_files(fw, filepath_downloads, dry_run, jobs=1, retries=parallel.DEFAULT_RETRIES, journal=None,
+        archive=None, blob_cache=None, extracted=None):
     """
     filepath_downloads: {container_type: {filepath: {'args': (tuple of args for sdk download function), 'modified': file modified attr}}}
+    jobs: The maximum number of files to download concurrently
+    retries: The number of times to retry a failed download
+    journal: The optional ExportJournal to record progress in, files it has completed are skipped
+    archive: The optional ArchiveWriter to add files to, instead of keeping them at their paths
+    blob_cache: The optional BlobCache to fill files from, only downloading files it doesn't have
+    extracted: The optional dict to fill with the paths of the files extracted from each project zip, by its path
+
+    Files are downloaded to a temporary file next to them, and renamed once complete.
     """
-    # Download all project files
-    logger.info('Downloading project files')
-    for f in filepath_downloads['project']:
-        args = filepath_downloads['project'][f]['args']
-        modified = filepath_downloads['project'][f]['modified']
-        logger.info('Downloading project file: {0}'.format(args[1]))
-        # For dry run, don't actually download
-        if dry_run:
-            logger.info('  to {0}'.format(args[2]))
-            continue
-        fw.download_file_from_project(*args)
-        # Set the mtime of the downloaded file to the 'modified' timestamp in seconds
-        modified_time = float(timestamp_to_int(modified))
-        os.utime(f,(modified_time, modified_time))
-
+    downloads = []
+    for container_type in ('project', 'session', 'acquisition'):
+        logger.info('Downloading {0} files'.format(container_type))
+        for f in filepath_downloads[container_type]:
+            args = filepath_downloads[container_type][f]['args']
+            if journal and journal.is_completed(f):
+                logger.info('Already downloaded {0} file: {1}'.format(container_type, args[1]))
+                continue
+            logger.info('Downloading {0} file: {1}'.format(container_type, args[1]))
+            # For dry run, don't actually download
+            if dry_run:
+                logger.info('  to {0}'.format(args[2]))
+                continue
+            downloads.append((container_type, f))
+
+    def download_file(download):
+        container_type, f = download
+        args = filepath_downloads[container_type][f]['args']
+        modified = filepath_downloads[container_type][f]['modified']
+        download_func = getattr(fw, DOWNLOAD_FUNCTIONS[container_type])
+        def fetch(path):
+            parallel.retry_call(download_func, args[:2] + (path,) + args[3:], retries=retries)
+        if journal:
+            journal.record('started', f)
+
+        # Partial downloads never appear at the destination path
+        if not os.path.isdir(os.path.dirname(f)):
+            os.makedirs(os.path.dirname(f))
+        tmp_path = get_partial_path(f)
+        try:
+            if blob_cache:
+                blob_cache.fetch(filepath_downloads[container_type][f], tmp_path, fetch)
+            else:
+                fetch(tmp_path)
+            # Set the mtime of the downloaded file to the 'modified' timestamp in seconds
+            modified_time = float(timestamp_to_int(modified))
+            os.utime(tmp_path, (modified_time, modified_time))
+            if archive:
+                # If zipfile is attached to project, add its contents
+                if container_type == 'project' and is_project_zip(f):
+                    archive.add_zip_members(tmp_path, f[:-4])
+                else:
+                    archive.add_file(tmp_path, f)
+            else:
+                os.rename(tmp_path, f)
+        finally:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
         # If zipfile is attached to project, unzip...
-        path = args[2]
-        zip_pattern = re.compile('[a-zA-Z0-9]+(.zip)')
-        zip_dirname = path[:-4]
-        if zip_pattern.search(path):
-            zip_ref = zipfile.ZipFile(path, 'r')
-            zip_ref.extractall(zip_dirname)
-            zip_ref.close()
-            # Remove the zipfile
-            os.remove(path)
-
-    # Download all session files
-    logger.info('Downloading session files')
-    for f in filepath_downloads['session']:
-        args = filepath_downloads['session'][f]['args']
-        modified = filepath_downloads['session'][f]['modified']
-        logger.info('Downloading session file: {0}'.format(args[1]))
-        # For dry run, don't actually download
-        if dry_run:
-            logger.info('  to {0}'.format(args[2]))
-            continue
-        fw.download_file_from_session(*args)
-        # Set the mtime of the downloaded file to the 'modified' timestamp in seconds
-        modified_time = float(timestamp_to_int(modified))
-        os.utime(f,(modified_time, modified_time))
+        if container_type == 'project' and not archive:
+            members = extract_project_zip(args[2])
+            if members is not None and extracted is not None:
+                extracted[f] = members
 
+        # Only completed once extracted, so that an interrupted extraction is resumed
+        if journal:
+            journal.record('completed', f)
 
-    # Download all acquisition files
-    logger.info('Downloading acquisition files')
-    for f in filepath_downloads['acquisition']:
-        args = filepath_downloads['acquisition'][f]['args']
-        modified = filepath_downloads['acquisition'][f]['modified']
-        # Download the file
-        logger.info('Downloading acquisition file: {0}'.format(args[1]))
-
-        # For dry run, don't actually download
-        if dry_run:
-            logger.info('  to {0}'.format(args[2]))
-            continue
+    def log_progress(done, total, job_result):
+        container_type, f = job_result.item
+        if job_result.ok:
+            logger.info('Downloaded {0}/{1}: {2}'.format(done, total, f))
+        else:
+            logger.error('Failed {0}/{1}: {2} ({3})'.format(done, total, f, job_result.error))
 
-        fw.download_file_from_acquisition(*args)
-        # Set the mtime of the downloaded file to the 'modified' timestamp in seconds
-        modified_time = float(timestamp_to_int(modified))
-        os.utime(f,(modified_time, modified_time))
+    results = parallel.run_jobs(download_file, downloads, jobs=jobs, progress=log_progress)
 
     # Creating all JSON sidecar files
     logger.info('Creating sidecar files')
@@ -244,22 +327,783 @@ def download_bids_files(fw, filepath_downloads, dry_run):
             logger.info('  to {0}'.format(args[1]))
             continue
 
-        create_json(*args)
+        create_json(*args, archive=archive)
+
+    # Summarize the downloads
+    failed = [job_result for job_result in results if not job_result.ok]
+    logger.info('Downloaded {0} of {1} files'.format(len(results) - len(failed), len(results)))
+    if failed:
+        for job_result in failed:
+            logger.error('Could not download {0}: {1}'.format(job_result.item[1], job_result.error))
+        raise BIDSExportError('Failed to download {0} file(s)'.format(len(failed)))
+
+class SyncPlan(object):
+    """
+    The changes that bring a synced export directory up to date.
+
+    All paths are relative to the export directory.
+
+    Args:
+        entries (dict): The manifest entries of the files to export, by path
+
+    Attributes:
+        unchanged (list): The paths of files that are already up to date
+        moves (list): The (source, destination) paths of files that were renamed
+        downloads (list): The paths of files to download
+        stale (list): The paths of files and sidecars to delete
+    """
+    def __init__(self, entries):
+        self.entries = entries
+        self.unchanged = []
+        self.moves = []
+        self.downloads = []
+        self.stale = []
+
+def get_manifest_path(outdir):
+    return os.path.join(outdir, MANIFEST_FILENAME)
+
+def load_manifest(outdir, container):
+    """
+    Load the manifest of the previous sync of outdir.
+
+    Args:
+        outdir (str): The export directory
+        container (tuple): The container type and id being exported
+
+    Returns:
+        dict: The manifest entries by path, empty if there is no usable manifest
+    """
+    path = get_manifest_path(outdir)
+    if not os.path.isfile(path):
+        return {}
+    try:
+        with open(path, 'r') as f:
+            manifest = json.load(f)
+    except ValueError:
+        logger.warning('Ignoring invalid manifest: {0}'.format(path))
+        return {}
+
+    if manifest.get('version') != MANIFEST_VERSION:
+        logger.warning('Ignoring manifest with a different version: {0}'.format(path))
+        return {}
+    # Files exported from another container are left alone
+    if manifest.get('container') != list(container):
+        logger.warning('Ignoring manifest for another container: {0}'.format(path))
+        return {}
+    return manifest.get('files', {})
+
+def save_manifest(outdir, container, entries):
+    """
+    Save the manifest of outdir, replacing the existing manifest file.
+
+    Args:
+        outdir (str): The export directory
+        container (tuple): The container type and id being exported
+        entries (dict): The manifest entries by path
+    """
+    manifest = {'version': MANIFEST_VERSION, 'container': list(container), 'files': entries}
+    fd, tmp_path = tempfile.mkstemp('.json', dir=outdir)
+    with os.fdopen(fd, 'w') as f:
+        json.dump(manifest, f, indent=2, sort_keys=True)
+    os.rename(tmp_path, get_manifest_path(outdir))
+
+def get_manifest_entries(outdir, filepath_downloads):
+    """
+    Describe the files to export as manifest entries.
+
+    Args:
+        outdir (str): The export directory
+        filepath_downloads (dict): The downloads, as built by download_bids_dir
+
+    Returns:
+        dict: The manifest entries by path, relative to outdir
+    """
+    entries = {}
+    for container_type in DOWNLOAD_FUNCTIONS:
+        for fpath, download in filepath_downloads[container_type].items():
+            sidecar = None
+            if fpath in filepath_downloads['sidecars']:
+                sidecar = os.path.relpath(get_sidecar_path(fpath), outdir)
+            entries[os.path.relpath(fpath, outdir)] = {
+                'container_type': container_type,
+                'container_id': download['args'][0],
+                'name': download['args'][1],
+                'file_id': download.get('file_id'),
+                'modified': timestamp_to_int(download['modified']),
+                'size': download.get('size'),
+                'hash': download.get('hash'),
+                'sidecar': sidecar
+            }
+            # Project zips are extracted and removed, the manifest lists the extracted files instead
+            if container_type == 'project' and is_project_zip(fpath):
+                entries[os.path.relpath(fpath, outdir)]['extract'] = True
+    return entries
+
+def get_content_key(entry):
+    """ Identify the content of a file, which stays the same when a file is renamed """
+    if entry.get('hash'):
+        return ('hash', entry['hash'], entry.get('size'))
+    # Without a hash, only the same version of the same file is known to have the same content
+    return ('file', entry.get('file_id') or (entry['container_id'], entry['name']), entry['modified'],
+            entry.get('size'))
+
+def is_local_file(outdir, path, size):
+    """ Whether the file at path exists, with the given size if it is known """
+    fpath = os.path.join(outdir, path)
+    return os.path.isfile(fpath) and (size is None or os.path.getsize(fpath) == size)
+
+def is_up_to_date(outdir, path, entry, previous):
+    """
+    Whether the local file at path has the content described by entry.
+
+    Args:
+        outdir (str): The export directory
+        path (str): The path, relative to outdir
+        entry (dict): The manifest entry of the file to export
+        previous (dict): The manifest entry of the previous sync, if any
+
+    Returns:
+        bool: True if the file doesn't need to be downloaded
+    """
+    if entry.get('extract'):
+        # The zip is gone, so the same version must have been extracted, and its files still be there
+        return (previous is not None and get_content_key(previous) == get_content_key(entry) and
+                previous.get('members') is not None and
+                all(is_local_file(outdir, member, None) for member in previous['members']))
+    if (previous is not None and get_content_key(previous) == get_content_key(entry) and
+            is_local_file(outdir, path, previous.get('size'))):
+        return True
+    # Files exported before the first sync, or by an interrupted sync, are kept if they look like
+    # what a download would produce
+    return (is_local_file(outdir, path, entry.get('size')) and
+            int(os.path.getmtime(os.path.join(outdir, path))) == entry['modified'])
+
+def plan_sync(outdir, manifest, entries):
+    """
+    Diff the manifest of the previous sync against the files to export.
+
+    Args:
+        outdir (str): The export directory
+        manifest (dict): The manifest entries of the previous sync, by path
+        entries (dict): The manifest entries of the files to export, by path
+
+    Returns:
+        SyncPlan: The changes to make
+    """
+    plan = SyncPlan(entries)
+    for path in sorted(entries):
+        if is_up_to_date(outdir, path, entries[path], manifest.get(path)):
+            plan.unchanged.append(path)
+            if entries[path].get('extract'):
+                entries[path]['members'] = manifest[path]['members']
+    unchanged = set(plan.unchanged)
+
+    # Previously exported files that are still intact can be moved, instead of downloaded again
+    sources = {}
+    for path in sorted(manifest):
+        previous = manifest[path]
+        if path not in unchanged and is_local_file(outdir, path, previous.get('size')):
+            sources.setdefault(get_content_key(previous), []).append(path)
+
+    moved = set()
+    for path in sorted(entries):
+        if path in unchanged:
+            continue
+        # Project zips are extracted again, rather than moved
+        candidates = None
+        if not entries[path].get('extract'):
+            candidates = sources.get(get_content_key(entries[path]))
+        if candidates:
+            source = candidates.pop(0)
+            plan.moves.append((source, path))
+            moved.add(source)
+        else:
+            plan.downloads.append(path)
+
+    wanted = set(entries)
+    wanted.update(entry['sidecar'] for entry in entries.values() if entry.get('sidecar'))
+    # Files extracted from a zip that changed are deleted, before it is extracted again
+    for entry in entries.values():
+        wanted.update(entry.get('members', []))
+    previous_paths = set(manifest)
+    for entry in manifest.values():
+        if entry.get('sidecar'):
+            previous_paths.add(entry['sidecar'])
+        previous_paths.update(entry.get('members', []))
+    plan.stale = sorted(previous_paths - wanted - moved)
+    return plan
+
+def remove_empty_dirs(outdir, path):
+    """ Remove the directories of path that are empty, up to outdir """
+    dirname = os.path.dirname(os.path.join(outdir, path))
+    while os.path.abspath(dirname) != os.path.abspath(outdir) and os.path.isdir(dirname) and not os.listdir(dirname):
+        os.rmdir(dirname)
+        dirname = os.path.dirname(dirname)
+
+def apply_sync(outdir, plan):
+    """
+    Move renamed files and delete stale files in outdir.
+
+    Files are moved in two steps through a temporary directory, so that
+    files that swapped paths don't overwrite each other.
+
+    Args:
+        outdir (str): The export directory
+        plan (SyncPlan): The changes to make
+    """
+    if plan.moves:
+        tmpdir = tempfile.mkdtemp(prefix='.flywheel-bids-sync-', dir=outdir)
+        staged = []
+        for i, (source, path) in enumerate(plan.moves):
+            tmp_path = os.path.join(tmpdir, str(i))
+            os.rename(os.path.join(outdir, source), tmp_path)
+            staged.append((tmp_path, source, path))
+        for tmp_path, source, path in staged:
+            logger.info('Moving {0} to {1}'.format(source, path))
+            fpath = os.path.join(outdir, path)
+            if not os.path.isdir(os.path.dirname(fpath)):
+                os.makedirs(os.path.dirname(fpath))
+            if os.path.exists(fpath):
+                os.remove(fpath)
+            os.rename(tmp_path, fpath)
+            set_modified_time(outdir, path, plan.entries[path])
+        os.rmdir(tmpdir)
+
+    for path in plan.stale:
+        fpath = os.path.join(outdir, path)
+        if os.path.isfile(fpath):
+            logger.info('Deleting stale file {0}'.format(path))
+            os.remove(fpath)
+
+    for path in [source for source, _ in plan.moves] + plan.stale:
+        remove_empty_dirs(outdir, path)
+
+    for path in plan.unchanged:
+        # Extracted project zips are not kept
+        if not plan.entries[path].get('extract'):
+            set_modified_time(outdir, path, plan.entries[path])
+
+def set_modified_time(outdir, path, entry):
+    """ Give a kept or moved file the modified time of the file on the server, like a download """
+    modified_time = float(entry['modified'])
+    os.utime(os.path.join(outdir, path), (modified_time, modified_time))
+
+def sync_bids_files(fw, outdir, filepath_downloads, dry_run, container, jobs=1, journal=None, blob_cache=None):
+    """
+    Bring outdir up to date with the files to export, using the manifest of the previous sync.
+
+    Only new or changed files are downloaded. Renamed files are moved
+    locally, and files that are no longer exported are deleted. Sidecars are
+    always written again. The manifest is updated with the files that are
+    up to date, even if some downloads fail. Project zips are recorded with
+    the files extracted from them, which are deleted along with the zip.
+
+    Args:
+        fw (Flywheel): The flywheel client
+        outdir (str): The export directory
+        filepath_downloads (dict): The downloads, as built by download_bids_dir
+        dry_run (bool): Only log the changes that would be made
+        container (tuple): The container type and id being exported
+        jobs (int): The maximum number of files to download concurrently
+        journal (ExportJournal): The optional journal to record download progress in
+        blob_cache (BlobCache): The optional cache to fill files from
+    """
+    manifest = load_manifest(outdir, container)
+    entries = get_manifest_entries(outdir, filepath_downloads)
+    plan = plan_sync(outdir, manifest, entries)
+    logger.info('Sync: {0} unchanged, {1} moved, {2} to download, {3} stale'.format(
+        len(plan.unchanged), len(plan.moves), len(plan.downloads), len(plan.stale)))
+
+    downloads = set(os.path.join(outdir, path) for path in plan.downloads)
+    filepath_downloads = dict(filepath_downloads)
+    for container_type in DOWNLOAD_FUNCTIONS:
+        filepath_downloads[container_type] = dict(
+            (fpath, download) for fpath, download in filepath_downloads[container_type].items()
+            if fpath in downloads
+        )
+
+    if dry_run:
+        for source, path in plan.moves:
+            logger.info('Would move {0} to {1}'.format(source, path))
+        for path in plan.stale:
+            logger.info('Would delete {0}'.format(path))
+        download_bids_files(fw, filepath_downloads, dry_run, jobs=jobs)
+        return
+
+    extracted = {}
+    try:
+        apply_sync(outdir, plan)
+        download_bids_files(fw, filepath_downloads, dry_run, jobs=jobs, journal=journal, blob_cache=blob_cache,
+                extracted=extracted)
+    finally:
+        # Failed downloads don't get their modified time set, so they are left out
+        up_to_date = {}
+        for path, entry in entries.items():
+            if entry.get('extract'):
+                fpath = os.path.join(outdir, path)
+                if fpath in extracted:
+                    entry['members'] = sorted(os.path.relpath(member, outdir) for member in extracted[fpath])
+                if entry.get('members') is not None:
+                    up_to_date[path] = entry
+            elif (is_local_file(outdir, path, entry.get('size')) and
+                    int(os.path.getmtime(os.path.join(outdir, path))) == entry['modified']):
+                up_to_date[path] = entry
+        save_manifest(outdir, container, up_to_date)
+
+class ExportJournal(object):
+    """
+    An append-only log of the downloads an export planned, started and completed.
+
+    The journal is kept in the export directory until the export succeeds,
+    so that an interrupted export can resume without planning its downloads
+    again. The first line holds the plan and each following line one event,
+    as JSON.
+
+    Args:
+        outdir (str): The export directory
+    """
+    def __init__(self, outdir):
+        self.outdir = outdir
+        self.path = os.path.join(outdir, JOURNAL_FILENAME)
+        self.completed = set()
+        self._file = None
+        self._partial_line = False
+        self._lock = threading.Lock()
+
+    def start(self, container, sync, filepath_downloads):
+        """
+        Start a new journal for the planned downloads, replacing any existing journal.
+
+        Args:
+            container (tuple): The container type and id being exported
+            sync (bool): Whether the export is a sync
+            filepath_downloads (dict): The downloads, as built by get_bids_downloads
+        """
+        plan = {
+            'version': JOURNAL_VERSION,
+            'container': list(container),
+            'sync': sync,
+            'downloads': serialize_downloads(self.outdir, filepath_downloads)
+        }
+        # Write the plan to a temporary file first, so that a journal always starts with a complete plan
+        fd, tmp_path = tempfile.mkstemp('.json', dir=self.outdir)
+        with os.fdopen(fd, 'w') as f:
+            f.write(json.dumps(plan) + '\n')
+            f.flush()
+            os.fsync(f.fileno())
+        os.rename(tmp_path, self.path)
+        self.completed = set()
+
+    def resume(self, container, sync):
+        """
+        Load the plan and progress of an interrupted export.
+
+        Args:
+            container (tuple): The container type and id being exported
+            sync (bool): Whether the export is a sync
+
+        Returns:
+            dict: The planned downloads, or None if there is no journal for this export
+        """
+        if not os.path.isfile(self.path):
+            logger.info('No journal to resume from, starting a new export')
+            return None
+
+        with open(self.path, 'r') as f:
+            content = f.read()
+        lines = content.splitlines()
+        try:
+            plan = json.loads(lines[0])
+        except (IndexError, ValueError):
+            logger.warning('Ignoring invalid journal: {0}'.format(self.path))
+            return None
+        if (plan.get('version') != JOURNAL_VERSION or plan.get('container') != list(container) or
+                plan.get('sync') != sync):
+            logger.warning('Journal {0} is for another export, starting a new export'.format(self.path))
+            return None
+
+        self.completed = set()
+        for line in lines[1:]:
+            try:
+                event = json.loads(line)
+            except ValueError:
+                # The last line is incomplete if the export was killed while writing it
+                continue
+            if event.get('event') == 'completed':
+                self.completed.add(event['path'])
+
+        self._partial_line = not content.endswith('\n')
+
+        filepath_downloads = deserialize_downloads(self.outdir, plan['downloads'])
+        total = sum(len(filepath_downloads[container_type]) for container_type in DOWNLOAD_FUNCTIONS)
+        logger.info('Resuming export, {0} of {1} downloads are complete'.format(len(self.completed), total))
+        return filepath_downloads
+
+    def is_completed(self, fpath):
+        """ Whether the journal recorded the download to fpath as completed, and the file is still there """
+        if os.path.relpath(fpath, self.outdir) not in self.completed:
+            return False
+        # Project zips are removed once extracted, so their directory is there instead
+        if is_project_zip(fpath):
+            return os.path.isdir(fpath[:-4])
+        return os.path.isfile(fpath)
+
+    def record(self, event, fpath):
+        """
+        Record that the download to fpath was started or completed.
+
+        Args:
+            event (str): The event, started or completed
+            fpath (str): The path of the download
+        """
+        path = os.path.relpath(fpath, self.outdir)
+        with self._lock:
+            if self._file is None:
+                self._file = open(self.path, 'a')
+                # Don't append to an incomplete last line
+                if self._partial_line:
+                    self._file.write('\n')
+            self._file.write(json.dumps({'event': event, 'path': path}) + '\n')
+            self._file.flush()
+            if event == 'completed':
+                self.completed.add(path)
+
+    def finish(self):
+        """ Remove the journal, once every download succeeded """
+        if self._file:
+            self._file.close()
+            self._file = None
+        if os.path.exists(self.path):
+            os.remove(self.path)
+
+def serialize_downloads(outdir, filepath_downloads):
+    """
+    Convert planned downloads to JSON, with paths relative to outdir.
+
+    Args:
+        outdir (str): The export directory
+        filepath_downloads (dict): The downloads, as built by get_bids_downloads
+
+    Returns:
+        dict: The JSON serializable downloads
+    """
+    result = {'sidecars': {}}
+    for container_type in DOWNLOAD_FUNCTIONS:
+        result[container_type] = {}
+        for fpath, download in filepath_downloads[container_type].items():
+            result[container_type][os.path.relpath(fpath, outdir)] = {
+                'container_id': download['args'][0],
+                'name': download['args'][1],
+                'modified': download['modified'].isoformat(),
+                'size': download.get('size'),
+                'hash': download.get('hash'),
+                'file_id': download.get('file_id')
+            }
+    for fpath, sidecar in filepath_downloads['sidecars'].items():
+        meta_info, _, namespace = sidecar['args']
+        result['sidecars'][os.path.relpath(fpath, outdir)] = {'info': meta_info, 'namespace': namespace}
+    return result
+
+def deserialize_downloads(outdir, downloads):
+    """
+    Convert downloads serialized by serialize_downloads back to planned downloads.
+
+    Args:
+        outdir (str): The export directory
+        downloads (dict): The serialized downloads
+
+    Returns:
+        dict: The downloads, as built by get_bids_downloads
+    """
+    filepath_downloads = {'sidecars': {}}
+    for container_type in DOWNLOAD_FUNCTIONS:
+        filepath_downloads[container_type] = {}
+        for path, download in downloads[container_type].items():
+            fpath = os.path.join(outdir, path)
+            filepath_downloads[container_type][fpath] = {
+                'args': (download['container_id'], download['name'], fpath),
+                'modified': dateutil.parser.parse(download['modified']),
+                'size': download['size'],
+                'hash': download['hash'],
+                'file_id': download['file_id']
+            }
+    for path, sidecar in downloads['sidecars'].items():
+        fpath = os.path.join(outdir, path)
+        filepath_downloads['sidecars'][fpath] = {'args': (sidecar['info'], fpath, sidecar['namespace'])}
+    return filepath_downloads
+
+def is_project_zip(path):
+    """ Whether the project file at path is a zipfile, that is extracted when exported """
+    return bool(PROJECT_ZIP_PATTERN.search(path))
+
+def extract_project_zip(path):
+    """
+    Extracts a zipfile attached to the project next to it, and removes the zipfile
+
+    Returns the paths of the extracted files, or None if path is not a zipfile
+    """
+    zip_dirname = path[:-4]
+    if is_project_zip(path):
+        zip_ref = zipfile.ZipFile(path, 'r')
+        zip_ref.extractall(zip_dirname)
+        members = get_zip_member_paths(zip_ref, zip_dirname)
+        zip_ref.close()
+        # Remove the zipfile
+        os.remove(path)
+        return members
+    return None
+
+def get_zip_member_paths(zip_ref, dirname):
+    """ Get the paths of the files of zip_ref when extracted to dirname, leaving out any outside of it """
+    root = os.path.abspath(dirname)
+    members = []
+    for name in zip_ref.namelist():
+        if name.endswith('/'):
+            continue
+        member = os.path.normpath(os.path.join(dirname, name))
+        if os.path.abspath(member).startswith(root + os.sep):
+            members.append(member)
+    return members
+
+def get_archive_format(path):
+    """
+    Get the format of the archive to write, from its file name.
+
+    Args:
+        path (str): The path of the archive, or - for stdout
+
+    Returns:
+        str: The archive format, one of ARCHIVE_FORMATS
+    """
+    if path == '-':
+        return 'tar'
+    lower = path.lower()
+    if lower.endswith('.tar.gz') or lower.endswith('.tgz'):
+        return 'tar.gz'
+    if lower.endswith('.tar'):
+        return 'tar'
+    if lower.endswith('.zip'):
+        return 'zip'
+    raise BIDSExportError('Unsupported archive: {0}, expected .tar, .tar.gz, .tgz or .zip'.format(path))
+
+class ArchiveWriter(object):
+    """
+    Streams exported files into a tar or zip archive, as they are downloaded.
+
+    Files are named by their path relative to root, which is where the
+    export would otherwise have been written. Archives are written
+    sequentially, so they can be written to a pipe.
+
+    Archive files are written to a temporary file next to them, which is
+    only renamed into place by close, so a failed export never leaves an
+    incomplete archive that looks complete. A tar archive on stdout is left
+    without its end-of-archive marker when discarded.
+
+    Args:
+        path (str): The path of the archive, or - to write a tar archive to stdout
+        root (str): The directory that file paths are relative to
+    """
+    def __init__(self, path, root):
+        self.path = path
+        self.root = root
+        self.format = get_archive_format(path)
+        self._lock = threading.Lock()
+
+        if path == '-':
+            self.tmp_path = None
+            stream = getattr(sys.stdout, 'buffer', sys.stdout)
+        else:
+            self.tmp_path = get_partial_path(path)
+            stream = None
+        if self.format == 'zip':
+            self._tar = None
+            self._zip = zipfile.ZipFile(self.tmp_path, 'w', zipfile.ZIP_DEFLATED, allowZip64=True)
+        else:
+            self._zip = None
+            mode = 'w|gz' if self.format == 'tar.gz' else 'w|'
+            if stream is None:
+                self._tar = tarfile.open(self.tmp_path, mode)
+            else:
+                self._tar = tarfile.open(fileobj=stream, mode=mode)
+
+    def get_name(self, fpath):
+        """ Get the archive member name of the export file at fpath """
+        return os.path.relpath(fpath, self.root).replace(os.sep, '/')
+
+    def get_compress_type(self, name):
+        # Compressing files that are already compressed only costs time
+        if name.endswith(COMPRESSED_EXTENSIONS):
+            return zipfile.ZIP_STORED
+        return zipfile.ZIP_DEFLATED
+
+    def add_file(self, src_path, fpath):
+        """
+        Add the file at src_path to the archive, as the export file at fpath.
+
+        Args:
+            src_path (str): The path of the file to add, whose mtime is kept
+            fpath (str): The path of the file in the export
+        """
+        name = self.get_name(fpath)
+        with self._lock:
+            if self._zip is not None:
+                self._zip.write(src_path, name, self.get_compress_type(name))
+            else:
+                info = self._tar.gettarinfo(src_path, name)
+                info.mode = 0o644
+                info.uid = info.gid = 0
+                info.uname = info.gname = ''
+                with open(src_path, 'rb') as f:
+                    self._tar.addfile(info, f)
+
+    def add_data(self, data, fpath, mtime=None):
+        """
+        Add data to the archive, as the export file at fpath.
+
+        Args:
+            data (bytes): The file contents
+            fpath (str): The path of the file in the export
+            mtime (float): The modified time of the file, defaults to now
+        """
+        name = self.get_name(fpath)
+        if mtime is None:
+            mtime = time.time()
+        with self._lock:
+            if self._zip is not None:
+                info = zipfile.ZipInfo(name, time.localtime(mtime)[:6])
+                info.compress_type = self.get_compress_type(name)
+                info.external_attr = 0o644 << 16
+                self._zip.writestr(info, data)
+            else:
+                info = tarfile.TarInfo(name)
+                info.size = len(data)
+                info.mtime = mtime
+                info.mode = 0o644
+                self._tar.addfile(info, io.BytesIO(data))
+
+    def add_zip_members(self, src_path, fpath):
+        """
+        Add the members of the zip file at src_path to the archive, in the export directory fpath.
+
+        This is the archive equivalent of extract_project_zip.
+
+        Args:
+            src_path (str): The path of the zip file
+            fpath (str): The export directory that the zip file is extracted to
+        """
+        tmpdir = tempfile.mkdtemp(dir=os.path.dirname(src_path))
+        try:
+            with zipfile.ZipFile(src_path, 'r') as zip_ref:
+                zip_ref.extractall(tmpdir)
+            for dirpath, dirnames, filenames in os.walk(tmpdir):
+                dirnames.sort()
+                for filename in sorted(filenames):
+                    member_path = os.path.join(dirpath, filename)
+                    self.add_file(member_path, os.path.join(fpath, os.path.relpath(member_path, tmpdir)))
+        finally:
+            shutil.rmtree(tmpdir)
+
+    def close(self):
+        """ Finish writing the archive, and move it into place """
+        with self._lock:
+            if self._zip is not None:
+                self._zip.close()
+            else:
+                self._tar.close()
+            if self.tmp_path is None:
+                getattr(sys.stdout, 'buffer', sys.stdout).flush()
+            else:
+                os.rename(self.tmp_path, self.path)
+
+    def discard(self):
+        """ Stop writing the archive after a failure, removing it """
+        with self._lock:
+            if self.tmp_path is None:
+                getattr(sys.stdout, 'buffer', sys.stdout).flush()
+                return
+            try:
+                if self._zip is not None:
+                    self._zip.close()
+                else:
+                    self._tar.close()
+            finally:
+                os.remove(self.tmp_path)
 
 def download_bids_dir(fw, container_id, container_type, outdir, src_data=False,
-        dry_run=False, replace=False, subjects=[], sessions=[], folders=[]):
+        dry_run=False, replace=False, subjects=[], sessions=[], folders=[], jobs=1, sync=False, resume=False,
+        archive=None, blob_cache=None, query=None):
     """
 
     fw: Flywheel client
     project_id: Label of the project to download
     outdir: path to directory to download files to, string
     src_data: Option to include sourcedata when downloading
+    jobs: The maximum number of files to download concurrently
+    sync: Bring outdir up to date with a manifest of the previous export, see sync_bids_files
+    resume: Continue the downloads of an interrupted export from its journal, instead of planning them again
+    archive: The optional ArchiveWriter to stream files into, instead of keeping them in outdir
+    blob_cache: The optional BlobCache to fill files from, shared with other exports
+    query: The optional query backend to list containers with, see get_bids_downloads
 
     """
+    container = (container_type, container_id)
+    journal = ExportJournal(outdir)
+    filepath_downloads = None
+    if resume:
+        filepath_downloads = journal.resume(container, sync)
+
+    if filepath_downloads is None:
+        started = timeit.default_timer()
+        filepath_downloads = get_bids_downloads(fw, container_id, container_type, outdir, src_data=src_data,
+                replace=replace, subjects=subjects, sessions=sessions, folders=folders, sync=sync, query=query)
+        instrumentation.add_phase('tree_load', timeit.default_timer() - started)
+        if not dry_run and not archive:
+            journal.start(container, sync, filepath_downloads)
+
+    # Archives are written in a single pass, so can't be resumed
+    if dry_run or archive:
+        journal = None
+
+    with instrumentation.phase('download'):
+        if sync:
+            sync_bids_files(fw, outdir, filepath_downloads, dry_run, container, jobs=jobs, journal=journal,
+                    blob_cache=blob_cache)
+        else:
+            download_bids_files(fw, filepath_downloads, dry_run, jobs=jobs, journal=journal, archive=archive,
+                    blob_cache=blob_cache)
+
+    # Failed downloads raise, so the journal is kept for a later resume
+    if journal:
+        journal.finish()
+
+def get_bids_downloads(fw, container_id, container_type, outdir, src_data=False, replace=False,
+        subjects=[], sessions=[], folders=[], sync=False, query=None):
+    """
+    Plan the downloads of an export, by walking the container on the server.
+
+    Args:
+        fw (Flywheel): The flywheel client
+        container_id (str): The id of the container to export
+        container_type (str): The type of the container to export
+        outdir (str): The directory to download files to
+        src_data (bool): Whether to include sourcedata
+        replace (bool): Whether to replace files whose modified timestamps don't match
+        subjects (list): The subjects to limit the export to
+        sessions (list): The session labels to limit the export to
+        folders (list): The folders to limit the export to
+        sync (bool): Whether the export is a sync, which includes existing files
+        query (ClientQueryBackend): The backend that lists sessions and acquisitions, narrowed by the filters.
+            Defaults to filtering on the server.
+
+    Returns:
+        dict: The downloads by container type, and the sidecars to write
+    """
+    if query is None:
+        query = ServerQueryBackend(fw)
 
     # Define namespace
     namespace = 'BIDS'
-    is_file_excluded = is_file_excluded_options(namespace, src_data, replace)
+    is_file_excluded = is_file_excluded_options(namespace, src_data, replace, sync=sync)
 
     # Files and the corresponding download arguments separated by parent container
     filepath_downloads = {
@@ -303,13 +1147,13 @@ def download_bids_dir(fw, container_id, container_type, outdir, src_data=False,
                 logger.error('Multiple files with path {0}:\n\t{1} and\n\t{2}'.format(path, f['name'], filepath_downloads['project'][path]['args'][1]))
                 valid = False
 
-            filepath_downloads['project'][path] = {'args': (project['_id'], f['name'], path), 'modified': f.get('modified')}
+            filepath_downloads['project'][path] = get_file_download(project['_id'], f, path)
 
         ## Create dataset_description.json filepath_download
         path = os.path.join(outdir, 'dataset_description.json')
         filepath_downloads['sidecars'][path] = {'args': (project['info'][namespace], path, namespace)}
-        # Get project sessions
-        project_sessions = fw.get_project_sessions(container_id)
+        # Get project sessions, the filters are applied again below in case the query didn't
+        project_sessions = query.get_project_sessions(container_id, subjects=subjects, sessions=sessions)
     elif container_type == 'session':
         project_sessions = [fw.get_session(container_id)]
     else:
@@ -362,11 +1206,11 @@ def download_bids_dir(fw, container_id, container_type, outdir, src_data=False,
                     logger.error('Multiple files with path {0}:\n\t{1} and\n\t{2}'.format(path, f['name'], filepath_downloads['session'][path]['args'][1]))
                     valid = False
 
-                filepath_downloads['session'][path] = {'args': (session['_id'], f['name'], path), 'modified': f.get('modified')}
+                filepath_downloads['session'][path] = get_file_download(session['_id'], f, path)
 
             logger.info('Processing acquisition files')
             # Get acquisitions
-            session_acqs = fw.get_session_acquisitions(proj_ses['_id'])
+            session_acqs = query.get_session_acquisitions(proj_ses['_id'], folders=folders)
             all_acqs += session_acqs
     elif container_type == 'acquisition':
         all_acqs = [fw.get_acquisition(container_id)]
@@ -409,7 +1253,7 @@ def download_bids_dir(fw, container_id, container_type, outdir, src_data=False,
                     logger.error('Multiple files with path {0}:\n\t{1} and\n\t{2}'.format(path, f['name'], filepath_downloads['acquisition'][path]['args'][1]))
                     valid = False
 
-                filepath_downloads['acquisition'][path] = {'args': (acq['_id'], f['name'], path), 'modified': f.get('modified')}
+                filepath_downloads['acquisition'][path] = get_file_download(acq['_id'], f, path)
 
                 # Create the sidecar JSON filepath_download
                 filepath_downloads['sidecars'][path] = {'args': (f['info'], path, namespace)}
@@ -420,7 +1264,7 @@ def download_bids_dir(fw, container_id, container_type, outdir, src_data=False,
     if not valid:
         raise BIDSExportError('Error mapping files from Flywheel to BIDS')
 
-    download_bids_files(fw, filepath_downloads, dry_run)
+    return filepath_downloads
 
 def determine_container(fw, project_label, container_type, container_id):
     """
@@ -444,30 +1288,79 @@ def determine_container(fw, project_label, container_type, container_id):
     return ctype, cid
 
 def export_bids(fw, bids_dir, project_label, subjects=None, sessions=None, folders=None, replace=False,
-        dry_run=False, container_type=None, container_id=None, source_data=False, validate=True):
+        dry_run=False, container_type=None, container_id=None, source_data=False, validate=True, jobs=1, sync=False,
+        resume=False, archive=None, blob_cache=None, query=None):
 
     ### Prep
+    if archive:
+        if sync or resume:
+            raise BIDSExportError('Cannot sync or resume an export to an archive')
+        get_archive_format(archive)
+        return export_bids_archive(fw, archive, project_label, subjects=subjects, sessions=sessions, folders=folders,
+                dry_run=dry_run, container_type=container_type, container_id=container_id, source_data=source_data,
+                jobs=jobs, blob_cache=blob_cache, query=query)
+
     # Check directory name - ensure it exists
     validate_dirname(bids_dir)
 
+    # A filtered export can't tell which files outside of the filter are stale
+    if sync and (subjects or sessions or folders):
+        raise BIDSExportError('Cannot sync an export that is limited to subjects, sessions or folders')
+
     # Check that container args are valid
     ctype, cid = determine_container(fw, project_label, container_type, container_id)
 
     ### Download BIDS project
     download_bids_dir(fw, cid, ctype, bids_dir,
             src_data=source_data, dry_run=dry_run, replace=replace,
-            subjects=subjects, sessions=sessions, folders=folders)
+            subjects=subjects, sessions=sessions, folders=folders, jobs=jobs, sync=sync, resume=resume,
+            blob_cache=blob_cache, query=query)
 
     # Validate the downloaded directory
     #   Go one more step into the hierarchy to pass to the validator...
     if validate and not dry_run:
-        utils.validate_bids(bids_dir)
+        with instrumentation.phase('validation'):
+            utils.validate_bids(bids_dir)
+
+def export_bids_archive(fw, archive, project_label, subjects=None, sessions=None, folders=None, dry_run=False,
+        container_type=None, container_id=None, source_data=False, jobs=1, blob_cache=None, query=None):
+    """
+    Export a BIDS dataset straight into a tar or zip archive.
+
+    Each file is downloaded to a scratch directory, added to the archive and
+    removed, so only the files being downloaded are on disk at any time.
+    The archive is not validated, since it is never extracted. If the
+    export fails, no archive is written.
+
+    Args:
+        archive (str): The path of the archive, or - to write a tar archive to stdout
+
+    The other arguments are the same as for export_bids.
+    """
+    ctype, cid = determine_container(fw, project_label, container_type, container_id)
+
+    scratch_dir = tempfile.mkdtemp(prefix='flywheel-bids-export-')
+    try:
+        writer = None if dry_run else ArchiveWriter(archive, scratch_dir)
+        completed = False
+        try:
+            download_bids_dir(fw, cid, ctype, scratch_dir, src_data=source_data, dry_run=dry_run,
+                    subjects=subjects, sessions=sessions, folders=folders, jobs=jobs, archive=writer,
+                    blob_cache=blob_cache, query=query)
+            completed = True
+        finally:
+            if writer and completed:
+                writer.close()
+            elif writer:
+                writer.discard()
+    finally:
+        shutil.rmtree(scratch_dir)
 
 def main():
     ### Read in arguments
     parser = argparse.ArgumentParser(description='BIDS Directory Export')
     parser.add_argument('--bids-dir', dest='bids_dir', action='store',
-            required=True, help='Name of directory in which to download BIDS hierarchy. \
+            required=False, help='Name of directory in which to download BIDS hierarchy. \
                     NOTE: Directory must be empty.')
     parser.add_argument('--api-key', dest='api_key', action='store',
             required=True, help='API key')
@@ -486,17 +1379,47 @@ def main():
             help='Download single container (acquisition|session|project) in BIDS format. Must provide --container-id.')
     parser.add_argument('--container-id', dest='container_id', action='store', required=False, default=None,
             help='Download single container in BIDS format. Must provide --container-type.')
+    parser.add_argument('--jobs', dest='jobs', action='store', type=int, required=False, default=parallel.DEFAULT_JOBS,
+            help='Number of files to download concurrently (default: %(default)s)')
+    parser.add_argument('--sync', dest='sync', action='store_true', default=False, required=False,
+            help='Keep a manifest in the BIDS directory, and only download new or changed files, move renamed files and delete stale ones')
+    parser.add_argument('--resume', dest='resume', action='store_true', default=False, required=False,
+            help='Continue an interrupted export from the journal in the BIDS directory, only downloading what is missing')
+    parser.add_argument('--archive', dest='archive', action='store', required=False, default=None,
+            help='Stream the export into a .tar, .tar.gz, .tgz or .zip archive instead of --bids-dir, or - for a tar archive on stdout')
+    parser.add_argument('--blob-cache', dest='blob_cache', action='store', required=False, default=None,
+            help='Directory of a local cache of downloaded files, shared by exports, so only new files are downloaded')
+    parser.add_argument('--blob-cache-size', dest='blob_cache_size', action='store', required=False,
+            default=str(DEFAULT_MAX_SIZE), type=parse_size,
+            help='Maximum size of the blob cache, e.g. 500M or 20G, least recently used files are evicted (default 10G)')
+    parser.add_argument('--blob-cache-link', dest='blob_cache_link', action='store', required=False, default='reflink',
+            choices=LINK_MODES, help='How exported files are filled from the blob cache, falling back to copy where '
+            'the file system does not support it. Hardlinked files are read-only (default reflink)')
+    parser.add_argument('--report', dest='report', action='store', required=False, default=None,
+            help='Write a JSON report of phase timings and API calls to this file')
     args = parser.parse_args()
 
-    # Check API key - raises Error if key is invalid
-    fw = flywheel.Flywheel(args.api_key)
-
-    try:
-        export_bids(fw, args.bids_dir, args.project_label, subjects=args.subjects, sessions=args.sessions, folders=args.folders, replace=args.replace,
-                dry_run=args.dry_run, container_type=args.container_type, container_id=args.container_id, source_data=args.source_data)
-    except utils.BIDSException as bids_exception:
-        logger.error(bids_exception)
-        sys.exit(bids_exception.status_code)
+    if not args.bids_dir and not args.archive:
+        parser.error('Either --bids-dir or --archive is required')
+
+    with instrumentation.recording(args.report):
+        # Check API key - raises Error if key is invalid
+        fw = instrumentation.instrument(flywheel.Flywheel(args.api_key))
+
+        blob_cache = None
+        if args.blob_cache:
+            blob_cache = BlobCache(args.blob_cache, max_size=args.blob_cache_size, link_mode=args.blob_cache_link)
+
+        try:
+            export_bids(fw, args.bids_dir, args.project_label, subjects=args.subjects, sessions=args.sessions, folders=args.folders, replace=args.replace,
+                    dry_run=args.dry_run, container_type=args.container_type, container_id=args.container_id, source_data=args.source_data,
+                    jobs=args.jobs, sync=args.sync, resume=args.resume, archive=args.archive, blob_cache=blob_cache)
+        except utils.BIDSException as bids_exception:
+            logger.error(bids_exception)
+            sys.exit(bids_exception.status_code)
+        finally:
+            if blob_cache:
+                blob_cache.close()
 
 if __name__ == '__main__':
     main()
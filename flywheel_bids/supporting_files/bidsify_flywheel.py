@@ -106,10 +106,8 @@ def process_matching_templates(context, template=templates.DEFAULT_TEMPLATE, upl
     if initial:
         # Do initial rule matching
         match = False
-        rules = template.rules
-        # If matching on upload, test against upload_rules as well
-        if upload:
-            rules = rules + template.upload_rules
+        # Only test the rules that can apply to this type of container
+        rules = template.get_rules(container_type, context['parent_container_type'], upload)
         for rule in rules:
             if rule.test(context):
                 print('matches template={0}'.format(rule.template))
@@ -153,22 +151,33 @@ def process_resolvers(context, template=templates.DEFAULT_TEMPLATE):
         context (dict): The context to perform path resolution on
         template (Template): The template
     """
+    # Apply each resolver
+    for resolver in get_resolvers(context, template):
+        resolver.resolve(context)
+
+def get_resolvers(context, template=templates.DEFAULT_TEMPLATE):
+    """
+    Get the resolvers that apply to the template matched by context
+
+    Args:
+        context (dict): The context to perform path resolution on
+        template (Template): The template
+
+    Returns:
+        list(Resolver): The resolvers, empty if no template was matched
+    """
     namespace = template.namespace
 
     container_type = context['container_type']
     container = context[container_type]
 
     if (('info' not in container) or (namespace not in container['info']) or ('template' not in container['info'][namespace])):
-        return
+        return []
 
     # Determine the applied template name
     template_name = container['info'][namespace]['template']
     # Get a list of resolvers that apply to this template
-    resolvers = template.resolver_map.get(template_name, [])
-
-    # Apply each resolver
-    for resolver in resolvers:
-        resolver.resolve(context)
+    return template.resolver_map.get(template_name, [])
 
 
 def ensure_info_exists(context, template=templates.DEFAULT_TEMPLATE):
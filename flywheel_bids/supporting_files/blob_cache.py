@@ -0,0 +1,302 @@
+import errno
+import hashlib
+import json
+import logging
+import os
+import re
+import shutil
+import stat
+import tempfile
+import threading
+import time
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+logger = logging.getLogger('bids-blob-cache')
+
+DEFAULT_MAX_SIZE = 10 * 1024 ** 3
+INDEX_FILENAME = 'index.json'
+
+# How files are filled from the cache, each falls back to a copy where it isn't supported
+LINK_MODES = ('reflink', 'hardlink', 'copy')
+# Linux ioctl that clones a file on copy-on-write file systems, such as btrfs and xfs
+FICLONE = 0x40049409
+
+SIZE_UNITS = {'': 1, 'K': 1024, 'M': 1024 ** 2, 'G': 1024 ** 3, 'T': 1024 ** 4}
+
+def parse_size(value):
+    """
+    Parse a size such as 500M or 10G into bytes.
+
+    Args:
+        value (str): The size, as a number of bytes with an optional K, M, G or T suffix
+
+    Returns:
+        int: The number of bytes
+    """
+    match = re.match(r'^\s*(\d+(?:\.\d+)?)\s*([KMGT]?)i?B?\s*$', str(value), re.IGNORECASE)
+    if not match:
+        raise ValueError('Invalid size: {0}'.format(value))
+    return int(float(match.group(1)) * SIZE_UNITS[match.group(2).upper()])
+
+def get_cache_key(download):
+    """
+    Identify the content of a download, for the cache.
+
+    The same version of a file, by id and modified time, always has the same
+    content. Files without an id fall back to their hash.
+
+    Args:
+        download (dict): The download, as built by export_bids.get_file_download
+
+    Returns:
+        str: The cache key, or None if the content can't be identified
+    """
+    modified = download.get('modified')
+    if download.get('file_id') and modified:
+        if hasattr(modified, 'isoformat'):
+            modified = modified.isoformat()
+        return 'file:{0}:{1}'.format(download['file_id'], modified)
+    if download.get('hash'):
+        return 'hash:{0}'.format(download['hash'])
+    return None
+
+def reflink_file(src, dest):
+    """ Clone src to dest, sharing their blocks until either is modified. Raises OSError if unsupported """
+    if fcntl is None:
+        raise OSError(errno.EOPNOTSUPP, 'Reflinks are not supported on this platform')
+    with open(src, 'rb') as src_file:
+        with open(dest, 'wb') as dest_file:
+            try:
+                fcntl.ioctl(dest_file.fileno(), FICLONE, src_file.fileno())
+            except IOError as exc:
+                raise OSError(exc.errno, str(exc))
+
+class BlobCache(object):
+    """
+    A local cache of downloaded files, that can be shared by exports.
+
+    Blobs are stored by the hash of their cache key, and exports are filled
+    from them by reflink, hardlink or copy, so the API is only called on a
+    miss. When the cache grows over max_size, the least recently used blobs
+    are evicted. Usage is kept in an index file, which is merged with other
+    processes using the same cache when it is saved.
+
+    Blobs are read-only, so hardlinked export files are too, and can't be
+    modified in place by mistake.
+
+    Args:
+        path (str): The cache directory, created if it doesn't exist
+        max_size (int): The maximum total size of the blobs, in bytes
+        link_mode (str): How to fill export files from the cache, one of LINK_MODES
+    """
+    def __init__(self, path, max_size=DEFAULT_MAX_SIZE, link_mode='reflink'):
+        if link_mode not in LINK_MODES:
+            raise ValueError('Invalid link mode: {0}'.format(link_mode))
+        self.path = path
+        self.max_size = max_size
+        self.link_mode = link_mode
+        self.blob_dir = os.path.join(path, 'blobs')
+        self.tmp_dir = os.path.join(path, 'tmp')
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        # The number of fetches using each blob, which must not be evicted
+        self._in_use = {}
+
+        for dirname in (self.blob_dir, self.tmp_dir):
+            if not os.path.isdir(dirname):
+                os.makedirs(dirname)
+
+        # Blob name -> [last used time, size]
+        self.blobs = {}
+        index = self._load_index()
+        for name in os.listdir(self.blob_dir):
+            try:
+                st = os.stat(os.path.join(self.blob_dir, name))
+            except OSError:
+                continue
+            self.blobs[name] = [index.get(name, st.st_mtime), st.st_size]
+
+    @property
+    def size(self):
+        """ The total size of the blobs, in bytes """
+        with self._lock:
+            return sum(blob[1] for blob in self.blobs.values())
+
+    def get_blob_name(self, key):
+        return hashlib.sha1(key.encode('utf-8')).hexdigest()
+
+    def get_blob_path(self, name):
+        return os.path.join(self.blob_dir, name)
+
+    def fetch(self, download, dest, download_func):
+        """
+        Fill dest with the content of download, from the cache if possible.
+
+        On a miss, download_func is called to download the file into the
+        cache, and dest is then filled from the new blob.
+
+        Args:
+            download (dict): The download, as built by export_bids.get_file_download
+            dest (str): The path to fill
+            download_func (callable): Called with a path to download the file to
+
+        Returns:
+            bool: True if dest was filled from the cache
+        """
+        key = get_cache_key(download)
+        if key is None:
+            download_func(dest)
+            return False
+
+        name = self.get_blob_name(key)
+        blob_path = self.get_blob_path(name)
+        with self._lock:
+            self._in_use[name] = self._in_use.get(name, 0) + 1
+        try:
+            if self._fill(name, blob_path, download.get('size'), dest):
+                with self._lock:
+                    self.hits += 1
+                return True
+
+            with self._lock:
+                self.misses += 1
+            self._add(name, blob_path, download_func)
+            self._link(blob_path, dest)
+        finally:
+            with self._lock:
+                self._in_use[name] -= 1
+                if not self._in_use[name]:
+                    del self._in_use[name]
+        self.evict()
+        return False
+
+    def _fill(self, name, blob_path, size, dest):
+        """ Fill dest from the blob, returning False if it is missing or has the wrong size """
+        try:
+            blob_size = os.path.getsize(blob_path)
+        except OSError:
+            return False
+        if size is not None and blob_size != size:
+            logger.warning('Removing cached blob {0} with size {1}, expected {2}'.format(name, blob_size, size))
+            self._remove(name)
+            return False
+        try:
+            self._link(blob_path, dest)
+        except OSError as exc:
+            # Evicted by another process
+            if exc.errno == errno.ENOENT:
+                return False
+            raise
+        with self._lock:
+            self.blobs[name] = [time.time(), blob_size]
+        return True
+
+    def _add(self, name, blob_path, download_func):
+        """ Download a blob into the cache """
+        fd, tmp_path = tempfile.mkstemp(dir=self.tmp_dir)
+        os.close(fd)
+        try:
+            download_func(tmp_path)
+            os.chmod(tmp_path, stat.S_IRUSR | stat.S_IRGRP | stat.S_IROTH)
+            os.rename(tmp_path, blob_path)
+        finally:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+        with self._lock:
+            self.blobs[name] = [time.time(), os.path.getsize(blob_path)]
+
+    def _link(self, blob_path, dest):
+        """ Fill dest from blob_path, according to the link mode """
+        if os.path.exists(dest):
+            os.remove(dest)
+        if self.link_mode == 'hardlink':
+            try:
+                os.link(blob_path, dest)
+                return
+            except OSError as exc:
+                if exc.errno == errno.ENOENT:
+                    raise
+                logger.debug('Could not hardlink {0} ({1}), copying instead'.format(dest, exc))
+        elif self.link_mode == 'reflink':
+            try:
+                reflink_file(blob_path, dest)
+                return
+            except OSError as exc:
+                if exc.errno == errno.ENOENT:
+                    raise
+                logger.debug('Could not reflink {0} ({1}), copying instead'.format(dest, exc))
+        shutil.copyfile(blob_path, dest)
+
+    def _remove(self, name):
+        try:
+            os.remove(self.get_blob_path(name))
+        except OSError as exc:
+            if exc.errno != errno.ENOENT:
+                raise
+        with self._lock:
+            self.blobs.pop(name, None)
+
+    def evict(self):
+        """
+        Evict the least recently used blobs, until the cache is no larger than max_size.
+
+        Returns:
+            int: The number of blobs evicted
+        """
+        with self._lock:
+            total = sum(blob[1] for blob in self.blobs.values())
+            if total <= self.max_size:
+                return 0
+            evicted = []
+            for name, (last_used, size) in sorted(self.blobs.items(), key=lambda item: item[1][0]):
+                if total <= self.max_size:
+                    break
+                if name in self._in_use:
+                    continue
+                evicted.append(name)
+                total -= size
+
+        for name in evicted:
+            logger.debug('Evicting cached blob {0}'.format(name))
+            self._remove(name)
+        return len(evicted)
+
+    def _load_index(self):
+        try:
+            with open(os.path.join(self.path, INDEX_FILENAME), 'r') as f:
+                return json.load(f)
+        except (IOError, OSError, ValueError):
+            return {}
+
+    def save(self):
+        """
+        Save the usage of the blobs, merged with the index of other processes.
+        """
+        index = self._load_index()
+        with self._lock:
+            for name, (last_used, size) in self.blobs.items():
+                index[name] = max(last_used, index.get(name, 0))
+        # Blobs that were evicted, here or elsewhere, are forgotten
+        index = dict((name, last_used) for name, last_used in index.items()
+                     if os.path.exists(self.get_blob_path(name)))
+
+        fd, tmp_path = tempfile.mkstemp(dir=self.tmp_dir)
+        try:
+            with os.fdopen(fd, 'w') as f:
+                json.dump(index, f)
+            os.rename(tmp_path, os.path.join(self.path, INDEX_FILENAME))
+        finally:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+
+    def close(self):
+        """ Evict blobs over the size cap, and save the index """
+        self.evict()
+        self.save()
+        logger.info('Blob cache: {0} hits, {1} misses, {2} bytes in {3}'.format(
+            self.hits, self.misses, self.size, self.path))
@@ -0,0 +1,114 @@
+import logging
+import re
+
+import flywheel
+
+logger = logging.getLogger('bids-export-query')
+
+# Characters that are escaped in filter regular expressions
+REGEX_SPECIAL = re.compile(r'[\\.^$*+?()\[\]{}|]')
+
+class ClientQueryBackend(object):
+    """
+    Lists the containers of an export, leaving all filtering to the client.
+
+    This is the query backend of servers that don't support filters, and
+    the base class of other backends. Backends may return containers that
+    don't match the filters, since the export filters them again, but must
+    return every container that does.
+
+    Args:
+        fw (Flywheel): The flywheel client
+    """
+    def __init__(self, fw):
+        self.fw = fw
+
+    def get_project_sessions(self, project_id, subjects=None, sessions=None):
+        """
+        List the sessions of a project.
+
+        Args:
+            project_id (str): The id of the project
+            subjects (list): The subject codes to limit the sessions to
+            sessions (list): The session labels to limit the sessions to
+
+        Returns:
+            list: The sessions
+        """
+        return self.fw.get_project_sessions(project_id)
+
+    def get_session_acquisitions(self, session_id, folders=None):
+        """
+        List the acquisitions of a session.
+
+        Args:
+            session_id (str): The id of the session
+            folders (list): The BIDS folders to limit the acquisitions to, by the folders of their files
+
+        Returns:
+            list: The acquisitions
+        """
+        return self.fw.get_session_acquisitions(session_id)
+
+class ServerQueryBackend(ClientQueryBackend):
+    """
+    Lists the containers of an export, filtered on the server.
+
+    Subject, session and folder filters are sent as filter queries, so only
+    the matching containers are returned. If the server rejects a filter,
+    or the SDK is too old to send one, filtering falls back to the client
+    for the rest of the export.
+
+    Args:
+        fw (Flywheel): The flywheel client
+    """
+    def __init__(self, fw):
+        super(ServerQueryBackend, self).__init__(fw)
+        self.server_filters = True
+
+    def get_project_sessions(self, project_id, subjects=None, sessions=None):
+        filters = []
+        if subjects:
+            filters.append(get_filter('subject.code', subjects))
+        if sessions:
+            filters.append(get_filter('label', sessions))
+        return self._query(self.fw.get_project_sessions, project_id, filters)
+
+    def get_session_acquisitions(self, session_id, folders=None):
+        filters = []
+        if folders:
+            filters.append(get_filter('files.info.BIDS.Folder', folders))
+        return self._query(self.fw.get_session_acquisitions, session_id, filters)
+
+    def _query(self, func, container_id, filters):
+        if not filters or not self.server_filters:
+            return func(container_id)
+        query = ','.join(filters)
+        try:
+            return func(container_id, filter=query)
+        except flywheel.ApiException as exc:
+            if exc.status not in (400, 422):
+                raise
+            logger.warning('Server rejected filter {0} ({1}), filtering on the client instead'.format(query, exc))
+        except TypeError as exc:
+            # SDK methods reject keyword arguments they don't know
+            if 'filter' not in str(exc):
+                raise
+            logger.warning('SDK does not support filters ({0}), filtering on the client instead'.format(exc))
+        self.server_filters = False
+        return func(container_id)
+
+def get_filter(field, values):
+    """
+    Get a filter query that matches field to any of values exactly.
+
+    Args:
+        field (str): The dotted name of the field
+        values (list): The values to match
+
+    Returns:
+        str: The filter, as a regular expression match
+    """
+    pattern = '^({0})$'.format('|'.join(REGEX_SPECIAL.sub(r'\\\g<0>', value) for value in values))
+    # Commas separate filters, unless they are escaped
+    return '{0}=~{1}'.format(field, pattern.replace(',', '\\,'))
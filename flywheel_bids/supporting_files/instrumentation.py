@@ -0,0 +1,255 @@
+import contextlib
+import json
+import logging
+import os
+import threading
+import timeit
+
+import six
+
+logger = logging.getLogger('bids-instrumentation')
+
+# SDK methods whose size is the size of the local file they read or write, rather than the request body
+FILE_TRANSFER_PREFIXES = ('upload_', 'download_')
+
+class Recorder(object):
+    """
+    Collects phase timings and SDK call statistics for a single run.
+
+    Phases may nest, and phases that run on several threads at once are
+    summed across threads, so phase totals can exceed the wall time.
+
+    Attributes:
+        phases (dict): The count and total seconds of each phase, by name
+        calls (dict): The count, errors, total and maximum seconds and bytes of each SDK method, by name
+    """
+    def __init__(self):
+        self.started = timeit.default_timer()
+        self.phases = {}
+        self.calls = {}
+        self._lock = threading.Lock()
+
+    def add_phase(self, name, seconds):
+        """
+        Record that a phase took seconds.
+
+        Args:
+            name (str): The name of the phase
+            seconds (float): The duration of the phase
+        """
+        with self._lock:
+            entry = self.phases.setdefault(name, {'count': 0, 'seconds': 0.0})
+            entry['count'] += 1
+            entry['seconds'] += seconds
+
+    def add_call(self, name, seconds, size=0, error=False):
+        """
+        Record a call to an SDK method.
+
+        Args:
+            name (str): The name of the SDK method
+            seconds (float): The latency of the call
+            size (int): The number of bytes sent or received
+            error (bool): Whether the call raised
+        """
+        with self._lock:
+            entry = self.calls.setdefault(name, {'count': 0, 'errors': 0, 'seconds': 0.0,
+                                                 'max_seconds': 0.0, 'bytes': 0})
+            entry['count'] += 1
+            entry['errors'] += int(error)
+            entry['seconds'] += seconds
+            entry['max_seconds'] = max(entry['max_seconds'], seconds)
+            entry['bytes'] += size
+
+    def report(self):
+        """
+        Summarize the run.
+
+        Returns:
+            dict: The wall time of the run, its phases and its SDK calls, with totals over all calls
+        """
+        with self._lock:
+            calls = dict((name, dict(entry)) for name, entry in self.calls.items())
+            phases = dict((name, dict(entry)) for name, entry in self.phases.items())
+
+        for entry in calls.values():
+            entry['mean_seconds'] = entry['seconds'] / entry['count']
+
+        return {
+            'seconds': timeit.default_timer() - self.started,
+            'phases': phases,
+            'api': {
+                'count': sum(entry['count'] for entry in calls.values()),
+                'errors': sum(entry['errors'] for entry in calls.values()),
+                'seconds': sum(entry['seconds'] for entry in calls.values()),
+                'bytes': sum(entry['bytes'] for entry in calls.values()),
+                'methods': calls
+            }
+        }
+
+    def write_report(self, path):
+        """
+        Write the report for the run to path, as JSON.
+
+        Args:
+            path (str): The path of the report file
+        """
+        with open(path, 'w') as f:
+            json.dump(self.report(), f, indent=2, sort_keys=True)
+        logger.info('Wrote timing report to {0}'.format(path))
+
+class InstrumentedClient(object):
+    """
+    Wraps a flywheel client, recording the latency and size of every SDK method call.
+
+    Attributes that are not methods, such as api_client, are returned as is.
+
+    Args:
+        fw (Flywheel): The flywheel client
+        recorder (Recorder): The recorder to record calls on
+    """
+    def __init__(self, fw, recorder):
+        self._fw = fw
+        self._recorder = recorder
+
+    def __getattr__(self, name):
+        attr = getattr(self._fw, name)
+        if name.startswith('_') or not callable(attr):
+            return attr
+
+        recorder = self._recorder
+        def call(*args, **kwargs):
+            start = timeit.default_timer()
+            result = None
+            error = True
+            try:
+                result = attr(*args, **kwargs)
+                error = False
+                return result
+            finally:
+                seconds = timeit.default_timer() - start
+                recorder.add_call(name, seconds, get_call_size(name, args, kwargs, result), error)
+        call.__name__ = name
+        return call
+
+def get_call_size(name, args, kwargs, result):
+    """
+    Estimate the number of bytes transferred by an SDK call.
+
+    File transfers count the size of the local file, other calls the size
+    of their JSON request body, and data returned as bytes.
+
+    Args:
+        name (str): The name of the SDK method
+        args (tuple): The positional arguments of the call
+        kwargs (dict): The keyword arguments of the call
+        result: The return value of the call
+
+    Returns:
+        int: The estimated number of bytes
+    """
+    size = 0
+    values = list(args) + list(kwargs.values())
+    if name.startswith(FILE_TRANSFER_PREFIXES):
+        for value in values:
+            if isinstance(value, six.string_types) and os.path.isfile(value):
+                size += os.path.getsize(value)
+    else:
+        for value in values:
+            if isinstance(value, (dict, list)):
+                try:
+                    size += len(json.dumps(value, default=str))
+                except (TypeError, ValueError):
+                    pass
+    if isinstance(result, six.binary_type):
+        size += len(result)
+    return size
+
+# The recorder for the current run, if instrumentation is enabled
+_recorder = None
+
+def start():
+    """
+    Start recording a run, replacing any current recording.
+
+    Returns:
+        Recorder: The new recorder
+    """
+    global _recorder
+    _recorder = Recorder()
+    return _recorder
+
+def stop():
+    """
+    Stop recording.
+
+    Returns:
+        Recorder: The recorder of the run, or None if nothing was recorded
+    """
+    global _recorder
+    recorder, _recorder = _recorder, None
+    return recorder
+
+def get_recorder():
+    """ Returns the current recorder, or None if instrumentation is disabled """
+    return _recorder
+
+@contextlib.contextmanager
+def recording(report_path):
+    """
+    Record the enclosed run, and write its report to report_path.
+
+    Does nothing if report_path is empty. The report is written even if the run fails.
+
+    Args:
+        report_path (str): The path of the JSON report to write
+    """
+    if not report_path:
+        yield None
+        return
+
+    recorder = start()
+    try:
+        yield recorder
+    finally:
+        stop()
+        recorder.write_report(report_path)
+
+def instrument(fw):
+    """
+    Wrap fw to record its SDK calls, if a run is being recorded.
+
+    Args:
+        fw (Flywheel): The flywheel client
+
+    Returns:
+        The instrumented client, or fw itself if instrumentation is disabled
+    """
+    if _recorder is None or isinstance(fw, InstrumentedClient):
+        return fw
+    return InstrumentedClient(fw, _recorder)
+
+def add_phase(name, seconds):
+    """ Record that a phase took seconds, if a run is being recorded """
+    recorder = _recorder
+    if recorder is not None:
+        recorder.add_phase(name, seconds)
+
+@contextlib.contextmanager
+def phase(name):
+    """
+    Time the enclosed block as the named phase, if a run is being recorded.
+
+    Args:
+        name (str): The name of the phase, e.g. matching or upload
+    """
+    recorder = _recorder
+    if recorder is None:
+        yield
+        return
+
+    start = timeit.default_timer()
+    try:
+        yield
+    finally:
+        recorder.add_phase(name, timeit.default_timer() - start)
@@ -0,0 +1,123 @@
+import logging
+import time
+
+from multiprocessing.pool import ThreadPool
+
+logger = logging.getLogger('bids-parallel')
+
+DEFAULT_JOBS = 4
+DEFAULT_RETRIES = 3
+DEFAULT_RETRY_DELAY = 1.0
+
+class JobResult(object):
+    """
+    The outcome of running a single job on the worker pool.
+
+    Args:
+        item: The input item the job was run for
+        result: The return value of the job, if it succeeded
+        error (Exception): The exception raised by the job, if it failed
+    """
+    def __init__(self, item, result=None, error=None):
+        self.item = item
+        self.result = result
+        self.error = error
+
+    @property
+    def ok(self):
+        return self.error is None
+
+def retry_call(func, args=(), kwargs=None, retries=DEFAULT_RETRIES, delay=DEFAULT_RETRY_DELAY):
+    """
+    Call func, retrying with a linear backoff if it raises.
+
+    Args:
+        func (callable): The function to call
+        args (tuple): Positional arguments for func
+        kwargs (dict): Keyword arguments for func
+        retries (int): The number of times to retry after the first failure
+        delay (float): The number of seconds to wait before the first retry
+
+    Returns:
+        The return value of func
+    """
+    kwargs = kwargs or {}
+    attempt = 0
+    while True:
+        try:
+            return func(*args, **kwargs)
+        except Exception as exc:
+            attempt += 1
+            if attempt > retries:
+                raise
+            logger.warning('{0} failed ({1}), retrying ({2}/{3})'.format(
+                getattr(func, '__name__', func), exc, attempt, retries))
+            time.sleep(delay * attempt)
+
+def run_jobs(func, items, jobs=1, progress=None):
+    """
+    Run func for every item on a bounded pool of worker threads.
+
+    Exceptions raised by func are captured on the returned JobResult instead
+    of aborting the remaining jobs.
+
+    Args:
+        func (callable): The function to call with each item
+        items (iterable): The items to process
+        jobs (int): The maximum number of concurrent workers
+        progress (callable): Optional callback invoked as progress(done, total, job_result)
+
+    Returns:
+        list(JobResult): The results, in the same order as items
+    """
+    items = list(items)
+    total = len(items)
+    results = [None] * total
+
+    def call(indexed_item):
+        index, item = indexed_item
+        try:
+            return index, JobResult(item, result=func(item))
+        except Exception as exc:
+            return index, JobResult(item, error=exc)
+
+    if jobs is None or jobs <= 1 or total <= 1:
+        completed = (call(indexed_item) for indexed_item in enumerate(items))
+        pool = None
+    else:
+        pool = ThreadPool(min(jobs, total))
+        completed = pool.imap_unordered(call, enumerate(items))
+
+    try:
+        done = 0
+        for index, job_result in completed:
+            results[index] = job_result
+            done += 1
+            if progress:
+                progress(done, total, job_result)
+    finally:
+        if pool:
+            pool.close()
+            pool.join()
+
+    return results
+
+def map_jobs(func, items, jobs=1):
+    """
+    Like map(func, items), but run on a bounded pool of worker threads.
+
+    The first exception raised by func is re-raised once all jobs are done.
+
+    Args:
+        func (callable): The function to call with each item
+        items (iterable): The items to process
+        jobs (int): The maximum number of concurrent workers
+
+    Returns:
+        list: The return values of func, in the same order as items
+    """
+    results = run_jobs(func, items, jobs=jobs)
+    for job_result in results:
+        if not job_result.ok:
+            raise job_result.error
+    return [job_result.result for job_result in results]
@@ -1,15 +1,23 @@
 import collections
+import hashlib
 import logging
-import copy
+import json
+import os
 import sys
+import tempfile
 
 if __name__ == '__main__':
+    import instrumentation
+    import parallel
     import utils
 else:
-    from . import utils
+    from . import instrumentation, parallel, utils
 
 logger = logging.getLogger('curate-bids')
 
+# Bump when the layout of the tree cache file changes
+TREE_CACHE_VERSION = 1
+
 class TreeNode(collections.MutableMapping):
     """
     Represents a single node (Project, Session, Acquisition or File) in
@@ -23,16 +31,18 @@ class TreeNode(collections.MutableMapping):
         type: The type of node
         data: The node data
         children: The children belonging to this node
-        original_info: The original value of the 'info' property
+        original_digest: A digest of each key of the original 'info' property
+        context_index: The index of contexts below this node, used by resolvers
     """
     def __init__(self, node_type, data):
         self.type = node_type
         self.data = data
         self.children = []
-   
-        # save a copy of original info object so we know when
-        # we need to do an update
-        self.original_info = copy.deepcopy(self.data.get('info'))
+        self.context_index = None
+
+        # save a digest of the original info object so we know when
+        # we need to do an update, without keeping a copy of it
+        self.original_digest = info_digest(self.data.get('info'))
 
     def is_dirty(self):
         """
@@ -42,7 +52,21 @@ class TreeNode(collections.MutableMapping):
             bool: True if info has been modified, False if it is unchanged
         """
         info = self.data.get('info')
-        return info != self.original_info
+        if (info is None) != (self.original_digest is None):
+            return True
+        return bool(self.changed_keys())
+
+    def changed_keys(self):
+        """
+        Get the top-level keys of 'info' that have been added, removed or modified.
+
+        Returns:
+            set: The changed keys
+        """
+        original = self.original_digest or {}
+        current = info_digest(self.data.get('info')) or {}
+        return set(key for key in set(original) | set(current)
+                   if original.get(key) != current.get(key))
 
     def to_json(self):
         return {
@@ -51,11 +75,11 @@ class TreeNode(collections.MutableMapping):
             'children': [ x.to_json() for x in self.children ]
         }
 
-    @staticmethod
+    @classmethod
     def from_json(cls, data):
-        node = TreeNode(data['type'], data['data'])
+        node = cls(data['type'], data['data'])
         for child in data.get('children', []):
-            node.children.append(TreeNode.from_json(child))
+            node.children.append(cls.from_json(child))
         return node
 
     def context_iter(self, context=None):
@@ -68,10 +92,29 @@ class TreeNode(collections.MutableMapping):
         Yields:
             dict: The context object for this node
         """
+        context = self.make_context(context)
+
+        # Yield the current context before processing children
+        yield context
+
+        # Depth-first walk down tree
+        for child, child_contexts in self.child_context_iters(context):
+            for ctx in child_contexts:
+                yield ctx
+
+    def make_context(self, context=None):
+        """
+        Produce the context for this node.
+
+        Args:
+            context (dict): The parent context object, which is updated
+
+        Returns:
+            dict: The context object for this node
+        """
         if not context:
             context = {'parent_container_type': None}
 
-        # Depth-first walk down tree
         context['container_type'] = self.type
         context[self.type] = self
         
@@ -83,14 +126,30 @@ class TreeNode(collections.MutableMapping):
         if self.type == 'file':
             context['ext'] = utils.get_extension(self.data['name'])
 
-        # Yield the current context before processing children
-        yield context
+        return context
+
+    def child_context_iters(self, context):
+        """
+        Iterate the children of this node, with an iterator over the contexts of each child's subtree.
+
+        Args:
+            context (dict): The context object for this node, from make_context
 
+        Yields:
+            tuple: The child node, and the context_iter for its subtree
+        """
         context['parent_container_type'] = self.type
         for child in self.children:
             context_copy = context.copy()
-            for ctx in child.context_iter(context_copy):
-                yield ctx
+            yield child, child.context_iter(context_copy)
+
+    def release(self):
+        """
+        Release the memory held by this node, once it has been curated.
+
+        Only nodes that can be loaded again, like LazySessionNode, release anything.
+        """
+        pass
 
     def __len__(self):
         return len(self.data)
@@ -113,6 +172,33 @@ class TreeNode(collections.MutableMapping):
     def __repr__(self):
         return repr(self.data)
 
+def value_digest(value):
+    """
+    Compute a stable digest of a json-like value.
+
+    Args:
+        value: The value to digest
+
+    Returns:
+        str: The hex digest
+    """
+    data = json.dumps(value, sort_keys=True, default=str)
+    return hashlib.sha1(data.encode('utf-8')).hexdigest()
+
+def info_digest(info):
+    """
+    Compute a digest for each top-level key of an info object.
+
+    Args:
+        info (dict): The info object
+
+    Returns:
+        dict: The map of key to value digest, or None if info is None
+    """
+    if info is None:
+        return None
+    return dict((key, value_digest(value)) for key, value in info.items())
+
 def add_file_nodes(parent):
     """
     Add file nodes as children to parent.
@@ -123,15 +209,45 @@ def add_file_nodes(parent):
     for f in parent.get('files', []):
         parent.children.append(TreeNode('file', f))
 
-def get_project_tree(fw, project_id, session_id=None, session_only=False):
+def add_session_children(session, acquisitions):
+    """
+    Add file and acquisition nodes as children to session.
+
+    Args:
+        session (TreeNode): The session node
+        acquisitions (list): The acquisition data, in order
+    """
+    add_file_nodes(session)
+    for acq in acquisitions:
+        acquisition_node = TreeNode('acquisition', acq)
+        add_file_nodes(acquisition_node)
+
+        session.children.append(acquisition_node)
+
+def get_project_tree(fw, project_id, session_id=None, session_only=False, jobs=1, cache_dir=None, lazy=False):
     """
     Construct a project tree from the given project_id.
 
+    Sessions and acquisitions are retrieved concurrently, using up to
+    `jobs` worker threads.
+
+    If cache_dir is given, the tree from the previous run is loaded from
+    the cache, and only the sessions and acquisitions whose modified
+    timestamp changed are retrieved again. The cache is then updated
+    with the current tree.
+
+    If lazy is set, each session is only retrieved when it is iterated,
+    see LazySessionNode. Lazy trees can't use the cache, since it holds
+    the whole tree in memory.
+
     Args:
         fw: Flywheel client
         project_id (str): project id of project to curate
         session_id (str): Optional session_id if session_only
         session_only (bool): Set to true to only get session identified by session_id
+        jobs (int): The maximum number of concurrent requests
+        cache_dir (str): Optional directory for the tree cache
+        lazy (bool): Set to true to retrieve sessions on demand
 
     Returns:
         TreeNode: The project (root) tree node
@@ -144,6 +260,13 @@ def get_project_tree(fw, project_id, session_id=None, session_only=False):
     else:
         session_id = None
 
+    if lazy and cache_dir:
+        raise ValueError('The tree cache can not be used with lazy trees')
+
+    # Load the cached tree from the previous run
+    cache = load_tree_cache(cache_dir, project_id) if cache_dir else None
+    loader = TreeLoader(fw, cache=cache, jobs=jobs)
+
     # Get project
     logger.info('Getting project...')
     project_data = to_dict(fw, fw.get_project(project_id))
@@ -151,29 +274,181 @@ def get_project_tree(fw, project_id, session_id=None, session_only=False):
     add_file_nodes(project_node)
 
     # Get project sessions
-    project_sessions = fw.get_project_sessions(project_id)
-    for proj_ses in project_sessions:
-        if session_id and session_id != proj_ses['_id']:
-            continue
+    project_sessions = [proj_ses for proj_ses in fw.get_project_sessions(project_id)
+                        if not session_id or session_id == proj_ses['_id']]
+
+    if lazy:
+        logger.info('Found {} sessions, they will be retrieved on demand'.format(len(project_sessions)))
+        for proj_ses in project_sessions:
+            project_node.children.append(LazySessionNode(loader, proj_ses))
+        return project_node
+
+    logger.info('Getting {} sessions...'.format(len(project_sessions)))
+    sessions = parallel.map_jobs(loader.get_session, project_sessions, jobs=jobs)
+
+    session_acqs = [ses_acq for session_data, acqs in sessions for ses_acq in acqs]
+    logger.info('Getting {} acquisitions...'.format(len(session_acqs)))
+    acquisitions = iter(loader.get_acquisitions(session_acqs))
 
-        session_data = to_dict(fw, fw.get_session(proj_ses['_id']))
+    if cache_dir:
+        logger.info('Retrieved {} of {} sessions and {} of {} acquisitions, the rest were cached'.format(
+            len(loader.fetched['session']), len(sessions), len(loader.fetched['acquisition']), len(session_acqs)))
+        # Only a single session was retrieved, keep the rest of the cached sessions
+        tree_cache = {'sessions': loader.cached_sessions.copy() if session_id else {}}
+
+    for session_data, acqs in sessions:
         session_node = TreeNode('session', session_data)
-        add_file_nodes(session_node)
+        add_session_children(session_node, [next(acquisitions) for _ in acqs])
 
         project_node.children.append(session_node)
 
+        if cache_dir:
+            tree_cache['sessions'][session_data['id']] = {
+                'data': session_data,
+                'acquisitions': [acq.data for acq in session_node.children if acq.type == 'acquisition']
+            }
+
+    # Save the cache before the tree is modified by curation
+    if cache_dir:
+        save_tree_cache(cache_dir, project_id, tree_cache)
+
+    return project_node
+
+class TreeLoader(object):
+    """
+    Retrieves the sessions and acquisitions of a project tree,
+    reusing cached data that hasn't been modified since.
+
+    Args:
+        fw: Flywheel client
+        cache (dict): The optional tree cache from the previous run
+        jobs (int): The maximum number of concurrent requests
+
+    Attributes:
+        fetched (dict): The ids of the retrieved sessions and acquisitions, that weren't cached
+    """
+    def __init__(self, fw, cache=None, jobs=1):
+        self.fw = fw
+        self.jobs = jobs
+        self.cached_sessions = cache['sessions'] if cache else {}
+        self.cached_acquisitions = dict(
+            (acq['id'], acq) for entry in self.cached_sessions.values() for acq in entry['acquisitions']
+        )
+        self.fetched = {'session': [], 'acquisition': []}
+
+    def get_session(self, proj_ses):
+        """
+        Get the session data and its sorted acquisitions list.
+
+        Args:
+            proj_ses: The session, as returned by get_project_sessions
+
+        Returns:
+            tuple: The session data, and the list of acquisitions to retrieve with get_acquisitions
+        """
+        cached = self.cached_sessions.get(proj_ses['_id'])
+        if cached and cached['data'].get('modified') == get_modified(self.fw, proj_ses):
+            session_data = cached['data']
+        else:
+            session_data = to_dict(self.fw, parallel.retry_call(self.fw.get_session, (proj_ses['_id'],)))
+            self.fetched['session'].append(proj_ses['_id'])
         # Get acquisitions within session
-        session_acqs = fw.get_session_acquisitions(proj_ses['_id'])
+        session_acqs = parallel.retry_call(self.fw.get_session_acquisitions, (proj_ses['_id'],))
+        return session_data, sorted(session_acqs, key=AcquisitionSortKey)
+
+    def get_acquisition(self, ses_acq):
+        cached = self.cached_acquisitions.get(ses_acq['_id'])
+        if cached and cached.get('modified') == get_modified(self.fw, ses_acq):
+            return cached
+        self.fetched['acquisition'].append(ses_acq['_id'])
+        # Get true acquisition, in order to access file info
+        return to_dict(self.fw, parallel.retry_call(self.fw.get_acquisition, (ses_acq['_id'],)))
+
+    def get_acquisitions(self, ses_acqs):
+        """ Get the data of each acquisition concurrently, in order """
+        return parallel.map_jobs(self.get_acquisition, ses_acqs, jobs=self.jobs)
+
+class LazySessionNode(TreeNode):
+    """
+    A session node that retrieves its data and children when it is iterated,
+    and can release them once curated, so only one session needs to be in memory.
+
+    Until it is loaded, the node data is the session returned by
+    get_project_sessions. A released session is retrieved again if it is
+    iterated again, so it reflects any updates that were sent for it.
 
-        for ses_acq in sorted(session_acqs, key=AcquisitionSortKey):
-            # Get true acquisition, in order to access file info
-            acquisition_data = to_dict(fw, fw.get_acquisition(ses_acq['_id']))
-            acquisition_node = TreeNode('acquisition', acquisition_data)
-            add_file_nodes(acquisition_node)
+    Args:
+        loader (TreeLoader): The loader for the project tree
+        proj_ses: The session, as returned by get_project_sessions
+    """
+    def __init__(self, loader, proj_ses):
+        TreeNode.__init__(self, 'session', to_dict(loader.fw, proj_ses))
+        self.loader = loader
+        self.summary = proj_ses
+        self.loaded = False
+
+    def load(self):
+        """ Retrieve the session data and its children """
+        with instrumentation.phase('tree_load'):
+            session_data, acqs = self.loader.get_session(self.summary)
+            TreeNode.__init__(self, 'session', session_data)
+            add_session_children(self, self.loader.get_acquisitions(acqs))
+        self.loaded = True
+
+    def release(self):
+        """ Drop the session data and its children, until it is loaded again """
+        TreeNode.__init__(self, 'session', to_dict(self.loader.fw, self.summary))
+        self.loaded = False
 
-            session_node.children.append(acquisition_node)
+    def context_iter(self, context=None):
+        if not self.loaded:
+            self.load()
+        for ctx in TreeNode.context_iter(self, context):
+            yield ctx
 
-    return project_node
+def get_tree_cache_path(cache_dir, project_id):
+    return os.path.join(cache_dir, '{}.json'.format(project_id))
+
+def load_tree_cache(cache_dir, project_id):
+    """
+    Load the cached tree for project_id.
+
+    Args:
+        cache_dir (str): The tree cache directory
+        project_id (str): The project id
+
+    Returns:
+        dict: The cached sessions, or None if there is no usable cache
+    """
+    path = get_tree_cache_path(cache_dir, project_id)
+    if not os.path.isfile(path):
+        return None
+    try:
+        with open(path, 'r') as f:
+            cache = json.load(f)
+    except ValueError:
+        logger.warning('Ignoring invalid tree cache: {}'.format(path))
+        return None
+    if cache.get('version') != TREE_CACHE_VERSION or cache.get('project_id') != project_id:
+        return None
+    return cache
+
+def save_tree_cache(cache_dir, project_id, cache):
+    """
+    Save the cached tree for project_id, replacing the existing cache file.
+
+    Args:
+        cache_dir (str): The tree cache directory
+        project_id (str): The project id
+        cache (dict): The cached sessions
+    """
+    if not os.path.isdir(cache_dir):
+        os.makedirs(cache_dir)
+    cache = dict(cache, version=TREE_CACHE_VERSION, project_id=project_id)
+    fd, tmp_path = tempfile.mkstemp('.json', dir=cache_dir)
+    with os.fdopen(fd, 'w') as f:
+        json.dump(cache, f)
+    os.rename(tmp_path, get_tree_cache_path(cache_dir, project_id))
 
 class AcquisitionSortKey(object):
     def __init__(self, acq, **args):
@@ -200,16 +475,21 @@ class AcquisitionSortKey(object):
 def to_dict(fw, obj):
     return fw.api_client.sanitize_for_serialization(obj.to_dict())
 
+def get_modified(fw, obj):
+    """Returns the modified timestamp of obj, in the same format as to_dict"""
+    return fw.api_client.sanitize_for_serialization(obj.get('modified'))
+
 if __name__ == '__main__':
     import argparse
     import flywheel
-    import json
 
     parser = argparse.ArgumentParser(description='Dump project tree to json')
     parser.add_argument('--api-key', dest='api_key', action='store',
             required=True, help='API key')
     parser.add_argument('-p', dest='project_label', action='store',
             required=False, default=None, help='Project Label on Flywheel instance')
+    parser.add_argument('--cache-dir', dest='cache_dir', action='store',
+            required=False, default=None, help='Directory to cache the project tree in between runs')
     parser.add_argument('output_file', help='The output file destination')
 
     args = parser.parse_args()
@@ -217,7 +497,7 @@ if __name__ == '__main__':
     fw = flywheel.Flywheel(args.api_key)
     project_id = utils.validate_project_label(fw, args.project_label)
 
-    project_tree = get_project_tree(fw, project_id)
+    project_tree = get_project_tree(fw, project_id, cache_dir=args.cache_dir)
 
     with open(args.output_file, 'w') as f:
         json.dump(project_tree.to_json(), f, indent=2)
@@ -33,6 +33,99 @@ class Filter:
         return True
 
 
+class ContextIndex:
+    """
+    Index of the contexts below a node, for finding the contexts that pass a Filter.
+
+    Contexts are bucketed by the value of each field that filters use, built
+    the first time that field is looked up. Candidates are always confirmed
+    with Filter.test, so the index only needs to never exclude a match.
+
+    Args:
+        node (TreeNode): The node to index, usually a session
+    """
+    def __init__(self, node):
+        # Copy the contexts, since context_iter modifies them after they're yielded
+        self.contexts = [ctx.copy() for ctx in node.context_iter()]
+        self.buckets = {}
+
+    def bucket(self, field):
+        """
+        Get the positions of contexts by value for field.
+
+        Returns:
+            tuple: The map of value to positions, and the positions with unhashable values
+        """
+        if field not in self.buckets:
+            by_value = {}
+            unhashable = []
+            for i, ctx in enumerate(self.contexts):
+                value = utils.dict_lookup(ctx, field)
+                try:
+                    by_value.setdefault(value, []).append(i)
+                except TypeError:
+                    unhashable.append(i)
+            self.buckets[field] = (by_value, unhashable)
+        return self.buckets[field]
+
+    def candidates(self, filt):
+        """
+        Get the positions of contexts that may pass filt.
+
+        Args:
+            filt (Filter): The filter
+
+        Returns:
+            set: The candidate positions
+        """
+        result = None
+        for prop, filter_value in filt.fields.items():
+            values = filter_value if isinstance(filter_value, list) else [filter_value]
+            by_value, unhashable = self.bucket(prop)
+            positions = set(unhashable)
+            try:
+                for value in values:
+                    positions.update(by_value.get(value, []))
+            except TypeError:
+                # Can't look up unhashable filter values, so this field doesn't narrow the search
+                continue
+
+            if result is None:
+                result = positions
+            else:
+                result &= positions
+
+        if result is None:
+            return set(range(len(self.contexts)))
+        return result
+
+    def invalidate(self, field):
+        """
+        Drop the buckets that depend on field, after it was updated.
+
+        Args:
+            field (str): The updated field path
+        """
+        for key in list(self.buckets.keys()):
+            if key == field or key.startswith(field + '.') or field.startswith(key + '.'):
+                del self.buckets[key]
+
+def get_context_index(node):
+    """
+    Get the context index for node, building it on first use.
+
+    Args:
+        node (TreeNode): The node to index
+
+    Returns:
+        ContextIndex: The index, which is shared by every resolver for node
+    """
+    index = getattr(node, 'context_index', None)
+    if index is None:
+        index = ContextIndex(node)
+        node.context_index = index
+    return index
+
 class Resolver:
     """
     Compiled resolver rule
@@ -93,10 +186,13 @@ class Resolver:
                 fields[key] = v
             filters.append(Filter(fields))
 
-        # Iterate through the contexts in the session, collecting matches
-        for ctx in parent.context_iter():
-            for filt in filters:
-                if filt.test(ctx):
+        # Iterate through the candidate contexts in the session, in order, collecting matches
+        index = get_context_index(parent)
+        candidates = [index.candidates(filt) for filt in filters]
+        for i in sorted(set().union(*candidates)):
+            ctx = index.contexts[i]
+            for filt, filt_candidates in zip(filters, candidates):
+                if i in filt_candidates and filt.test(ctx):
                     if self.format:
                         results.append(utils.process_string_template(self.format, ctx))
                     elif self.value:
@@ -108,4 +204,5 @@ class Resolver:
         
         # Finally update the field specified
         utils.dict_set(context, self.update_field, results)
+        index.invalidate(self.update_field)
     
@@ -1,6 +1,13 @@
 import os, os.path, json, re
+import hashlib
+import logging
 import operator
-import jsonschema
+import pickle
+import stat
+import sys
+import tempfile
+import threading
+import collections
 import six
 
 from . import utils
@@ -10,6 +17,14 @@ DEFAULT_TEMPLATE_NAME = 'bids-v1'
 BIDS_TEMPLATE_NAME = 'bids-v1'
 DEFAULT_TEMPLATES = {}
 
+logger = logging.getLogger('bids-templates')
+
+# Where compiled templates are cached, keyed by the digest of their content. Set to an empty string to disable.
+TEMPLATE_CACHE_DIR = os.environ.get('BIDS_TEMPLATE_CACHE_DIR',
+                                    os.path.join(os.path.expanduser('~'), '.cache', 'flywheel-bids', 'templates'))
+# The maximum number of compiled templates to keep, the least recently used are removed
+TEMPLATE_CACHE_MAX_ENTRIES = 32
+
 class Template:
     """
     Represents a project-level template for organizing data.
@@ -25,9 +40,11 @@ class Template:
         rules (list): The list of if rules for applying templates.
         extends (string): The optional name of the template to extend.
         exclude_rules (list): The optional list of rules to exclude from a parent template.
+        fingerprint (str): A digest of the template data, including the template it extends.
     """
     def __init__(self, data, templates=None):
         if data:
+            self.fingerprint = hashlib.sha1(json.dumps(data, sort_keys=True, default=str).encode('utf-8')).hexdigest()
             self.namespace = data.get('namespace')
             self.description = data.get('description', '')
             self.definitions = data.get('definitions', {})
@@ -41,9 +58,14 @@ class Template:
         else:
             raise Exception("data is required")
 
-        if templates:
+        # Only look at templates when extending, so that DEFAULT_TEMPLATES is not loaded needlessly
+        if self.extends and templates:
             self.do_extend(templates)
 
+        self.auto_update_paths = {}
+        self.validators = {}
+        # jsonschema is slow to import, and not needed for templates loaded from the cache
+        import jsonschema
         resolver = jsonschema.RefResolver.from_schema({'definitions': self.definitions})
         self.resolve_refs(resolver, self.definitions)
         self.compile_resolvers()
@@ -64,6 +86,7 @@ class Template:
             raise Exception('Could not find parent template: {0}'.format(self.extends))
 
         parent = templates[self.extends]
+        self.fingerprint = hashlib.sha1((parent.fingerprint + self.fingerprint).encode('utf-8')).hexdigest()
 
         if not self.namespace:
             self.namespace = parent.namespace
@@ -98,6 +121,33 @@ class Template:
             if not isinstance(upload_rule, Rule):
                 self.upload_rules[i] = Rule(upload_rule)
 
+        self.rule_index = {}
+
+    def get_rules(self, container_type, parent_container_type, upload=False):
+        """
+        Get the rules that can match a container, in order.
+
+        Rules whose container_type or parent_container_type conditions exclude
+        the container are skipped. The result is cached per container type.
+
+        Args:
+            container_type (str): The type of container being matched
+            parent_container_type (str): The type of the parent container
+            upload (bool): Whether to include the upload_rules
+
+        Returns:
+            list(Rule): The candidate rules
+        """
+        key = (container_type, parent_container_type, upload)
+        if key not in self.rule_index:
+            rules = self.rules
+            # If matching on upload, test against upload_rules as well
+            if upload:
+                rules = rules + self.upload_rules
+            self.rule_index[key] = [rule for rule in rules
+                                    if rule.can_match(container_type, parent_container_type)]
+        return self.rule_index[key]
+
     def compile_resolvers(self):
         """
         Walk through the definitions
@@ -124,6 +174,8 @@ class Template:
             if not rule:
                 continue
             del init['rule']
+            if 'where' in init:
+                init['_where'] = WhereClause(init['where'])
             if rule not in self.initializer_map:
                 self.initializer_map[rule] = []
             self.initializer_map[rule].append(init)
@@ -139,12 +191,70 @@ class Template:
         """
         if rule_id in self.initializer_map:
             for init in self.initializer_map[rule_id]:
-                if 'where' in init:
-                    if not test_where_clause(init['where'], context):
+                if '_where' in init:
+                    if not init['_where'].test(context):
                         continue
 
                 apply_initializers(init['initialize'], info, context)
 
+    def get_auto_update_paths(self, template_name):
+        """
+        Get the context paths that the auto_update properties of a template definition use.
+
+        Args:
+            template_name (str): The name of the template definition
+
+        Returns:
+            list(str): The dotted paths, in order
+        """
+        if template_name not in self.auto_update_paths:
+            paths = []
+            templateDef = self.definitions.get(template_name) or {}
+            for propDef in templateDef.get('properties', {}).values():
+                auto_update = propDef.get('auto_update')
+                if isinstance(auto_update, dict):
+                    if auto_update.get('$process'):
+                        auto_update = auto_update['$value']
+                    else:
+                        paths.append(auto_update['$value'])
+                        continue
+                if auto_update:
+                    paths.extend(token[1:-1] for token in utils.STRING_TEMPLATE_VALUES.findall(auto_update))
+            self.auto_update_paths[template_name] = paths
+        return self.auto_update_paths[template_name]
+
+    def get_validator(self, templateDef):
+        """
+        Get the schema validator for a template definition, creating it on first use.
+
+        Args:
+            templateDef (dict): The template definition (schema)
+
+        Returns:
+            jsonschema.Draft4Validator: The validator for templateDef
+        """
+        # Keyed by id, the definition is kept alongside so that the id can't be reused
+        entry = self.validators.get(id(templateDef))
+        if entry is None:
+            import jsonschema
+            entry = self.validators[id(templateDef)] = (templateDef, jsonschema.Draft4Validator(templateDef))
+        return entry[1]
+
+    def is_valid(self, templateDef, info):
+        """
+        Check whether info is valid against a template definition schema.
+
+        Stops at the first error, so it is much cheaper than validate for invalid info.
+
+        Args:
+            templateDef (dict): The template definition (schema)
+            info (dict): The info object to validate
+
+        Returns:
+            bool: True if info is valid
+        """
+        return self.get_validator(templateDef).is_valid(info)
+
     def validate(self, templateDef, info):
         """
         Validate info against a template definition schema.
@@ -156,10 +266,13 @@ class Template:
         Returns:
             list(string): A list of validation errors if invalid, otherwise an empty list.
         """
-        if '_validator' not in templateDef:
-            templateDef['_validator'] = jsonschema.Draft4Validator(templateDef)
+        return list(sorted(self.get_validator(templateDef).iter_errors(info), key=str))
 
-        return list(sorted(templateDef['_validator'].iter_errors(info), key=str))
+    def __getstate__(self):
+        # Compiled validators can't be pickled, they are created again when needed
+        state = self.__dict__.copy()
+        state['validators'] = {}
+        return state
 
     def resolve_refs(self, resolver, obj, parent=None, key=None):
         """
@@ -204,6 +317,7 @@ class Rule:
         self.conditions = data.get('where')
         if not self.conditions:
             raise Exception('"where" field is required!')
+        self.where = WhereClause(self.conditions)
 
     def test(self, context):
         """
@@ -215,7 +329,23 @@ class Rule:
         Returns:
             bool: True if the rule matches the given context.
         """
-        return test_where_clause(self.conditions, context)
+        return self.where.test(context)
+
+    def can_match(self, container_type, parent_container_type):
+        """
+        Test if this rule could match a container, based only on its type.
+
+        Args:
+            container_type (str): The type of container
+            parent_container_type (str): The type of the parent container
+
+        Returns:
+            bool: False if the rule can never match the container.
+        """
+        return self.where.can_match({
+            'container_type': container_type,
+            'parent_container_type': parent_container_type
+        })
 
     def initializeProperties(self, info, context):
         """
@@ -341,13 +471,7 @@ def test_where_clause(conditions, context):
     Returns:
         bool: True if the rule matches the given context.
     """
-
-    for field, match in conditions.items():
-        value = utils.dict_lookup(context, field)
-        if not processValueMatch(value, match, field):
-            return False
-
-    return True
+    return WhereClause(conditions).test(context)
 
 def processValueMatch(value, match, condition=None):
     """
@@ -358,66 +482,153 @@ def processValueMatch(value, match, condition=None):
     Returns:
         bool: The result of matching the value against the match spec.
     """
-    if condition:
-        # Handle $or clauses at top-level
-        if condition == "$or":
-            for field, deeper_match in match:
-                value = utils.dict_lookup(context, field)
-                if processValueMatch(value, deeper_match):
-                    return True
-            return False
+    return compile_match(match).test(value)
 
-        # Otherwise AND clauses
-        if condition == "$and":
-            for field, deeper_match in match:
-                value = utils.dict_lookup(context, field)
-                if not processValueMatch(value, deeper_match):
-                    return False
-            return True
+class WhereClause:
+    """
+    A compiled set of conditions, that are all true for a matching context.
 
-    if isinstance(match, dict):
-        # Deeper processing
-        if '$in' in match:
-            # Check if value is in list
-            if isinstance(value, list):
-                for item in value:
-                    if item in match['$in']:
-                        return True
+    Field paths are split and match specs are compiled once, so that testing
+    a context only does the lookups and comparisons.
+
+    Args:
+        conditions (dict): The mapping of field paths to match specs, or a list of (field, match) pairs.
+    """
+    def __init__(self, conditions):
+        if isinstance(conditions, dict):
+            conditions = conditions.items()
+        self.conditions = []
+        for field, match in conditions:
+            # Handle $or and $and clauses, which contain nested conditions
+            if field == '$or':
+                matcher = AnyClause(match)
+            elif field == '$and':
+                matcher = WhereClause(match)
+            else:
+                matcher = compile_match(match)
+            self.conditions.append((field, utils.get_path_accessor(field), matcher))
+
+    def test(self, context):
+        for field, accessor, matcher in self.conditions:
+            if isinstance(matcher, (WhereClause, AnyClause)):
+                if not matcher.test(context):
+                    return False
+            elif not matcher.test(accessor.get(context)):
                 return False
-            elif isinstance(value, six.string_types):
-                for item in match['$in']:
-                    if item in value:
-                        return True
+        return True
+
+    def can_match(self, fields):
+        """
+        Test only the conditions on the given fields, other conditions are assumed to match.
+
+        Args:
+            fields (dict): The known field values
+
+        Returns:
+            bool: False if the known fields rule out a match
+        """
+        for field, accessor, matcher in self.conditions:
+            if field in fields and not matcher.test(fields[field]):
                 return False
+        return True
 
-            return value in match['$in']
+class AnyClause:
+    """
+    A compiled $or clause, where at least one condition is true for a matching context.
 
-        elif '$not' in match:
-            # Negate result of nested match
-            return not processValueMatch(value, match['$not'])
+    Args:
+        conditions (dict): The mapping of field paths to match specs, or a list of (field, match) pairs.
+    """
+    def __init__(self, conditions):
+        self.clauses = [WhereClause([condition]) for condition in
+                        (conditions.items() if isinstance(conditions, dict) else conditions)]
 
-        elif '$regex' in match:
-            regex = re.compile(match['$regex'])
+    def test(self, context):
+        for clause in self.clauses:
+            if clause.test(context):
+                return True
+        return False
 
-            if isinstance(value, list):
-                for item in value:
-                    if regex.search(item) is not None:
-                        return True
+def compile_match(match):
+    """
+    Compile a match spec into a matcher with a test(value) method.
 
-                return False
-            if value is None:
-                return False
-            return regex.search(value) is not None
+    Args:
+        match: The match spec, either a value to compare with, or a dict with $in, $not or $regex.
 
-    else:
+    Returns:
+        The compiled matcher
+    """
+    if isinstance(match, dict):
+        if '$in' in match:
+            return InMatch(match['$in'])
+        elif '$not' in match:
+            return NotMatch(compile_match(match['$not']))
+        elif '$regex' in match:
+            return RegexMatch(match['$regex'])
+        return NoMatch()
+    return EqualsMatch(match)
+
+class EqualsMatch:
+    """Matches a value, or a list containing the value"""
+    def __init__(self, expected):
+        self.expected = expected
+
+    def test(self, value):
         # Direct match
         if isinstance(value, list):
             for item in value:
-                if item == match:
+                if item == self.expected:
                     return True
             return False
 
-        return value == match
+        return value == self.expected
+
+class InMatch:
+    """Matches a value in a list of options, or a string containing one of them"""
+    def __init__(self, options):
+        self.options = options
+
+    def test(self, value):
+        # Check if value is in list
+        if isinstance(value, list):
+            for item in value:
+                if item in self.options:
+                    return True
+        elif isinstance(value, six.string_types):
+            for item in self.options:
+                if item in value:
+                    return True
+        return value in self.options
+
+class NotMatch:
+    """Negates the result of a nested matcher"""
+    def __init__(self, matcher):
+        self.matcher = matcher
+
+    def test(self, value):
+        return not self.matcher.test(value)
+
+class RegexMatch:
+    """Matches a string, or a list containing a string, that contains the pattern"""
+    def __init__(self, pattern):
+        self.regex = re.compile(pattern)
+
+    def test(self, value):
+        if isinstance(value, list):
+            for item in value:
+                if self.regex.search(item) is not None:
+                    return True
+
+            return False
+        if value is None:
+            return False
+        return self.regex.search(value) is not None
+
+class NoMatch:
+    """Never matches, for match specs without a known operator"""
+    def test(self, value):
+        return False
 
 
 def loadTemplates(templates_dir=None):
@@ -446,23 +657,274 @@ def loadTemplate(path, templates=None):
     """
     Load the template at path
 
+    The compiled template is cached in TEMPLATE_CACHE_DIR, and loaded from
+    there the next time a file with the same content is loaded, from any path.
+
     Args:
         path (str): The path to the template to load
         templates (dict): The mapping of template names to template defintions.
     Returns:
         Template: The template that was loaded (otherwise throws)
     """
-    with open(path, 'r') as f:
-        data = json.load(f)
-
-    data = utils.normalize_strings(data)
+    with open(path, 'rb') as f:
+        content = f.read()
 
     if templates is None:
         templates = DEFAULT_TEMPLATES
 
-    return Template(data, templates)
+    cache_key = get_template_cache_key(content)
+    cache_path = get_template_cache_path(cache_key)
+    template = load_cached_template(cache_path, cache_key, templates)
+    if template is None:
+        data = json.loads(content.decode('utf-8'))
+        data = utils.normalize_strings(data)
+
+        template = Template(data, templates)
+        save_cached_template(cache_path, cache_key, template, templates)
+
+    return template
+
+def get_template_cache_path(cache_key):
+    """
+    Get the path where the compiled template with cache_key is cached.
+
+    Templates are cached by content, so custom project templates that are
+    downloaded to a new temporary file on every run are still found.
+
+    Args:
+        cache_key (str): The digest of the template, see get_template_cache_key
+
+    Returns:
+        str: The path of the cache file, or None if caching is disabled
+    """
+    if not TEMPLATE_CACHE_DIR:
+        return None
+
+    name = '{0}-py{1}.pickle'.format(cache_key, sys.version_info[0])
+    return os.path.join(TEMPLATE_CACHE_DIR, name)
+
+def get_template_cache_key(content):
+    """
+    Get the digest that a cached template must match to be used.
+
+    The digest includes the source of the modules that compiled templates
+    are made of, so that changes to them invalidate the cache.
+
+    Args:
+        content (bytes): The content of the template file
+
+    Returns:
+        str: The digest of the template and the code that compiles it
+    """
+    digest = hashlib.sha1(content)
+    for module in (sys.modules[__name__], utils, resolver):
+        source = os.path.splitext(module.__file__)[0] + '.py'
+        try:
+            with open(source, 'rb') as f:
+                digest.update(f.read())
+        except (IOError, OSError):
+            digest.update(module.__file__.encode('utf-8'))
+    return digest.hexdigest()
+
+def get_parent_fingerprint(template, templates):
+    """Get the fingerprint of the template that template extends, if it will be extended"""
+    if template.extends and templates and template.extends in templates:
+        return templates[template.extends].fingerprint
+    return None
+
+def load_cached_template(cache_path, cache_key, templates):
+    """
+    Load a compiled template from the cache.
+
+    Args:
+        cache_path (str): The path of the cache file
+        cache_key (str): The digest of the template, see get_template_cache_key
+        templates (dict): The mapping of template names to template definitions.
+
+    Returns:
+        Template: The cached template, or None if it isn't cached or is out of date
+    """
+    if not cache_path or not os.path.isfile(cache_path):
+        return None
+
+    # Unpickling runs code, so only files that nobody else could have written are loaded
+    if not is_trusted_cache_file(cache_path):
+        logger.warning('Ignoring cached template that is writable by other users: {0}'.format(cache_path))
+        return None
+
+    try:
+        with open(cache_path, 'rb') as f:
+            cached_key, parent_fingerprint, template = pickle.load(f)
+    except Exception as exc:
+        logger.debug('Could not load cached template {0}: {1}'.format(cache_path, exc))
+        return None
+
+    # The template file or the code changed since it was cached
+    if cached_key != cache_key:
+        return None
+
+    # Compile again if the parent template changed or went missing
+    if template.extends and templates and template.extends not in templates:
+        return None
+    if parent_fingerprint != get_parent_fingerprint(template, templates):
+        return None
+
+    # Mark the template as recently used, for prune_template_cache
+    try:
+        os.utime(cache_path, None)
+    except OSError:
+        pass
+    return template
+
+def is_trusted_cache_file(path):
+    """
+    Whether the cache file at path is owned by the current user, and can't be written by anyone else.
+
+    Args:
+        path (str): The path of the cache file
+
+    Returns:
+        bool: True if the file can be unpickled
+    """
+    st = os.stat(path)
+    if hasattr(os, 'getuid') and st.st_uid != os.getuid():
+        return False
+    return not st.st_mode & (stat.S_IWGRP | stat.S_IWOTH)
+
+def save_cached_template(cache_path, cache_key, template, templates):
+    """
+    Save a compiled template to the cache, ignoring failures.
+
+    Removes the least recently used templates once there are more than
+    TEMPLATE_CACHE_MAX_ENTRIES, so that old versions don't accumulate.
+
+    Args:
+        cache_path (str): The path of the cache file
+        cache_key (str): The digest of the template, see get_template_cache_key
+        template (Template): The compiled template
+        templates (dict): The mapping of template names to template definitions.
+    """
+    if not cache_path:
+        return
+
+    try:
+        cache_dir = os.path.dirname(cache_path)
+        if not os.path.isdir(cache_dir):
+            os.makedirs(cache_dir, 0o700)
+
+        # Write to a temporary file first, so that readers never see a partial file
+        fd, tmp_path = tempfile.mkstemp(dir=cache_dir, suffix='.tmp')
+        with os.fdopen(fd, 'wb') as f:
+            pickle.dump((cache_key, get_parent_fingerprint(template, templates), template), f,
+                        pickle.HIGHEST_PROTOCOL)
+        try:
+            os.rename(tmp_path, cache_path)
+        except OSError:
+            os.remove(tmp_path)
+
+        prune_template_cache(cache_dir, TEMPLATE_CACHE_MAX_ENTRIES)
+    except Exception as exc:
+        logger.debug('Could not cache template {0}: {1}'.format(cache_path, exc))
+
+def prune_template_cache(cache_dir, max_entries):
+    """
+    Remove the least recently used compiled templates, keeping max_entries.
+
+    Templates are marked as used by their modified time, which is updated
+    when they are loaded from the cache.
+
+    Args:
+        cache_dir (str): The cache directory
+        max_entries (int): The number of compiled templates to keep
+    """
+    entries = []
+    for name in os.listdir(cache_dir):
+        if name.endswith('.pickle'):
+            path = os.path.join(cache_dir, name)
+            try:
+                entries.append((os.path.getmtime(path), path))
+            except OSError:
+                continue
+    entries.sort(reverse=True)
+    for _, path in entries[max_entries:]:
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+
+class LazyTemplates(collections.Mapping):
+    """
+    The map of template names to templates in a directory, loaded on first access.
+
+    Args:
+        templates_dir (string): The optional directory to load templates from.
+    """
+    def __init__(self, templates_dir=None):
+        self.templates_dir = templates_dir
+        self._templates = None
+        self._loading = False
+        self._lock = threading.RLock()
+
+    @property
+    def loaded(self):
+        return self._templates is not None
+
+    def load(self):
+        """
+        Load the templates, if they haven't been loaded yet.
+
+        Returns:
+            dict: The map of template names to templates
+        """
+        if self._templates is None:
+            with self._lock:
+                # Templates loaded while loading only see the templates loaded so far, that is none
+                if self._loading:
+                    return {}
+                if self._templates is None:
+                    self._loading = True
+                    try:
+                        self._templates = loadTemplates(self.templates_dir)
+                    finally:
+                        self._loading = False
+        return self._templates
+
+    def __getitem__(self, key):
+        return self.load()[key]
+
+    def __iter__(self):
+        return iter(self.load())
+
+    def __len__(self):
+        return len(self.load())
+
+class LazyTemplate(object):
+    """
+    Stands in for a named template in DEFAULT_TEMPLATES, which is loaded on first use.
+
+    Args:
+        name (str): The name of the template
+    """
+    def __init__(self, name):
+        self._name = name
+
+    def load(self):
+        """
+        Get the template that this stands in for.
+
+        Returns:
+            Template: The template, or None if there is no template with this name
+        """
+        return DEFAULT_TEMPLATES.get(self._name)
+
+    def __getattr__(self, name):
+        if name.startswith('__'):
+            raise AttributeError(name)
+        return getattr(self.load(), name)
 
-DEFAULT_TEMPLATES = loadTemplates()
-DEFAULT_TEMPLATE = DEFAULT_TEMPLATES.get(DEFAULT_TEMPLATE_NAME)
-BIDS_TEMPLATE = DEFAULT_TEMPLATES.get(BIDS_TEMPLATE_NAME)
+    def __reduce__(self):
+        return (LazyTemplate, (self._name,))
 
+DEFAULT_TEMPLATES = LazyTemplates()
+DEFAULT_TEMPLATE = LazyTemplate(DEFAULT_TEMPLATE_NAME)
+BIDS_TEMPLATE = LazyTemplate(BIDS_TEMPLATE_NAME)
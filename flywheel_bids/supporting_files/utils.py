@@ -4,7 +4,6 @@ import re
 import six
 import sys
 import subprocess
-import jsonschema
 import collections
 from builtins import input
 
@@ -81,29 +80,81 @@ def get_extension(fname):
 
 def dict_lookup(obj, value, default=None):
     # For now, we don't support escaping of dots
-    parts = value.split('.')
-    curr = obj
-    for part in parts:
-        if isinstance(curr, (dict, collections.Mapping)) and part in curr:
-            curr = curr[part]
-        elif isinstance(curr, list) and int(part) < len(curr):
-            curr = curr[int(part)]
-        else:
-            curr = default
-            break
-    return curr
+    return get_path_accessor(value).get(obj, default)
 
 def dict_set(obj, key, value):
-    parts = key.split('.')
-    curr = obj
-    for part in parts[:-1]:
-        if isinstance(curr, (dict, collections.Mapping)) and part in curr:
-            curr = curr[part]
-        elif isinstance(curr, list) and int(part) < len(curr):
-            curr = curr[int(part)]
-        else:
-            raise ValueError('Could not set value for key: ' + key)
-    curr[parts[-1]] = value
+    get_path_accessor(key).set(obj, value)
+
+# Compiled accessors by dotted path, see get_path_accessor
+PATH_ACCESSOR_CACHE = {}
+PATH_ACCESSOR_CACHE_SIZE = 4096
+# Whether each type that was looked up in is a Mapping, which is slow to check with isinstance
+MAPPING_TYPES = {dict: True}
+
+def is_mapping(obj):
+    obj_type = type(obj)
+    result = MAPPING_TYPES.get(obj_type)
+    if result is None:
+        result = MAPPING_TYPES[obj_type] = isinstance(obj, collections.Mapping)
+    return result
+
+def get_path_accessor(path):
+    """
+    Get the compiled accessor for a dotted path, from the cache if possible.
+
+    Args:
+        path (str): The dotted path, e.g. file.info.BIDS.Filename
+
+    Returns:
+        PathAccessor: The accessor
+    """
+    accessor = PATH_ACCESSOR_CACHE.get(path)
+    if accessor is None:
+        if len(PATH_ACCESSOR_CACHE) >= PATH_ACCESSOR_CACHE_SIZE:
+            PATH_ACCESSOR_CACHE.clear()
+        accessor = PATH_ACCESSOR_CACHE[path] = PathAccessor(path)
+    return accessor
+
+class PathAccessor(object):
+    """
+    Looks up or sets the value at a dotted path, which is only split once.
+
+    Each part of the path is a mapping key, or a list index.
+
+    Args:
+        path (str): The dotted path
+    """
+    def __init__(self, path):
+        self.path = path
+        self.parts = path.split('.')
+        self.parent_parts = self.parts[:-1]
+        self.last_part = self.parts[-1]
+
+    def get(self, obj, default=None):
+        curr = obj
+        for part in self.parts:
+            if is_mapping(curr):
+                if part in curr:
+                    curr = curr[part]
+                    continue
+            elif isinstance(curr, list) and int(part) < len(curr):
+                curr = curr[int(part)]
+                continue
+            return default
+        return curr
+
+    def set(self, obj, value):
+        curr = obj
+        for part in self.parent_parts:
+            if is_mapping(curr):
+                if part in curr:
+                    curr = curr[part]
+                    continue
+            elif isinstance(curr, list) and int(part) < len(curr):
+                curr = curr[int(part)]
+                continue
+            raise ValueError('Could not set value for key: ' + self.path)
+        curr[self.last_part] = value
 
 def dict_match(matcher, matchee):
     """
@@ -146,38 +197,42 @@ def normalize_strings(obj):
 # example template string:
 #       'sub-<subject.code>_ses-<session.label>_acq-<acquisition.label>_{file.info.BIDS.Modality}.nii.gz'
 
+# Tokens of a string template, and the values to substitute within them
+STRING_TEMPLATE_TOKENS = re.compile('[^\[][A-Za-z0-9\.><}{-]+|\[[/A-Za-z0-9><}{_\.-]+\]')
+STRING_TEMPLATE_VALUES = re.compile('[{<][A-Za-z0-9\.-]+[>}]')
+BIDS_LABEL_REGEX = re.compile('(sub|ses)-[a-zA-Z0-9]+')
+
+# The maximum number of compiled string templates to keep
+STRING_TEMPLATE_CACHE_SIZE = 1024
+STRING_TEMPLATE_CACHE = collections.OrderedDict()
+
 def process_string_template(template, context):
-    tokens = re.compile('[^\[][A-Za-z0-9\.><}{-]+|\[[/A-Za-z0-9><}{_\.-]+\]')
-    values = re.compile('[{<][A-Za-z0-9\.-]+[>}]')
+    compiled = compile_string_template(template)
+    if compiled is not None:
+        result = compiled.render(context)
+        if result is not None:
+            return result
+    return replace_string_template(template, context)
+
+def replace_string_template(template, context):
+    """
+    Process a string template by replacing each token in turn.
 
-    for token in tokens.findall(template):
-        if values.search(token):
-            replace_tokens = values.findall(token)
+    This is the reference implementation of process_string_template, which is
+    used for the templates that StringTemplate can't render in a single pass.
+    """
+    for token in STRING_TEMPLATE_TOKENS.findall(template):
+        if STRING_TEMPLATE_VALUES.search(token):
+            replace_tokens = STRING_TEMPLATE_VALUES.findall(token)
             for replace_token in replace_tokens:
                 # Remove the {} or <> surrounding the replace_token
                 path = replace_token[1:-1]
                 # Get keys, if replace token has a . in it
-                keys = path.split(".")
-                result = context
-                for key in keys:
-                    if key in result:
-                        result = result[key]
-                    else:
-                        result = None
-                        break
+                result = lookup_template_value(context, path.split("."))
                 # If value found replace it
                 if result:
-                    # If replace token is <>, need to check if in BIDS
-                    if replace_token[0] == '<':
-                        # Check if result is already in BIDS format...
-                        #   if so, split and grab only the label
-                        if re.match('(sub|ses)-[a-zA-Z0-9]+', result):
-                            label, result = result.split('-')
-                        # If not, take the entire result and remove underscores and dashes
-                        else:
-                            result = ''.join(x for x in result.replace('_', ' ').replace('-', ' ') if x.isalnum())
                     # Replace the token with the result
-                    template = template.replace(replace_token, str(result))
+                    template = template.replace(replace_token, format_template_value(result, replace_token[0] == '<'))
                 # If result not found, but the token is option, remove the token from the template
                 elif token[0] == '[':
                     template = template.replace(token, '')
@@ -195,6 +250,160 @@ def process_string_template(template, context):
 
     return processed_template
 
+def lookup_template_value(context, keys):
+    """ Look up the value of a string template token, or None if not found """
+    result = context
+    for key in keys:
+        if key in result:
+            result = result[key]
+        else:
+            return None
+    return result
+
+def format_template_value(result, bids_label):
+    """ Format a value found for a string template token """
+    # If replace token is <>, need to check if in BIDS
+    if bids_label:
+        # Check if result is already in BIDS format...
+        #   if so, split and grab only the label
+        if BIDS_LABEL_REGEX.match(result):
+            label, result = result.split('-')
+        # If not, take the entire result and remove underscores and dashes
+        else:
+            result = ''.join(x for x in result.replace('_', ' ').replace('-', ' ') if x.isalnum())
+    return str(result)
+
+def compile_string_template(template):
+    """
+    Get the compiled form of a string template, from the cache if possible.
+
+    Args:
+        template (str): The string template
+
+    Returns:
+        StringTemplate: The compiled template, or None if it must be processed with replace_string_template
+    """
+    try:
+        compiled = STRING_TEMPLATE_CACHE.pop(template)
+    except KeyError:
+        compiled = StringTemplate.parse(template)
+        while len(STRING_TEMPLATE_CACHE) >= STRING_TEMPLATE_CACHE_SIZE:
+            STRING_TEMPLATE_CACHE.popitem(last=False)
+    # Keep the most recently used templates at the end
+    STRING_TEMPLATE_CACHE[template] = compiled
+    return compiled
+
+class StringTemplate(object):
+    """
+    A string template, parsed into literal text and value lookup segments.
+
+    Rendering gives the same result as replace_string_template, in a single pass.
+    That's only possible when every value token appears once and the literal
+    text can't form a token, so parse returns None for other templates.
+    Rendering also returns None if a substituted value could form a token.
+
+    Args:
+        segments (list): The literal strings, value segments and optional groups
+    """
+    def __init__(self, segments):
+        self.segments = segments
+
+    @classmethod
+    def parse(cls, template):
+        segments = []
+        value_tokens = []
+        pos = 0
+        for match in STRING_TEMPLATE_TOKENS.finditer(template):
+            token = match.group()
+            if not STRING_TEMPLATE_VALUES.search(token):
+                continue
+            segments.append(template[pos:match.start()])
+            token_segments = []
+            token_pos = 0
+            for value_match in STRING_TEMPLATE_VALUES.finditer(token):
+                replace_token = value_match.group()
+                value_tokens.append(replace_token)
+                token_segments.append(token[token_pos:value_match.start()])
+                token_segments.append(TemplateValue(replace_token))
+                token_pos = value_match.end()
+            token_segments.append(token[token_pos:])
+
+            if token[0] == '[':
+                segments.append(OptionalGroup(token_segments))
+            else:
+                segments.extend(token_segments)
+            pos = match.end()
+        segments.append(template[pos:])
+
+        # Every value must be found in a token, and only once
+        if value_tokens != STRING_TEMPLATE_VALUES.findall(template) or len(set(value_tokens)) != len(value_tokens):
+            return None
+        # Literal text must not form a value token, once the values are substituted
+        for segment in segments:
+            literals = segment.segments if isinstance(segment, OptionalGroup) else [segment]
+            for literal in literals:
+                if isinstance(literal, six.string_types) and any(c in literal for c in '{}<>'):
+                    return None
+
+        return cls([segment for segment in segments if segment != ''])
+
+    def render(self, context):
+        """
+        Render the template against context.
+
+        Returns:
+            str: The processed template, or None if it must be processed with replace_string_template
+        """
+        parts = []
+        for segment in self.segments:
+            if isinstance(segment, six.string_types):
+                parts.append(segment)
+            elif not segment.render(context, parts):
+                return None
+        # Replace any [] from the string
+        return ''.join(parts).replace('[', '').replace(']', '')
+
+class TemplateValue(object):
+    """ A value token of a string template, like {file.info.BIDS.Folder} or <session.label> """
+    def __init__(self, token):
+        self.token = token
+        self.keys = token[1:-1].split('.')
+        self.bids_label = token[0] == '<'
+
+    def render(self, context, parts):
+        """ Add the value, or the token if not found, to parts. Returns False if it can't be rendered """
+        result = lookup_template_value(context, self.keys)
+        if not result:
+            parts.append(self.token)
+            return True
+        value = format_template_value(result, self.bids_label)
+        # The value would be substituted again by a later token
+        if '{' in value or '<' in value:
+            return False
+        parts.append(value)
+        return True
+
+class OptionalGroup(object):
+    """
+    An optional [] token of a string template.
+
+    The group is dropped if its first value isn't found. Values that aren't found
+    after that are kept as tokens, as replace_string_template does.
+    """
+    def __init__(self, segments):
+        self.segments = [segment for segment in segments if segment != '']
+        self.first_value = [segment for segment in self.segments if isinstance(segment, TemplateValue)][0]
+
+    def render(self, context, parts):
+        if not lookup_template_value(context, self.first_value.keys):
+            return True
+        for segment in self.segments:
+            if isinstance(segment, six.string_types):
+                parts.append(segment)
+            elif not segment.render(context, parts):
+                return False
+        return True
+
 
 def get_pattern(format_params):
     return format_params.get("$pattern")
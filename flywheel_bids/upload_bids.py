@@ -1,4 +1,5 @@
 import argparse
+import collections
 import csv
 import json
 import logging
@@ -11,7 +12,8 @@ import flywheel
 
 from six.moves import reduce
 
-from .supporting_files import bidsify_flywheel, classifications, utils
+from .supporting_files import bidsify_flywheel, classifications, instrumentation, parallel, utils
+from .supporting_files.errors import BIDSImportError
 from .supporting_files.templates import BIDS_TEMPLATE as template
 
 
@@ -153,52 +155,114 @@ def check_enabled_rules(fw, project_id):
             return True
     return False
 
-def handle_project(fw, group_id, project_label, assume_yes):
+class ContainerIndex(object):
+    """
+    In-memory index of existing Flywheel containers, built once per upload run.
+
+    Containers are listed once per parent the first time they are looked up,
+    and created containers are added to the index, so that finding a container
+    does not require listing all of its siblings again. Created containers
+    have no children, so theirs are never listed.
+
+    Args:
+        fw: Flywheel client
+    """
+    def __init__(self, fw):
+        self.fw = fw
+        # {(group_id, label): project}
+        self.projects = None
+        # {project_id: {code: subject}}
+        self.subjects = {}
+        # {project_id: {(subject_code, label): session}}
+        self.sessions = {}
+        # {session_id: {label: acquisition}}
+        self.acquisitions = {}
+
+    def find_project(self, group_id, label):
+        if self.projects is None:
+            self.projects = {}
+            for project in self.fw.get_all_projects():
+                self.projects.setdefault((project['group'], project['label']), project)
+        return self.projects.get((group_id, label))
+
+    def add_project(self, project):
+        self.find_project(project['group'], project['label'])
+        self.projects[(project['group'], project['label'])] = project
+        self.subjects.setdefault(project['id'], {})
+        self.sessions.setdefault(project['id'], {})
+
+    def find_subject(self, project_id, code):
+        if project_id not in self.subjects:
+            self.subjects[project_id] = {}
+            for subject in self.fw.get_project_subjects(project_id):
+                self.subjects[project_id].setdefault(subject['code'], subject)
+        return self.subjects[project_id].get(code)
+
+    def add_subject(self, project_id, subject):
+        self.find_subject(project_id, subject['code'])
+        self.subjects[project_id][subject['code']] = subject
+
+    def find_session(self, project_id, subject_code, label):
+        if project_id not in self.sessions:
+            self.sessions[project_id] = {}
+            for session in self.fw.get_project_sessions(project_id):
+                key = (session['subject']['code'], session['label'])
+                self.sessions[project_id].setdefault(key, session)
+        return self.sessions[project_id].get((subject_code, label))
+
+    def add_session(self, project_id, session):
+        self.find_session(project_id, session['subject']['code'], session['label'])
+        self.sessions[project_id][(session['subject']['code'], session['label'])] = session
+        self.acquisitions.setdefault(session['id'], {})
+
+    def find_acquisition(self, session_id, label):
+        if session_id not in self.acquisitions:
+            self.acquisitions[session_id] = {}
+            for acquisition in self.fw.get_session_acquisitions(session_id):
+                self.acquisitions[session_id].setdefault(acquisition['label'], acquisition)
+        return self.acquisitions[session_id].get(label)
+
+    def add_acquisition(self, session_id, acquisition):
+        self.find_acquisition(session_id, acquisition['label'])
+        self.acquisitions[session_id][acquisition['label']] = acquisition
+
+def handle_project(fw, group_id, project_label, assume_yes, index=None):
     """ Returns a Flywheel project based on group_id and project_label
 
     If project exists, project will be retrieved,
      else project will be created
     """
-    # Get all projects
-    existing_projs = fw.get_all_projects()
+    if index is None:
+        index = ContainerIndex(fw)
     # Determine if project_label with group_id already exists
-    found = False
-    for ep in existing_projs:
-        if (ep['label'] == project_label) and (ep['group'] == group_id):
-            logger.info('Project (%s) was found. Adding data to existing project.' % project_label)
-            # project exists
-            project = ep
-            found = True
-            if check_enabled_rules(fw, project.to_dict()['id']):
-                logger.warning('Project has enabled rules, these may overwrite BIDS data. Either disable rules or run bids curation gear after data is uploaded.')
-                if not assume_yes and not utils.confirmation_prompt('Continue upload?'):
-                    return
-            break
+    project = index.find_project(group_id, project_label)
+    if project is not None:
+        logger.info('Project (%s) was found. Adding data to existing project.' % project_label)
+        if check_enabled_rules(fw, project.to_dict()['id']):
+            logger.warning('Project has enabled rules, these may overwrite BIDS data. Either disable rules or run bids curation gear after data is uploaded.')
+            if not assume_yes and not utils.confirmation_prompt('Continue upload?'):
+                return
     # If project does not exist, create project
-    if not found:
+    else:
         logger.info('Project (%s) not found. Creating new project for group %s.' % (project_label, group_id))
         project_id = fw.add_project({'label': project_label, 'group': group_id})
         project = fw.get_project(project_id)
         disable_project_rules(fw, project_id)
+        index.add_project(project)
 
     return project.to_dict()
 
 
-def handle_subject(fw, project_id, subject_code):
+def handle_subject(fw, project_id, subject_code, index=None):
     """Returns a Flywheel subject based on project_id and subject_code"""
-    # Get all subjects
-    existing_subjects = fw.get_project_subjects(project_id)
+    if index is None:
+        index = ContainerIndex(fw)
     # Determine if subject_name within project project_id already exists, with same subject_name...
-    found = False
-    for es in existing_subjects:
-        if (es['code'] == subject_code):
-            logger.info('Subject (%s) was found. Adding data to existing subject.' % subject_code)
-            # Session exists
-            subject = es
-            found = True
-            break
+    subject = index.find_subject(project_id, subject_code)
+    if subject is not None:
+        logger.info('Subject (%s) was found. Adding data to existing subject.' % subject_code)
     # If subject does not exist, create new subject
-    if not found:
+    else:
         logger.info('Subject (%s) not found. Creating new subject for %s.' % (subject_code, project_id))
 
         subject_id = fw.add_subject({
@@ -207,31 +271,27 @@ def handle_subject(fw, project_id, subject_code):
             'project': project_id
         })
         subject = fw.get_subject(subject_id)
+        index.add_subject(project_id, subject)
 
     return subject.to_dict()
 
 
 
-def handle_session(fw, project_id, session_name, subject_name):
+def handle_session(fw, project_id, session_name, subject_name, index=None):
     """ Returns a Flywheel session based on project_id and session_label
 
     If session exists, session will be retrieved,
      else session will be created
 
     """
-    # Get all sessions
-    existing_sessions = fw.get_project_sessions(project_id)
+    if index is None:
+        index = ContainerIndex(fw)
     # Determine if session_name within project project_id already exists, with same subject_name...
-    found = False
-    for es in existing_sessions:
-        if (es['label'] == session_name) and (es['subject']['code'] == subject_name):
-            logger.info('Session (%s) for subject (%s) was found. Adding data to existing session.' % (session_name, subject_name))
-            # Session exists
-            session = es
-            found = True
-            break
+    session = index.find_session(project_id, subject_name, session_name)
+    if session is not None:
+        logger.info('Session (%s) for subject (%s) was found. Adding data to existing session.' % (session_name, subject_name))
     # If session does not exist, create new session
-    if not found:
+    else:
         logger.info('Session (%s) not found. Creating new session for project %s.' % (session_name, project_id))
 
         session_id = fw.add_session({
@@ -241,65 +301,74 @@ def handle_session(fw, project_id, session_name, subject_name):
             'info': { template.namespace: {'Subject': subject_name[4:], 'Label': session_name[4:]} }
         })
         session = fw.get_session(session_id)
+        index.add_session(project_id, session)
 
     return session.to_dict()
 
-def handle_acquisition(fw, session_id, acquisition_label):
+def handle_acquisition(fw, session_id, acquisition_label, index=None):
     """ Returns a Flywheel acquisition based on session_id and acquisition_label
 
     If acquisition exists, acquisition will be retrieved,
      else acquisition will be created
     """
-    # Get all sessions
-    existing_acquisitions = fw.get_session_acquisitions(session_id)
+    if index is None:
+        index = ContainerIndex(fw)
     # Determine if acquisition_label within project project_id already exists
-    found = False
-    for ea in existing_acquisitions:
-        if ea['label'] == acquisition_label:
-            logger.info('Acquisition (%s) was found. Adding data to existing acquisition.' % acquisition_label)
-            # Acquisition exists
-            acquisition = ea
-            found = True
-            break
+    acquisition = index.find_acquisition(session_id, acquisition_label)
+    if acquisition is not None:
+        logger.info('Acquisition (%s) was found. Adding data to existing acquisition.' % acquisition_label)
     # If acquisition does not exist, create new session
-    if not found:
+    else:
         logger.info('Acquisition (%s) not found. Creating new acquisition for session %s.' % (acquisition_label, session_id))
         acquisition_id = fw.add_acquisition({'label': acquisition_label, 'session': session_id})
         acquisition = fw.get_acquisition(acquisition_id)
+        index.add_acquisition(session_id, acquisition)
 
     return acquisition.to_dict()
 
+def uploaded_file_entry(result, full_fname):
+    """
+    Returns the file object for full_fname from an sdk upload response
+
+    Returns None if the response does not include the uploaded file, in which
+    case the file object has to be retrieved from its container.
+    """
+    name = os.path.basename(full_fname)
+    if not isinstance(result, list):
+        return None
+    for entry in result:
+        if hasattr(entry, 'to_dict'):
+            entry = entry.to_dict()
+        if isinstance(entry, dict) and entry.get('name') == name:
+            return entry
+    return None
+
 def upload_project_file(fw, context, full_fname):
     """"""
     # Upload file
-    fw.upload_file_to_project(context['project']['id'], full_fname)
-    # Get project
-    proj = fw.get_project(context['project']['id']).to_dict()
+    result = fw.upload_file_to_project(context['project']['id'], full_fname)
     # Return project file object
-    return proj['files'][-1]
+    return uploaded_file_entry(result, full_fname)
 
 def upload_subject_file(fw, context, full_fname):
     """"""
     # Upload file
-    fw.upload_file_to_subject(context['subject']['id'], full_fname)
-    # Get project
-    subj = fw.get_subject(context['subject']['id']).to_dict()
-    # Return project file object
-    return subj['files'][-1]
+    result = fw.upload_file_to_subject(context['subject']['id'], full_fname)
+    # Return subject file object
+    return uploaded_file_entry(result, full_fname)
 
 def upload_session_file(fw, context, full_fname):
     """"""
     # Upload file
-    fw.upload_file_to_session(context['session']['id'], full_fname)
-    # Get session
-    ses = fw.get_session(context['session']['id']).to_dict()
+    result = fw.upload_file_to_session(context['session']['id'], full_fname)
     # Return session file object
-    return ses['files'][-1]
+    return uploaded_file_entry(result, full_fname)
 
 def upload_acquisition_file(fw, context, full_fname):
     """"""
     # Upload file
-    fw.upload_file_to_acquisition(context['acquisition']['id'], full_fname)
+    result = fw.upload_file_to_acquisition(context['acquisition']['id'], full_fname)
+    file_entry = uploaded_file_entry(result, full_fname)
 
     ### Classify acquisition
     # Get classification based on filename
@@ -313,11 +382,65 @@ def upload_acquisition_file(fw, context, full_fname):
         }
         fw.modify_acquisition_file_classification(context['acquisition']['id'],
               context['file']['name'], update)
+        if file_entry is not None:
+            file_entry['modality'] = update['modality']
+            file_entry['classification'] = classification
 
-    # Get acquisition
-    acq = fw.get_acquisition(context['acquisition']['id']).to_dict()
     # Return acquisition file object
-    return acq['files'][-1]
+    return file_entry
+
+def fetch_file_entries(fw, upload_tasks):
+    """
+    Fills in the file objects that were missing from the upload responses
+
+    Each container is retrieved once, no matter how many of its files are missing.
+    Returns the tasks whose file could not be found.
+    """
+    missing = collections.OrderedDict()
+    for task in upload_tasks:
+        if task['context']['file'] is None:
+            container_type = task['container_type']
+            key = (container_type, task['context'][container_type]['id'])
+            missing.setdefault(key, []).append(task)
+
+    failed = []
+    for (container_type, container_id), tasks in missing.items():
+        get_container = getattr(fw, GET_CONTAINER_FUNCTIONS[container_type])
+        container = get_container(container_id).to_dict()
+        files_by_name = dict((f['name'], f) for f in container.get('files', []))
+        for task in tasks:
+            file_entry = files_by_name.get(task['fname'])
+            if file_entry is None:
+                logger.error('Could not find uploaded file {0} on {1} {2}'.format(
+                    task['fname'], container_type, container_id))
+                failed.append(task)
+            else:
+                task['context']['file'] = file_entry
+    return failed
+
+# The upload function for each container type
+UPLOAD_FUNCTIONS = {
+    'project': upload_project_file,
+    'subject': upload_subject_file,
+    'session': upload_session_file,
+    'acquisition': upload_acquisition_file
+}
+
+# The sdk function to get each container type
+GET_CONTAINER_FUNCTIONS = {
+    'project': 'get_project',
+    'subject': 'get_subject',
+    'session': 'get_session',
+    'acquisition': 'get_acquisition'
+}
+
+# The sdk function to set file info for each container type
+SET_FILE_INFO_FUNCTIONS = {
+    'project': 'set_project_file_info',
+    'subject': 'set_subject_file_info',
+    'session': 'set_session_file_info',
+    'acquisition': 'set_acquisition_file_info'
+}
 
 def determine_acquisition_label(foldername, fname, hierarchy_type):
     """ """
@@ -421,7 +544,132 @@ def fill_in_properties(context, path, local_properties):
 
     return meta_info
 
-def handle_subject_folder(fw, context, files_of_interest, subject, rootdir, sub_rootdir, hierarchy_type, subject_code, local_properties):
+def file_upload_task(context, container_type, parent_container_type, fname, full_fname, full_path, remove_after=False):
+    """
+    Describes a single file upload and metadata write, to be run by upload_files
+
+    context: The context of the container that the file is uploaded to
+    container_type: The type of container the file is uploaded to
+    parent_container_type: The parent container type used for template matching
+    fname: The name of the file on Flywheel
+    full_fname: The path to the local file
+    full_path: The BIDS path of the folder containing the file
+    remove_after: Whether to remove the local file once uploaded (e.g. generated zipfiles)
+    """
+    context = context.copy()
+    context['container_type'] = 'file'
+    context['parent_container_type'] = parent_container_type
+    context['ext'] = utils.get_extension(fname)
+    context['file'] = {u'name': fname}
+    return {
+        'container_type': container_type,
+        'context': context,
+        'fname': fname,
+        'full_fname': full_fname,
+        'full_path': full_path,
+        'remove_after': remove_after
+    }
+
+def upload_file(fw, task):
+    """
+    Upload the file described by task
+
+    The file object is taken from the upload response, if available
+    """
+    container_type = task['container_type']
+    context = task['context']
+    try:
+        # Upload file
+        context['file'] = UPLOAD_FUNCTIONS[container_type](fw, context, task['full_fname'])
+    finally:
+        if task['remove_after']:
+            # remove the generated file
+            os.remove(task['full_fname'])
+
+def set_uploaded_file_info(fw, task, local_properties):
+    """
+    Match the uploaded file described by task to a template, and set its BIDS info
+    """
+    container_type = task['container_type']
+    context = task['context']
+    # Identify the templates for the file and return file object
+    with instrumentation.phase('matching'):
+        context['file'] = bidsify_flywheel.process_matching_templates(context, template, upload=True)
+    # Acquisition files are only updated if they matched a template
+    if container_type == 'acquisition' and not context['file'].get('info'):
+        return
+    # Update the meta info files w/ BIDS info from the filename...
+    meta_info = fill_in_properties(context, task['full_path'], local_properties)
+    # Upload the meta info onto the file
+    set_file_info = getattr(fw, SET_FILE_INFO_FUNCTIONS[container_type])
+    set_file_info(context[container_type]['id'], task['fname'], meta_info)
+
+def upload_files(fw, upload_tasks, local_properties, jobs=1):
+    """
+    Run the upload tasks, in parallel across containers
+
+    Tasks that share a container (and its subject or session, for
+    acquisitions) are grouped and run in order on the same worker.
+    Within a group, all files are uploaded before any meta info is set,
+    so that file objects missing from the upload responses can be
+    retrieved with a single request per container.
+    """
+    groups = collections.OrderedDict()
+    for task in upload_tasks:
+        context = task['context']
+        if task['container_type'] in ('session', 'acquisition'):
+            key = ('session', context['session']['id'])
+        else:
+            key = (task['container_type'], context[task['container_type']]['id'])
+        groups.setdefault(key, []).append(task)
+
+    def upload_group(tasks):
+        failed = []
+        uploaded = []
+        for task in tasks:
+            logger.info('Uploading file: {0}'.format(task['full_fname']))
+            try:
+                upload_file(fw, task)
+                uploaded.append(task)
+            except Exception as exc:
+                logger.error('Could not upload {0}: {1}'.format(task['full_fname'], exc))
+                failed.append(task)
+
+        missing = fetch_file_entries(fw, uploaded)
+        failed += missing
+        missing_ids = set(id(task) for task in missing)
+
+        for task in uploaded:
+            if id(task) in missing_ids:
+                continue
+            try:
+                set_uploaded_file_info(fw, task, local_properties)
+            except Exception as exc:
+                logger.error('Could not set info on {0}: {1}'.format(task['full_fname'], exc))
+                failed.append(task)
+        return failed
+
+    logger.info('Uploading {0} files from {1} containers'.format(len(upload_tasks), len(groups)))
+    results = parallel.run_jobs(upload_group, list(groups.values()), jobs=jobs)
+
+    failed = []
+    for job_result in results:
+        if job_result.ok:
+            failed += job_result.result
+        else:
+            failed += job_result.item
+    logger.info('Uploaded {0} of {1} files'.format(len(upload_tasks) - len(failed), len(upload_tasks)))
+    if failed:
+        raise BIDSImportError('Failed to upload {0} file(s)'.format(len(failed)))
+
+def handle_subject_folder(fw, context, files_of_interest, subject, rootdir, sub_rootdir, hierarchy_type, subject_code,
+                          index=None):
+    """
+    Creates the subject, session and acquisition containers for a subject folder
+
+    Returns the list of file upload tasks for the folder
+    """
+    upload_tasks = []
     #   In BIDS, the session is optional, if not present - use subject_code as session_label
     # Get all keys that are session - 'ses-<session.label>'
     if sub_rootdir:
@@ -432,7 +680,7 @@ def handle_subject_folder(fw, context, files_of_interest, subject, rootdir, sub_
         sessions = ['ses-']
         subject = {'ses-': subject}
 
-    context['subject'] = handle_subject(fw, context['project']['id'], subject_code)
+    context['subject'] = handle_subject(fw, context['project']['id'], subject_code, index=index)
 
     ## Iterate over subject files
     # NOTE: Attaching files to project instead of subject....
@@ -456,23 +704,14 @@ def handle_subject_folder(fw, context, files_of_interest, subject, rootdir, sub_
                 continue
 
             # Upload subject file
-            context['file'] = upload_subject_file(fw, context, full_fname)
-            # Update the context for this file
-            context['container_type'] = 'file'
-            context['parent_container_type'] = 'project' # TODO: once subjects are containers, change this to 'subject'
-            context['ext'] = utils.get_extension(fname)
-            # Identify the templates for the file and return file object
-            context['file'] = bidsify_flywheel.process_matching_templates(context, template, upload=True)
-            # Update the meta info files w/ BIDS info from the filename...
+            # TODO: once subjects are containers, change the parent container type to 'subject'
             full_path = os.path.join(sub_rootdir, subject_code)
-            meta_info = fill_in_properties(context, full_path, local_properties)
-            # Upload the meta info onto the subject file
-            fw.set_subject_file_info(context['subject']['id'], fname, meta_info)
+            upload_tasks.append(file_upload_task(context, 'subject', 'project', fname, full_fname, full_path))
 
     ### Iterate over sessions
     for session_label in sessions:
         # Create Session
-        context['session'] = handle_session(fw, context['project']['id'], session_label, subject_code)
+        context['session'] = handle_session(fw, context['project']['id'], session_label, subject_code, index=index)
         # Hand off subject info to context
         context['subject'] = context['session']['subject']
 
@@ -501,17 +740,7 @@ def handle_subject_folder(fw, context, files_of_interest, subject, rootdir, sub_
                         }
                 continue
             # Upload session file
-            context['file'] = upload_session_file(fw, context, full_fname)
-            # Update the context for this file
-            context['container_type'] = 'file'
-            context['parent_container_type'] = 'session'
-            context['ext'] = utils.get_extension(fname)
-            # Identify the templates for the file and return file object
-            context['file'] = bidsify_flywheel.process_matching_templates(context, template, upload=True)
-            # Update the meta info files w/ BIDS info from the filename...
-            meta_info = fill_in_properties(context, full_path, local_properties)
-            # Upload the meta info onto the project file
-            fw.set_session_file_info(context['session']['id'], fname, meta_info)
+            upload_tasks.append(file_upload_task(context, 'session', 'session', fname, full_fname, full_path))
 
             # Check if any session files are of interest (to be parsed later)
             #   interested in _scans.tsv and JSON files
@@ -537,7 +766,7 @@ def handle_subject_folder(fw, context, files_of_interest, subject, rootdir, sub_
                 # Determine acquisition label -- it can either be the folder name OR the basename of the file...
                 acq_label = determine_acquisition_label(foldername, fname, hierarchy_type)
                 # Create acquisition
-                context['acquisition'] = handle_acquisition(fw, context['session']['id'], acq_label)
+                context['acquisition'] = handle_acquisition(fw, context['session']['id'], acq_label, index=index)
                 ### Upload file
                 # define full filename
                 #   NOTE: If session_label equals 'ses-', session label is not
@@ -559,26 +788,14 @@ def handle_subject_folder(fw, context, files_of_interest, subject, rootdir, sub_
                             }
                     continue
 
-                # Place filename in context
-                context['file'] = {u'name': fname}
                 # Upload acquisition file
-                context['file'] = upload_acquisition_file(fw, context, full_fname)
-                # Update the context for this file
-                context['container_type'] = 'file'
-                context['parent_container_type'] = 'acquisition'
-                context['ext'] = utils.get_extension(fname)
-                # Identify the templates for the file and return file object
-                context['file'] = bidsify_flywheel.process_matching_templates(context, template, upload=True)
-                # Check that the file matched a template
-                if context['file'].get('info'):
-                    # Update the meta info files w/ BIDS info from the filename and foldername...
-                    meta_info = fill_in_properties(context, full_path, local_properties)
-                    # Upload the meta info onto the project file
-                    fw.set_acquisition_file_info(context['acquisition']['id'], fname, meta_info)
+                upload_tasks.append(file_upload_task(context, 'acquisition', 'acquisition', fname, full_fname, full_path))
+
+    return upload_tasks
 
 
 def upload_bids_dir(fw, bids_hierarchy, group_id, rootdir, hierarchy_type,
-                    local_properties, assume_yes):
+                    local_properties, assume_yes, jobs=1):
     """
 
     fw: Flywheel client
@@ -587,6 +804,11 @@ def upload_bids_dir(fw, bids_hierarchy, group_id, rootdir, hierarchy_type,
     hierarchy_type: either 'Flywheel' or 'BIDS'
             if 'Flywheel', the base filename is used as the acquisition label
             if 'BIDS', the BIDS foldername (anat,func,dwi etc...) is used as the acquisition label
+    jobs: The maximum number of containers to upload files to concurrently
+
+    The upload is staged: the hierarchy is walked and all containers are
+    created first, then the files are uploaded and their meta info is set
+    in parallel across containers.
 
     """
 
@@ -607,12 +829,18 @@ def upload_bids_dir(fw, bids_hierarchy, group_id, rootdir, hierarchy_type,
     files_of_interest = {
             }
 
+    # Collect files to be uploaded once all containers exist
+    upload_tasks = []
+
+    # Look up existing containers without listing their siblings for every file
+    index = ContainerIndex(fw)
+
     # Iterate over BIDS hierarchy (first key will be top level dirname which we will use as the project label)
     for proj_label in bids_hierarchy:
         ## Validate the project
         #   (1) create a project OR (2) find an existing project by the project_label -- return project object
         context['container_type'] = 'project'
-        context['project'] = handle_project(fw, group_id, proj_label, assume_yes)
+        context['project'] = handle_project(fw, group_id, proj_label, assume_yes, index=index)
         if context['project'] is None:
             continue
         context['project'] = bidsify_flywheel.process_matching_templates(context, template, upload=True)
@@ -635,18 +863,7 @@ def upload_bids_dir(fw, bids_hierarchy, group_id, rootdir, hierarchy_type,
                         }
                 continue
             # Upload project file
-            context['file'] = upload_project_file(fw, context, full_fname)
-            # Update the context for this file
-            context['container_type'] = 'file'
-            context['parent_container_type'] = 'project'
-            context['ext'] = utils.get_extension(fname)
-            # Identify the templates for the file and return file object
-            context['file'] = bidsify_flywheel.process_matching_templates(context, template, upload=True)
-            # Update the meta info files w/ BIDS info from the filename...
-            full_path = ''
-            meta_info = fill_in_properties(context, full_path, local_properties)
-            # Upload the meta info onto the project file
-            fw.set_project_file_info(context['project']['id'], fname, meta_info)
+            upload_tasks.append(file_upload_task(context, 'project', 'project', fname, full_fname, ''))
 
             # Check if project files are of interest (to be parsed later)
             #    Interested in participants.tsv or any JSON file
@@ -673,34 +890,26 @@ def upload_bids_dir(fw, bids_hierarchy, group_id, rootdir, hierarchy_type,
             full_dname = os.path.join(rootdir, dirr)
             full_zname = os.path.join(rootdir, dirr + '.zip')
             shutil.make_archive(full_dname, 'zip', full_dname)
-            # Upload project file
-            context['file'] = upload_project_file(fw, context, full_zname)
-            # remove the generated zipfile
-            os.remove(full_zname)
-            # Update the context for this file
-            context['container_type'] = 'file'
-            context['parent_container_type'] = 'project'
-            context['ext'] = utils.get_extension(full_zname)
-            # Identify the templates for the file and return file object
-            context['file'] = bidsify_flywheel.process_matching_templates(context, template, upload=True)
-            # Update the meta info files w/ BIDS info from the filename...
-            full_path = ''
-            meta_info = fill_in_properties(context, full_path, local_properties)
-            # Upload the meta info onto the project file
-            fw.set_project_file_info(context['project']['id'], dirr+'.zip', meta_info)
+            # Upload project file, the generated zipfile is removed once uploaded
+            upload_tasks.append(file_upload_task(context, 'project', 'project', dirr + '.zip', full_zname, '',
+                                                 remove_after=True))
 
         ### Iterate over subjects
         for subject_code in subjects:
             subject = bids_hierarchy[proj_label][subject_code]
-            handle_subject_folder(fw, context, files_of_interest, subject, rootdir,
-                                  '', hierarchy_type, subject_code, local_properties)
+            upload_tasks += handle_subject_folder(fw, context, files_of_interest, subject, rootdir,
+                                                  '', hierarchy_type, subject_code, index=index)
 
         # upload sourcedata (If option not set, the folder was popped in handle_project_label)
         for subject_code in sourcedata_folder:
             subject = bids_hierarchy[proj_label]['sourcedata'][subject_code]
-            handle_subject_folder(fw, context, files_of_interest, subject,
-                                  rootdir, 'sourcedata', hierarchy_type,
-                                  subject_code, local_properties)
+            upload_tasks += handle_subject_folder(fw, context, files_of_interest, subject,
+                                                  rootdir, 'sourcedata', hierarchy_type,
+                                                  subject_code, index=index)
+
+    ### Upload files and set meta info
+    with instrumentation.phase('upload'):
+        upload_files(fw, upload_tasks, local_properties, jobs=jobs)
 
     return files_of_interest
 
@@ -1014,7 +1223,7 @@ def parse_meta_files(fw, files_of_interest):
 
 def upload_bids(fw, bids_dir, group_id, project_label=None, hierarchy_type='Flywheel', validate=True,
                 include_source_data=False, local_properties=True, assume_yes=False, subject_label=None,
-                session_label=None):
+                session_label=None, jobs=1):
     ### Prep
     # Check directory name - ensure it exists
     validate_dirname(bids_dir)
@@ -1028,15 +1237,18 @@ def upload_bids(fw, bids_dir, group_id, project_label=None, hierarchy_type='Flyw
 
     # Determine if hierarchy is valid BIDS
     if validate:
-        utils.validate_bids(rootdir)
+        with instrumentation.phase('validation'):
+            utils.validate_bids(rootdir)
 
     ### Upload BIDS directory
     # upload bids dir (and get files of interest and project id)
-    files_of_interest = upload_bids_dir(fw, bids_hierarchy, group_id, rootdir, hierarchy_type, local_properties, assume_yes)
+    files_of_interest = upload_bids_dir(fw, bids_hierarchy, group_id, rootdir, hierarchy_type, local_properties, assume_yes,
+                                        jobs=jobs)
 
     # Parse the BIDS meta files
     #    data_description.json, participants.tsv, *_sessions.tsv, *_scans.tsv
-    parse_meta_files(fw, files_of_interest)
+    with instrumentation.phase('write_back'):
+        parse_meta_files(fw, files_of_interest)
 
 def main():
     ### Read in arguments
@@ -1059,19 +1271,24 @@ def main():
     parser.add_argument('--use-template-defaults', dest='local_properties', action='store_false',
             default=True, required=False, help='Prioiritize template default values for BIDS information')
     parser.add_argument('-y', '--yes', action='store_true', help='Assume the answer is yes to all prompts')
+    parser.add_argument('--jobs', dest='jobs', action='store', type=int, required=False, default=parallel.DEFAULT_JOBS,
+            help='Number of containers to upload files to concurrently (default: %(default)s)')
+    parser.add_argument('--report', dest='report', action='store', required=False, default=None,
+            help='Write a JSON report of phase timings and API calls to this file')
     args = parser.parse_args()
 
     if args.session and not args.subject:
         logger.error('Cannot only provide session without subject')
         sys.exit(1)
 
-    # Check API key - raises Error if key is invalid
-    fw = flywheel.Flywheel(args.api_key)
+    with instrumentation.recording(args.report):
+        # Check API key - raises Error if key is invalid
+        fw = instrumentation.instrument(flywheel.Flywheel(args.api_key))
 
-    upload_bids(fw, args.bids_dir, args.group_id, project_label=args.project_label,
-                hierarchy_type=args.hierarchy_type, include_source_data=args.source_data,
-                local_properties=args.local_properties, assume_yes=args.yes,
-                subject_label=args.subject, session_label=args.session)
+        upload_bids(fw, args.bids_dir, args.group_id, project_label=args.project_label,
+                    hierarchy_type=args.hierarchy_type, include_source_data=args.source_data,
+                    local_properties=args.local_properties, assume_yes=args.yes,
+                    subject_label=args.subject, session_label=args.session, jobs=args.jobs)
 
 if __name__ == '__main__':
     main()
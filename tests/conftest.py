@@ -0,0 +1,15 @@
+import shutil
+import tempfile
+
+import pytest
+
+from flywheel_bids.supporting_files import templates
+
+@pytest.fixture(scope='session', autouse=True)
+def template_cache_dir():
+    """ Cache compiled templates in a temporary directory, instead of the home directory """
+    cache_dir = tempfile.mkdtemp()
+    original, templates.TEMPLATE_CACHE_DIR = templates.TEMPLATE_CACHE_DIR, cache_dir
+    yield cache_dir
+    templates.TEMPLATE_CACHE_DIR = original
+    shutil.rmtree(cache_dir)
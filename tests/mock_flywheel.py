@@ -0,0 +1,54 @@
+import datetime
+
+try:
+    from unittest import mock
+except ImportError:
+    import mock
+
+class MockContainer(dict):
+    def to_dict(self):
+        return self
+
+def sanitize_for_serialization(obj):
+    """Convert timestamps to strings, like the sdk api client"""
+    if isinstance(obj, datetime.datetime):
+        return obj.isoformat()
+    if isinstance(obj, dict):
+        return dict((key, sanitize_for_serialization(value)) for key, value in obj.items())
+    if isinstance(obj, list):
+        return [sanitize_for_serialization(value) for value in obj]
+    return obj
+
+def mock_project_fw(session_count, acquisition_count):
+    """Mock a project with session_count sessions of acquisition_count acquisitions each"""
+    fw = mock.MagicMock()
+    fw.api_client.sanitize_for_serialization.side_effect = sanitize_for_serialization
+
+    project = MockContainer(_id='project', id='project', label='project', files=[{'name': 'README'}])
+    sessions = {}
+    acquisitions = {}
+    session_acqs = {}
+    created = datetime.datetime(2018, 1, 1)
+    for i in range(session_count):
+        session_id = 'ses{}'.format(i)
+        sessions[session_id] = MockContainer(_id=session_id, id=session_id, label=session_id,
+                                             subject={'code': 'sub{}'.format(i)}, files=[],
+                                             modified='2018-01-01T00:00:00Z')
+        session_acqs[session_id] = []
+        # Create acquisitions in reverse order, so that sorting is tested
+        for j in reversed(range(acquisition_count)):
+            acq_id = '{}_acq{}'.format(session_id, j)
+            acq = MockContainer(_id=acq_id, id=acq_id, label=acq_id,
+                                created=created + datetime.timedelta(minutes=j),
+                                modified='2018-01-01T00:00:00Z',
+                                files=[{'name': acq_id + '.nii.gz'}])
+            acquisitions[acq_id] = acq
+            session_acqs[session_id].append(acq)
+
+    fw.get_project.return_value = project
+    fw.get_project_sessions.return_value = [sessions[key] for key in sorted(sessions)]
+    fw.get_session.side_effect = sessions.get
+    fw.get_session_acquisitions.side_effect = session_acqs.get
+    fw.get_acquisition.side_effect = acquisitions.get
+    fw.acquisitions = acquisitions
+    return fw
@@ -0,0 +1,43 @@
+import unittest
+
+from flywheel_bids.benchmarks import curate, lookup, synthetic
+from flywheel_bids.supporting_files import utils
+
+
+class BenchmarkTestCases(unittest.TestCase):
+
+    def test_generate_project(self):
+        project = synthetic.generate_project(subjects=3, sessions=2, acquisitions=4, files=5, seed=1)
+        counts = synthetic.count_nodes(project)
+        self.assertEqual(counts, {'project': 1, 'session': 6, 'acquisition': 24, 'file': 121})
+
+        # The same seed always generates the same tree
+        again = synthetic.generate_project(subjects=3, sessions=2, acquisitions=4, files=5, seed=1)
+        self.assertEqual(again.to_json(), project.to_json())
+
+        # File names are unique within an acquisition
+        acquisitions = [acq for ses in project.children if ses.type == 'session' for acq in ses.children]
+        for acq in acquisitions:
+            names = [f['name'] for f in acq.children if f.type == 'file']
+            self.assertEqual(len(names), 5)
+            self.assertEqual(len(names), len(set(names)))
+        self.assertEqual(len(acquisitions), 24)
+
+    def test_run_benchmark(self):
+        results = curate.run_benchmark(subjects=2, sessions=1, acquisitions=8, files=2, repeat=1)
+        self.assertEqual(sorted(results['timings'].keys()), sorted(curate.TIMINGS))
+        self.assertEqual(sum(results['nodes'].values()), 1 + 2 + 16 + 33)
+        self.assertGreater(results['nodes_per_second'], 0)
+        self.assertIn('Throughput', curate.format_results(results))
+
+    def test_lookup_benchmark(self):
+        context = lookup.get_file_context()
+        for path in lookup.LOOKUP_PATHS:
+            self.assertEqual(lookup.split_lookup(context, path), utils.dict_lookup(context, path))
+        results = lookup.run_benchmark(number=10)
+        self.assertEqual(sorted(results.keys()), ['dict_lookup', 'split_lookup'])
+
+
+if __name__ == "__main__":
+
+    unittest.main()
@@ -0,0 +1,120 @@
+import json
+import os
+import shutil
+import stat
+import tempfile
+import unittest
+
+import dateutil.parser
+
+from flywheel_bids.supporting_files import blob_cache
+from flywheel_bids.supporting_files.blob_cache import BlobCache
+
+class BlobCacheTestCases(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmpdir)
+        self.cache_dir = os.path.join(self.tmpdir, 'cache')
+        self.downloaded = []
+
+    def _download(self, data):
+        def download(path):
+            self.downloaded.append(path)
+            with open(path, 'w') as f:
+                f.write(data)
+        return download
+
+    def _file(self, file_id, size=4):
+        return {'file_id': file_id, 'modified': dateutil.parser.parse('2018-03-28T20:40:59Z'), 'size': size}
+
+    def _read(self, path):
+        with open(path, 'r') as f:
+            return f.read()
+
+    def test_fetch(self):
+        for link_mode in blob_cache.LINK_MODES:
+            cache = BlobCache(os.path.join(self.cache_dir, link_mode), link_mode=link_mode)
+            first = os.path.join(self.tmpdir, link_mode + '1')
+            second = os.path.join(self.tmpdir, link_mode + '2')
+            self.assertFalse(cache.fetch(self._file('a'), first, self._download('data')))
+            self.assertTrue(cache.fetch(self._file('a'), second, self._download('other')))
+            self.assertEqual(self._read(first), 'data')
+            self.assertEqual(self._read(second), 'data')
+            self.assertEqual((cache.hits, cache.misses), (1, 1))
+
+            # Only hardlinks share the read-only blob
+            hardlinked = os.stat(first).st_ino == os.stat(second).st_ino
+            self.assertEqual(hardlinked, link_mode == 'hardlink')
+            self.assertEqual(bool(os.stat(second).st_mode & stat.S_IWUSR), link_mode != 'hardlink')
+        self.assertEqual(len(self.downloaded), len(blob_cache.LINK_MODES))
+
+    def test_fetch_uncacheable(self):
+        cache = BlobCache(self.cache_dir)
+        dest = os.path.join(self.tmpdir, 'file')
+        self.assertFalse(cache.fetch({'size': 4}, dest, self._download('data')))
+        self.assertEqual(self.downloaded, [dest])
+        self.assertEqual(cache.size, 0)
+
+    def test_fetch_wrong_size(self):
+        cache = BlobCache(self.cache_dir)
+        cache.fetch(self._file('a'), os.path.join(self.tmpdir, 'first'), self._download('data'))
+        # A blob that doesn't match the file is downloaded again
+        dest = os.path.join(self.tmpdir, 'second')
+        self.assertFalse(cache.fetch(self._file('a', size=5), dest, self._download('data5')))
+        self.assertEqual(self._read(dest), 'data5')
+        self.assertEqual(cache.size, 5)
+
+    def test_get_cache_key(self):
+        modified = dateutil.parser.parse('2018-03-28T20:40:59Z')
+        key = blob_cache.get_cache_key({'file_id': 'a', 'modified': modified, 'hash': 'h'})
+        self.assertEqual(key, blob_cache.get_cache_key({'file_id': 'a', 'modified': modified.isoformat()}))
+        self.assertNotEqual(key, blob_cache.get_cache_key({'file_id': 'b', 'modified': modified}))
+        self.assertEqual(blob_cache.get_cache_key({'file_id': None, 'modified': modified, 'hash': 'h'}), 'hash:h')
+        self.assertIsNone(blob_cache.get_cache_key({'modified': modified}))
+
+    def test_evict_lru(self):
+        cache = BlobCache(self.cache_dir, max_size=8)
+        dest = os.path.join(self.tmpdir, 'file')
+        cache.fetch(self._file('a'), dest, self._download('aaaa'))
+        cache.fetch(self._file('b'), dest, self._download('bbbb'))
+        # Using a makes b the least recently used
+        cache.blobs[cache.get_blob_name(blob_cache.get_cache_key(self._file('b')))][0] -= 10
+        self.assertTrue(cache.fetch(self._file('a'), dest, self._download('aaaa')))
+
+        cache.fetch(self._file('c'), dest, self._download('cccc'))
+        self.assertEqual(cache.size, 8)
+        self.assertTrue(cache.fetch(self._file('a'), dest, self._download('aaaa')))
+        self.assertTrue(cache.fetch(self._file('c'), dest, self._download('cccc')))
+        self.assertFalse(cache.fetch(self._file('b'), dest, self._download('bbbb')))
+        self.assertEqual(len(os.listdir(cache.blob_dir)), 2)
+
+    def test_save(self):
+        cache = BlobCache(self.cache_dir, max_size=8)
+        dest = os.path.join(self.tmpdir, 'file')
+        cache.fetch(self._file('a'), dest, self._download('aaaa'))
+        cache.fetch(self._file('b'), dest, self._download('bbbb'))
+        cache.blobs[cache.get_blob_name(blob_cache.get_cache_key(self._file('a')))][0] += 10
+        cache.close()
+
+        # Usage is kept across runs, with a smaller cap
+        with open(os.path.join(self.cache_dir, blob_cache.INDEX_FILENAME), 'r') as f:
+            self.assertEqual(len(json.load(f)), 2)
+        cache = BlobCache(self.cache_dir, max_size=4)
+        self.assertEqual(cache.size, 8)
+        self.assertEqual(cache.evict(), 1)
+        self.assertTrue(cache.fetch(self._file('a'), dest, self._download('aaaa')))
+        self.assertEqual(os.listdir(cache.tmp_dir), [])
+
+    def test_parse_size(self):
+        self.assertEqual(blob_cache.parse_size('100'), 100)
+        self.assertEqual(blob_cache.parse_size('1.5K'), 1536)
+        self.assertEqual(blob_cache.parse_size('10G'), 10 * 1024 ** 3)
+        self.assertEqual(blob_cache.parse_size('500MB'), 500 * 1024 ** 2)
+        with self.assertRaises(ValueError):
+            blob_cache.parse_size('lots')
+
+
+if __name__ == "__main__":
+
+    unittest.main()
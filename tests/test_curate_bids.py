@@ -1,13 +1,37 @@
 import os
+import pickle
 import shutil
 import unittest
 
 import flywheel
 
 from flywheel_bids import curate_bids
+from flywheel_bids.supporting_files.errors import BIDSCurationError
 from flywheel_bids.supporting_files import project_tree
 from flywheel_bids.supporting_files.templates import BIDS_TEMPLATE
 
+try:
+    from unittest import mock
+except ImportError:
+    import mock
+
+from mock_flywheel import mock_project_fw
+
+class InProcessPool(object):
+    """Stands in for multiprocessing.Pool, checking that the worker arguments can be pickled"""
+    def __init__(self, processes, initializer=None, initargs=()):
+        initializer(*pickle.loads(pickle.dumps(initargs)))
+
+    def imap_unordered(self, func, items):
+        return [func(pickle.loads(pickle.dumps(item))) for item in items]
+
+    def close(self):
+        pass
+
+    def join(self):
+        pass
+
+
 class BidsCurateTestCases(unittest.TestCase):
 
     def setUp(self):
@@ -249,6 +273,182 @@ class BidsCurateTestCases(unittest.TestCase):
         self.assertEqual(len(file1['info']['IntendedFor']), 1)
         self.assertEqual(file1['info']['IntendedFor'][0], 'ses-session1/func/sub-subj1_ses-session1_task-rest_run-1_bold.nii.gz')
 
+    def _project_tree(self):
+        project = project_tree.TreeNode('project', {'id': 'proj', 'label': 'testProj'})
+        for i in range(2):
+            session = project_tree.TreeNode('session', {
+                'id': 'ses{}'.format(i), 'label': 'session{}'.format(i), 'subject': {'code': 'subj1'}})
+            project.children.append(session)
+            for j in range(2):
+                acq = project_tree.TreeNode('acquisition', {
+                    'id': 'ses{}_acq{}'.format(i, j), 'label': 'acq{}_task-rest_run-{}'.format(j, j + 1)})
+                session.children.append(acq)
+                for ext in ['nii.gz', 'json']:
+                    acq.children.append(project_tree.TreeNode('file', {
+                        'name': 'task.{}'.format(ext),
+                        'type': 'nifti' if ext == 'nii.gz' else 'source code',
+                        'classification': {'Intent': 'Functional'}
+                    }))
+        return project
+
+    def test_curate_bids_tree_update(self):
+        project = self._project_tree()
+        fw = mock.MagicMock()
+        curate_bids.curate_bids_tree(fw, project, False, None, True, jobs=3)
+
+        self.assertEqual(fw.replace_session_info.call_count, 2)
+        self.assertEqual(fw.replace_acquisition_info.call_count, 4)
+        self.assertEqual(fw.set_acquisition_file_info.call_count, 8)
+        fw.set_acquisition_file_info.assert_any_call('ses1_acq0', 'task.nii.gz', mock.ANY)
+
+    def test_collect_updates(self):
+        project = self._project_tree()
+        curate_bids.curate_bids_tree(None, project, False, None, False)
+        # Duplicate the first file of the first acquisition
+        acq = project.children[0].children[0]
+        acq.children.append(project_tree.TreeNode('file', acq.children[0].data.copy()))
+        acq.children[-1]['info'] = {'BIDS': {'duplicate': True}}
+
+        updates = curate_bids.collect_updates(project)
+        self.assertEqual(list(updates.keys())[:3],
+            [('project', 'proj'), ('session', 'ses0'), ('acquisition', 'ses0_acq0')])
+        # The acquisition info and each file are updated once, keeping the last write
+        contexts = updates[('acquisition', 'ses0_acq0')]
+        self.assertEqual(list(contexts.keys()), [None, 'task.json', 'task.nii.gz'])
+        self.assertEqual(contexts['task.nii.gz']['file']['info'], {'BIDS': {'duplicate': True}})
+
+    @mock.patch('flywheel_bids.supporting_files.parallel.time.sleep')
+    def test_send_updates_failure(self, sleep):
+        project = self._project_tree()
+        curate_bids.curate_bids_tree(None, project, False, None, False)
+        fw = mock.MagicMock()
+        def set_file_info(acq_id, name, info):
+            if acq_id == 'ses0_acq1':
+                raise IOError('Connection reset')
+        fw.set_acquisition_file_info.side_effect = set_file_info
+
+        with self.assertRaises(BIDSCurationError):
+            curate_bids.send_updates(fw, curate_bids.collect_updates(project), jobs=2)
+        # The other containers are still updated
+        fw.set_acquisition_file_info.assert_any_call('ses1_acq1', 'task.nii.gz', mock.ANY)
+
+    def test_curate_contexts(self):
+        project = self._project_tree()
+        template = curate_bids.load_project_template(None, project)
+        batches = curate_bids.curate_contexts(project, template)
+
+        # The first session is matched and resolved before the next one is visited
+        contexts = next(batches)
+        self.assertEqual([ctx['container_type'] for ctx in contexts],
+                         ['session', 'acquisition', 'file', 'file', 'acquisition', 'file', 'file'])
+        self.assertEqual(contexts[0]['session']['id'], 'ses0')
+        self.assertIn('BIDS', contexts[2]['file']['info'])
+        self.assertNotIn('info', project.children[1].data)
+
+        contexts = next(batches)
+        self.assertEqual(contexts[0]['session']['id'], 'ses1')
+
+        # Contexts outside of sessions are deferred until the end
+        contexts = next(batches)
+        self.assertEqual([ctx['container_type'] for ctx in contexts], ['project'])
+        self.assertEqual(list(batches), [])
+
+    @mock.patch('flywheel_bids.supporting_files.parallel.time.sleep')
+    def test_curate_bids_tree_update_failure(self, sleep):
+        project = self._project_tree()
+        fw = mock.MagicMock()
+        def replace_session_info(session_id, info):
+            if session_id == 'ses0':
+                raise IOError('Connection reset')
+        fw.replace_session_info.side_effect = replace_session_info
+
+        with self.assertRaises(BIDSCurationError):
+            curate_bids.curate_bids_tree(fw, project, False, None, True, jobs=2)
+        # The following sessions and the project are still updated
+        self.assertEqual(fw.replace_acquisition_info.call_count, 4)
+        fw.replace_session_info.assert_any_call('ses1', mock.ANY)
+        fw.replace_project_info.assert_called_once_with('proj', mock.ANY)
+
+    def test_curate_bids_tree_incremental(self):
+        project = self._project_tree()
+        fw = mock.MagicMock()
+        curate_bids.curate_bids_tree(fw, project, update=True, incremental=True)
+        self.assertEqual(fw.set_acquisition_file_info.call_count, 8)
+        info = project.children[0].children[0].children[0]['info']['BIDS']
+        self.assertIn('fingerprint', info)
+
+        # Nothing changed since the last run, so nothing is matched or sent
+        project = project_tree.TreeNode.from_json(project.to_json())
+        fw = mock.MagicMock()
+        with mock.patch('flywheel_bids.supporting_files.bidsify_flywheel.process_matching_templates') as process:
+            curate_bids.curate_bids_tree(fw, project, update=True, incremental=True)
+        process.assert_not_called()
+        fw.set_acquisition_file_info.assert_not_called()
+        fw.replace_session_info.assert_not_called()
+
+        # Only the changed file is matched again, and only its session is resolved
+        project = project_tree.TreeNode.from_json(project.to_json())
+        project.children[1].children[0].children[0]['classification'] = {'Intent': 'Structural'}
+        fw = mock.MagicMock()
+        with mock.patch('flywheel_bids.curate_bids.resolve_contexts') as resolve:
+            curate_bids.curate_bids_tree(fw, project, update=True, incremental=True)
+        sessions = [contexts[0]['session']['id'] for (contexts, template), kwargs in resolve.call_args_list
+                    if contexts and 'session' in contexts[0]]
+        self.assertEqual(sessions, ['ses1'])
+        fw.set_acquisition_file_info.assert_called_once_with('ses1_acq0', 'task.nii.gz', mock.ANY)
+
+    def test_curate_lazy_tree(self):
+        fw = mock_project_fw(3, 2)
+        project = project_tree.get_project_tree(fw, 'project', lazy=True)
+        loaded = []
+        def get_session(session_id):
+            # Only one session is loaded at a time
+            loaded.append([child['label'] for child in project.children if getattr(child, 'loaded', False)])
+            return session_data[session_id]
+        session_data = dict((ses['id'], ses) for ses in fw.get_project_sessions('project'))
+        fw.get_session.side_effect = get_session
+
+        curate_bids.curate_bids_tree(fw, project)
+        self.assertEqual(loaded, [[], [], []])
+        self.assertEqual(fw.replace_session_info.call_count, 3)
+        self.assertEqual(fw.replace_acquisition_info.call_count, 6)
+        for child in project.children[1:]:
+            self.assertFalse(child.loaded)
+            self.assertEqual(child.children, [])
+
+    @mock.patch('flywheel_bids.curate_bids.multiprocessing.Pool', InProcessPool)
+    @mock.patch('flywheel_bids.curate_bids.flywheel.Flywheel')
+    def test_curate_bids_dir_workers(self, Flywheel):
+        fw = mock_project_fw(3, 2)
+        Flywheel.return_value = fw
+
+        curate_bids.curate_bids_dir(fw, 'project', workers=2, api_key='key')
+        Flywheel.assert_called_with('key')
+        self.assertEqual(fw.replace_session_info.call_count, 3)
+        self.assertEqual(fw.replace_acquisition_info.call_count, 6)
+        fw.replace_project_info.assert_called_once_with('project', mock.ANY)
+
+        with self.assertRaises(BIDSCurationError):
+            curate_bids.curate_bids_dir(fw, 'project', workers=2, api_key='key', cache_dir='cache')
+
+    @mock.patch('flywheel_bids.supporting_files.parallel.time.sleep')
+    @mock.patch('flywheel_bids.curate_bids.multiprocessing.Pool', InProcessPool)
+    @mock.patch('flywheel_bids.curate_bids.flywheel.Flywheel')
+    def test_curate_bids_dir_workers_failure(self, Flywheel, sleep):
+        fw = mock_project_fw(3, 2)
+        Flywheel.return_value = fw
+        def get_acquisition(acq_id):
+            if acq_id.startswith('ses1'):
+                raise IOError('Connection reset')
+            return fw.acquisitions[acq_id]
+        fw.get_acquisition.side_effect = get_acquisition
+
+        with self.assertRaises(BIDSCurationError):
+            curate_bids.curate_bids_dir(fw, 'project', workers=2, api_key='key')
+        # The other sessions and the project are still curated
+        self.assertEqual(fw.replace_session_info.call_count, 2)
+        fw.replace_project_info.assert_called_once_with('project', mock.ANY)
+
 
 if __name__ == "__main__":
 
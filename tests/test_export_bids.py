@@ -3,14 +3,23 @@ import datetime
 import json
 import os
 import shutil
+import tarfile
+import tempfile
 import unittest
+import zipfile
 import dateutil.parser
 
 import flywheel
 
 from flywheel_bids import export_bids
+from flywheel_bids.supporting_files.blob_cache import BlobCache
 from flywheel_bids.supporting_files.errors import BIDSExportError
 
+try:
+    from unittest import mock
+except ImportError:
+    import mock
+
 class BidsExportTestCases(unittest.TestCase):
 
     def setUp(self):
@@ -262,6 +271,385 @@ class BidsExportTestCases(unittest.TestCase):
         cid = '123456789009876543211224'
         self.assertTrue(export_bids.determine_container(None, None, ctype, cid) == (ctype, cid))
 
+    def _filepath_downloads(self, count):
+        modified = dateutil.parser.parse("2018-03-28T20:40:59.54Z")
+        filepath_downloads = {'project': {}, 'session': {}, 'acquisition': {}, 'sidecars': {}}
+        os.mkdir(self.testdir)
+        for i in range(count):
+            path = os.path.join(self.testdir, 'file{}.nii.gz'.format(i))
+            filepath_downloads['acquisition'][path] = {
+                'args': ('acq{}'.format(i), 'file{}.nii.gz'.format(i), path),
+                'modified': modified
+            }
+        return filepath_downloads, modified
+
+    def test_download_bids_files_concurrent(self):
+        filepath_downloads, modified = self._filepath_downloads(10)
+
+        def download(acq_id, name, dest):
+            open(dest, 'w').close()
+
+        fw = mock.MagicMock()
+        fw.download_file_from_acquisition.side_effect = download
+        export_bids.download_bids_files(fw, filepath_downloads, False, jobs=4)
+
+        self.assertEqual(fw.download_file_from_acquisition.call_count, 10)
+        for path in filepath_downloads['acquisition']:
+            self.assertEqual(int(os.path.getmtime(path)), export_bids.timestamp_to_int(modified))
+
+    @mock.patch('flywheel_bids.supporting_files.parallel.time.sleep')
+    def test_download_bids_files_retry(self, sleep):
+        filepath_downloads, modified = self._filepath_downloads(1)
+        attempts = []
+
+        def download(acq_id, name, dest):
+            attempts.append(name)
+            if len(attempts) < 2:
+                raise IOError('Connection reset')
+            open(dest, 'w').close()
+
+        fw = mock.MagicMock()
+        fw.download_file_from_acquisition.side_effect = download
+        export_bids.download_bids_files(fw, filepath_downloads, False, jobs=2)
+        self.assertEqual(len(attempts), 2)
+
+    @mock.patch('flywheel_bids.supporting_files.parallel.time.sleep')
+    def test_download_bids_files_failures(self, sleep):
+        filepath_downloads, modified = self._filepath_downloads(3)
+
+        def download(acq_id, name, dest):
+            if name == 'file1.nii.gz':
+                raise IOError('Not found')
+            open(dest, 'w').close()
+
+        fw = mock.MagicMock()
+        fw.download_file_from_acquisition.side_effect = download
+        with self.assertRaises(BIDSExportError):
+            export_bids.download_bids_files(fw, filepath_downloads, False, jobs=2, retries=1)
+        # The other downloads still completed
+        self.assertTrue(os.path.exists(os.path.join(self.testdir, 'file0.nii.gz')))
+        self.assertTrue(os.path.exists(os.path.join(self.testdir, 'file2.nii.gz')))
+
+    def _sync_downloads(self, files):
+        """ Build filepath_downloads for files, a map of BIDS path to (file name, hash, modified day) """
+        filepath_downloads = {'project': {}, 'session': {}, 'acquisition': {}, 'sidecars': {}}
+        for path, (name, file_hash, day) in files.items():
+            fpath = os.path.join(self.testdir, path)
+            f = {'name': name, 'hash': file_hash, 'size': len(file_hash),
+                 'modified': dateutil.parser.parse('2018-03-{0:02d}T20:40:59Z'.format(day))}
+            filepath_downloads['acquisition'][fpath] = export_bids.get_file_download('acq', f, fpath)
+            filepath_downloads['sidecars'][fpath] = {'args': ({'EchoTime': 0.03}, fpath, 'BIDS')}
+        return filepath_downloads
+
+    def _sync(self, files, container=('project', 'project')):
+        hashes = dict((name, file_hash) for name, file_hash, day in files.values())
+        def download(acq_id, name, dest):
+            if not os.path.isdir(os.path.dirname(dest)):
+                os.makedirs(os.path.dirname(dest))
+            with open(dest, 'w') as f:
+                f.write(hashes[name])
+
+        fw = mock.MagicMock()
+        fw.download_file_from_acquisition.side_effect = download
+        export_bids.sync_bids_files(fw, self.testdir, self._sync_downloads(files), False, container)
+        return sorted(call[0][1] for call in fw.download_file_from_acquisition.call_args_list)
+
+    def _read(self, path):
+        with open(os.path.join(self.testdir, path), 'r') as f:
+            return f.read()
+
+    def test_sync_bids_files(self):
+        os.mkdir(self.testdir)
+        files = {
+            'sub-01/anat/sub-01_T1w.nii.gz': ('t1.nii.gz', 'aaaa', 1),
+            'sub-01/func/sub-01_task-rest_bold.nii.gz': ('bold.nii.gz', 'bbbbbb', 1),
+            'sub-02/anat/sub-02_T1w.nii.gz': ('t1_2.nii.gz', 'cccccccc', 1)
+        }
+        self.assertEqual(self._sync(files), ['bold.nii.gz', 't1.nii.gz', 't1_2.nii.gz'])
+        self.assertTrue(os.path.isfile(os.path.join(self.testdir, 'sub-01/anat/sub-01_T1w.json')))
+        with open(os.path.join(self.testdir, export_bids.MANIFEST_FILENAME), 'r') as f:
+            manifest = json.load(f)
+        self.assertEqual(sorted(manifest['files']), sorted(files))
+        self.assertEqual(manifest['files']['sub-01/anat/sub-01_T1w.nii.gz']['sidecar'], 'sub-01/anat/sub-01_T1w.json')
+
+        # Nothing changed
+        self.assertEqual(self._sync(files), [])
+
+        # A renamed file is moved, a changed file is downloaded, a removed file and its sidecar are deleted
+        files = {
+            'sub-01/anat/sub-01_run-1_T1w.nii.gz': ('t1.nii.gz', 'aaaa', 2),
+            'sub-01/func/sub-01_task-rest_bold.nii.gz': ('bold.nii.gz', 'dddddd', 2),
+            'sub-03/anat/sub-03_T1w.nii.gz': ('t1_3.nii.gz', 'eeeeeeeeee', 2)
+        }
+        self.assertEqual(self._sync(files), ['bold.nii.gz', 't1_3.nii.gz'])
+        self.assertEqual(self._read('sub-01/anat/sub-01_run-1_T1w.nii.gz'), 'aaaa')
+        self.assertEqual(self._read('sub-01/func/sub-01_task-rest_bold.nii.gz'), 'dddddd')
+        self.assertFalse(os.path.exists(os.path.join(self.testdir, 'sub-01/anat/sub-01_T1w.nii.gz')))
+        self.assertFalse(os.path.exists(os.path.join(self.testdir, 'sub-01/anat/sub-01_T1w.json')))
+        self.assertFalse(os.path.exists(os.path.join(self.testdir, 'sub-02')))
+        self.assertEqual(int(os.path.getmtime(os.path.join(self.testdir, 'sub-01/anat/sub-01_run-1_T1w.nii.gz'))),
+                         export_bids.timestamp_to_int(dateutil.parser.parse('2018-03-02T20:40:59Z')))
+
+        # Files that swap paths are moved without overwriting each other
+        files = {
+            'sub-01/anat/sub-01_run-1_T1w.nii.gz': ('bold.nii.gz', 'dddddd', 3),
+            'sub-01/func/sub-01_task-rest_bold.nii.gz': ('t1.nii.gz', 'aaaa', 3),
+            'sub-03/anat/sub-03_T1w.nii.gz': ('t1_3.nii.gz', 'eeeeeeeeee', 2)
+        }
+        self.assertEqual(self._sync(files), [])
+        self.assertEqual(self._read('sub-01/anat/sub-01_run-1_T1w.nii.gz'), 'dddddd')
+        self.assertEqual(self._read('sub-01/func/sub-01_task-rest_bold.nii.gz'), 'aaaa')
+
+    def _sync_project_zip(self, members, day):
+        """ Sync a project zip with members, a map of member name to content, returning the number of downloads """
+        fpath = os.path.join(self.testdir, 'code.zip')
+        filepath_downloads = {'project': {}, 'session': {}, 'acquisition': {}, 'sidecars': {}}
+        if members is not None:
+            f = {'name': 'code.zip', 'hash': 'hash{0}'.format(day), 'file_id': 'code{0}'.format(day),
+                 'modified': dateutil.parser.parse('2018-03-{0:02d}T20:40:59Z'.format(day))}
+            filepath_downloads['project'][fpath] = export_bids.get_file_download('project', f, fpath)
+
+        def download(project_id, name, dest):
+            with zipfile.ZipFile(dest, 'w') as z:
+                for member, content in members.items():
+                    z.writestr(member, content)
+
+        fw = mock.MagicMock()
+        fw.download_file_from_project.side_effect = download
+        export_bids.sync_bids_files(fw, self.testdir, filepath_downloads, False, ('project', 'project'))
+        return fw.download_file_from_project.call_count
+
+    def test_sync_project_zip(self):
+        os.mkdir(self.testdir)
+        self.assertEqual(self._sync_project_zip({'a.txt': 'a', 'sub/b.txt': 'b'}, 1), 1)
+        self.assertFalse(os.path.exists(os.path.join(self.testdir, 'code.zip')))
+        self.assertEqual(self._read('code/sub/b.txt'), 'b')
+        with open(os.path.join(self.testdir, export_bids.MANIFEST_FILENAME), 'r') as f:
+            manifest = json.load(f)
+        self.assertEqual(manifest['files']['code.zip']['members'], ['code/a.txt', 'code/sub/b.txt'])
+
+        # An unchanged zip is not downloaded again
+        self.assertEqual(self._sync_project_zip({'a.txt': 'a', 'sub/b.txt': 'b'}, 1), 0)
+        self.assertEqual(self._sync_project_zip({'a.txt': 'a', 'sub/b.txt': 'b'}, 1), 0)
+
+        # Unless its files were removed
+        os.remove(os.path.join(self.testdir, 'code/a.txt'))
+        self.assertEqual(self._sync_project_zip({'a.txt': 'a', 'sub/b.txt': 'b'}, 1), 1)
+        self.assertEqual(self._read('code/a.txt'), 'a')
+
+        # A changed zip replaces the files extracted from the previous version
+        self.assertEqual(self._sync_project_zip({'a.txt': 'changed'}, 2), 1)
+        self.assertEqual(self._read('code/a.txt'), 'changed')
+        self.assertFalse(os.path.exists(os.path.join(self.testdir, 'code/sub')))
+
+        # A removed zip has its files deleted
+        self.assertEqual(self._sync_project_zip(None, 3), 0)
+        self.assertFalse(os.path.exists(os.path.join(self.testdir, 'code')))
+
+    def test_sync_bids_files_existing_export(self):
+        os.mkdir(self.testdir)
+        files = {'sub-01/anat/sub-01_T1w.nii.gz': ('t1.nii.gz', 'aaaa', 1)}
+        self.assertEqual(self._sync(files), ['t1.nii.gz'])
+
+        # Without a usable manifest, files that look like a download of the same version are kept
+        os.remove(os.path.join(self.testdir, export_bids.MANIFEST_FILENAME))
+        self.assertEqual(self._sync(files), [])
+        # A manifest of another container is not used, and its files are not deleted
+        self.assertEqual(self._sync({}, container=('session', 'ses')), [])
+        self.assertTrue(os.path.isfile(os.path.join(self.testdir, 'sub-01/anat/sub-01_T1w.nii.gz')))
+
+    def test_export_sync_filtered(self):
+        os.mkdir(self.testdir)
+        with self.assertRaises(BIDSExportError):
+            export_bids.export_bids(None, self.testdir, None, subjects=['01'], sync=True)
+
+    def _export_fw(self, count):
+        """ Mock a project with a single acquisition of count curated files """
+        modified = dateutil.parser.parse('2018-03-28T20:40:59Z')
+        files = []
+        for i in range(count):
+            files.append({'name': 'file{}.nii.gz'.format(i), 'modified': modified, 'size': 4, 'hash': 'hash{}'.format(i),
+                          'info': {'EchoTime': 0.03, 'BIDS': {
+                              'Filename': 'sub-01_run-{}_T1w.nii.gz'.format(i), 'Path': 'sub-01/anat', 'Folder': 'anat'}}})
+        fw = mock.MagicMock()
+        fw.get_project.return_value = {'_id': 'project', 'label': 'project', 'files': [],
+                                       'info': {'BIDS': {'Name': 'project', 'BIDSVersion': '1.0.2'}}}
+        fw.get_project_sessions.return_value = [{'_id': 'ses', 'label': 'ses', 'subject': {'code': '01'}, 'info': {}}]
+        fw.get_session.return_value = {'_id': 'ses', 'files': []}
+        fw.get_session_acquisitions.return_value = [{'_id': 'acq', 'info': {}}]
+        fw.get_acquisition.return_value = {'_id': 'acq', 'files': files}
+        return fw
+
+    @mock.patch('flywheel_bids.supporting_files.parallel.time.sleep')
+    def test_download_bids_dir_resume(self, sleep):
+        os.mkdir(self.testdir)
+        journal_path = os.path.join(self.testdir, export_bids.JOURNAL_FILENAME)
+
+        def download(acq_id, name, dest):
+            with open(dest, 'w') as f:
+                f.write('data')
+            if name == 'file1.nii.gz':
+                raise IOError('Connection reset')
+
+        fw = self._export_fw(3)
+        fw.download_file_from_acquisition.side_effect = download
+        with self.assertRaises(BIDSExportError):
+            export_bids.download_bids_dir(fw, 'project', 'project', self.testdir, jobs=2)
+
+        # The failed download left no partial file, and the journal is kept
+        anat = os.path.join(self.testdir, 'sub-01', 'anat')
+        self.assertEqual(sorted(os.listdir(anat)), ['sub-01_run-0_T1w.json', 'sub-01_run-0_T1w.nii.gz',
+                                                    'sub-01_run-1_T1w.json',
+                                                    'sub-01_run-2_T1w.json', 'sub-01_run-2_T1w.nii.gz'])
+        self.assertTrue(os.path.isfile(journal_path))
+        # Simulate being killed while writing to the journal
+        with open(journal_path, 'a') as f:
+            f.write('{"event": "compl')
+
+        # Resuming doesn't walk the project again, and only downloads what is missing
+        resumed = mock.MagicMock()
+        resumed.download_file_from_acquisition.side_effect = lambda acq_id, name, dest: open(dest, 'w').close()
+        export_bids.download_bids_dir(resumed, 'project', 'project', self.testdir, resume=True)
+        resumed.get_project.assert_not_called()
+        resumed.get_acquisition.assert_not_called()
+        resumed.download_file_from_acquisition.assert_called_once_with(
+            'acq', 'file1.nii.gz', os.path.join(anat, '.sub-01_run-1_T1w.nii.gz.part'))
+        self.assertTrue(os.path.isfile(os.path.join(anat, 'sub-01_run-1_T1w.nii.gz')))
+        self.assertTrue(os.path.isfile(os.path.join(anat, 'sub-01_run-1_T1w.json')))
+        self.assertFalse(os.path.exists(journal_path))
+
+    def test_download_bids_files_resume_project_zip(self):
+        os.mkdir(self.testdir)
+        fpath = os.path.join(self.testdir, 'code.zip')
+        f = {'name': 'code.zip', 'hash': 'hash', 'file_id': 'code',
+             'modified': dateutil.parser.parse('2018-03-28T20:40:59Z')}
+        filepath_downloads = {'project': {fpath: export_bids.get_file_download('project', f, fpath)},
+                              'session': {}, 'acquisition': {}, 'sidecars': {}}
+        journal = export_bids.ExportJournal(self.testdir)
+        journal.start(('project', 'project'), False, filepath_downloads)
+
+        def download(project_id, name, dest):
+            with zipfile.ZipFile(dest, 'w') as z:
+                z.writestr('a.txt', 'a')
+        fw = mock.MagicMock()
+        fw.download_file_from_project.side_effect = download
+
+        # An interrupted extraction is not recorded as completed
+        with mock.patch('flywheel_bids.export_bids.extract_project_zip', side_effect=IOError('No space left')):
+            with self.assertRaises(BIDSExportError):
+                export_bids.download_bids_files(fw, filepath_downloads, False, journal=journal)
+        self.assertFalse(journal.is_completed(fpath))
+
+        export_bids.download_bids_files(fw, filepath_downloads, False, journal=journal)
+        self.assertEqual(self._read('code/a.txt'), 'a')
+        self.assertFalse(os.path.exists(fpath))
+
+        # The extracted zip is not downloaded again on resume
+        resumed = export_bids.ExportJournal(self.testdir)
+        filepath_downloads = resumed.resume(('project', 'project'), False)
+        self.assertTrue(resumed.is_completed(fpath))
+        export_bids.download_bids_files(fw, filepath_downloads, False, journal=resumed)
+        self.assertEqual(fw.download_file_from_project.call_count, 2)
+
+    def test_download_bids_dir_resume_other_export(self):
+        os.mkdir(self.testdir)
+        journal = export_bids.ExportJournal(self.testdir)
+        journal.start(('session', 'ses'), False, {'project': {}, 'session': {}, 'acquisition': {}, 'sidecars': {}})
+
+        # A journal of another export is replaced by a new plan
+        fw = self._export_fw(1)
+        fw.download_file_from_acquisition.side_effect = lambda acq_id, name, dest: open(dest, 'w').close()
+        export_bids.download_bids_dir(fw, 'project', 'project', self.testdir, resume=True)
+        fw.get_acquisition.assert_called_once_with('acq')
+        self.assertEqual(fw.download_file_from_acquisition.call_count, 1)
+        self.assertFalse(os.path.exists(os.path.join(self.testdir, export_bids.JOURNAL_FILENAME)))
+
+    def test_download_bids_dir_blob_cache(self):
+        os.mkdir(self.testdir)
+        cache = BlobCache(os.path.join(self.testdir, 'cache'))
+        fw = self._export_fw(2)
+        fw.download_file_from_acquisition.side_effect = lambda acq_id, name, dest: open(dest, 'w').write('data')
+        first = os.path.join(self.testdir, 'first')
+        os.mkdir(first)
+        export_bids.download_bids_dir(fw, 'project', 'project', first, blob_cache=cache)
+        self.assertEqual(fw.download_file_from_acquisition.call_count, 2)
+
+        # Another export of the same files is filled from the cache
+        fw = self._export_fw(2)
+        second = os.path.join(self.testdir, 'second')
+        os.mkdir(second)
+        export_bids.download_bids_dir(fw, 'project', 'project', second, subjects=['01'], blob_cache=cache)
+        fw.download_file_from_acquisition.assert_not_called()
+        path = os.path.join(second, 'sub-01', 'anat', 'sub-01_run-1_T1w.nii.gz')
+        with open(path, 'r') as f:
+            self.assertEqual(f.read(), 'data')
+        self.assertEqual(int(os.path.getmtime(path)), export_bids.timestamp_to_int(
+            dateutil.parser.parse('2018-03-28T20:40:59Z')))
+        self.assertEqual((cache.hits, cache.misses), (2, 2))
+
+    def _export_archive(self, name):
+        os.mkdir(self.testdir)
+        archive = os.path.join(self.testdir, name)
+        fw = self._export_fw(2)
+        fw.download_file_from_acquisition.side_effect = lambda acq_id, name, dest: open(dest, 'w').write('data')
+        scratch = tempfile.mkdtemp()
+        with mock.patch('flywheel_bids.export_bids.tempfile.mkdtemp', return_value=scratch):
+            export_bids.export_bids(fw, None, None, container_type='project', container_id='project', archive=archive)
+        # Nothing is left in the scratch directory
+        self.assertFalse(os.path.exists(scratch))
+        self.assertEqual(os.listdir(self.testdir), [name])
+        return archive
+
+    def test_export_tar_archive(self):
+        archive = self._export_archive('export.tar.gz')
+        with tarfile.open(archive, 'r:gz') as tar:
+            names = tar.getnames()
+            data = tar.extractfile('sub-01/anat/sub-01_run-0_T1w.nii.gz').read()
+            sidecar = json.loads(tar.extractfile('sub-01/anat/sub-01_run-0_T1w.json').read().decode('utf-8'))
+        self.assertEqual(sorted(names), ['dataset_description.json',
+                                         'sub-01/anat/sub-01_run-0_T1w.json', 'sub-01/anat/sub-01_run-0_T1w.nii.gz',
+                                         'sub-01/anat/sub-01_run-1_T1w.json', 'sub-01/anat/sub-01_run-1_T1w.nii.gz'])
+        self.assertEqual(data, b'data')
+        self.assertEqual(sidecar, {'EchoTime': 0.03})
+
+    def test_export_zip_archive(self):
+        archive = self._export_archive('export.zip')
+        with zipfile.ZipFile(archive) as z:
+            infos = dict((info.filename, info) for info in z.infolist())
+            self.assertEqual(z.read('sub-01/anat/sub-01_run-1_T1w.nii.gz'), b'data')
+        self.assertIn('dataset_description.json', infos)
+        # Compressed files are stored as is
+        self.assertEqual(infos['sub-01/anat/sub-01_run-1_T1w.nii.gz'].compress_type, zipfile.ZIP_STORED)
+        self.assertEqual(infos['sub-01/anat/sub-01_run-1_T1w.json'].compress_type, zipfile.ZIP_DEFLATED)
+
+    @mock.patch('flywheel_bids.supporting_files.parallel.time.sleep')
+    def test_export_archive_failure(self, sleep):
+        os.mkdir(self.testdir)
+        def download(acq_id, name, dest):
+            if name == 'file1.nii.gz':
+                raise IOError('Connection reset')
+            with open(dest, 'w') as f:
+                f.write('data')
+
+        for name in ('export.tar.gz', 'export.zip'):
+            fw = self._export_fw(3)
+            fw.download_file_from_acquisition.side_effect = download
+            archive = os.path.join(self.testdir, name)
+            with self.assertRaises(BIDSExportError):
+                export_bids.export_bids(fw, None, None, container_type='project', container_id='project',
+                                        archive=archive)
+            # Neither the archive nor its temporary file are left behind
+            self.assertEqual(os.listdir(self.testdir), [])
+
+    def test_get_archive_format(self):
+        self.assertEqual(export_bids.get_archive_format('-'), 'tar')
+        self.assertEqual(export_bids.get_archive_format('export.TGZ'), 'tar.gz')
+        self.assertEqual(export_bids.get_archive_format('export.zip'), 'zip')
+        with self.assertRaises(BIDSExportError):
+            export_bids.get_archive_format('export.rar')
+        with self.assertRaises(BIDSExportError):
+            export_bids.export_bids(mock.MagicMock(), None, 'project', archive='export.zip', sync=True)
+
 
 if __name__ == "__main__":
 
@@ -0,0 +1,170 @@
+import copy
+import os
+import re
+import shutil
+import tempfile
+import unittest
+
+import dateutil.parser
+import flywheel
+
+from flywheel_bids import export_bids
+from flywheel_bids.supporting_files import export_query
+
+def get_values(container, field):
+    """ Get the values of a dotted field, from every item of the lists along the way """
+    values = [container]
+    for key in field.split('.'):
+        found = []
+        for value in values:
+            items = value if isinstance(value, list) else [value]
+            found.extend(item[key] for item in items if isinstance(item, dict) and key in item)
+        values = found
+    return values
+
+class FakeFlywheel(object):
+    """
+    A local stand-in for the flywheel client, that applies filter queries in memory.
+
+    Args:
+        subjects (int): The number of subjects, each with one session
+        folders (list): The BIDS folder of each acquisition in a session
+        supports_filters (bool): Whether filter queries are accepted
+    """
+    def __init__(self, subjects, folders, supports_filters=True):
+        self.supports_filters = supports_filters
+        self.calls = []
+        modified = dateutil.parser.parse('2018-03-28T20:40:59Z')
+        self.project = {'_id': 'project', 'label': 'project', 'files': [],
+                        'info': {'BIDS': {'Name': 'project', 'BIDSVersion': '1.0.2'}}}
+        self.sessions = {}
+        self.acquisitions = {}
+        self.session_acquisitions = {}
+        for i in range(subjects):
+            code = '{0:02d}'.format(i)
+            ses_id = 'ses' + code
+            self.sessions[ses_id] = {'_id': ses_id, 'label': 'ses-1', 'subject': {'code': code}, 'files': [], 'info': {}}
+            self.session_acquisitions[ses_id] = []
+            for j, folder in enumerate(folders):
+                acq_id = '{0}_acq{1}'.format(ses_id, j)
+                filename = 'sub-{0}_run-{1}_{2}.nii.gz'.format(code, j, 'T1w' if folder == 'anat' else 'bold')
+                f = {'name': '{0}.nii.gz'.format(acq_id), 'modified': modified, 'size': 4, 'info': {'BIDS': {
+                    'Filename': filename, 'Path': 'sub-{0}/{1}'.format(code, folder), 'Folder': folder}}}
+                self.acquisitions[acq_id] = {'_id': acq_id, 'info': {}, 'files': [f]}
+                self.session_acquisitions[ses_id].append(acq_id)
+
+    def _find(self, containers, filter=None):
+        if filter is None:
+            return [copy.deepcopy(container) for container in containers]
+        if not self.supports_filters:
+            raise flywheel.ApiException(status=400, reason='Invalid filter')
+        results = []
+        for container in containers:
+            for query in re.split(r'(?<!\\),', filter):
+                field, pattern = query.split('=~', 1)
+                if not any(re.match(pattern.replace('\\,', ','), value) for value in get_values(container, field)):
+                    break
+            else:
+                results.append(copy.deepcopy(container))
+        return results
+
+    def get_project(self, project_id):
+        self.calls.append(('get_project', project_id))
+        return copy.deepcopy(self.project)
+
+    def get_project_sessions(self, project_id, filter=None):
+        self.calls.append(('get_project_sessions', project_id))
+        return self._find([self.sessions[ses_id] for ses_id in sorted(self.sessions)], filter=filter)
+
+    def get_session(self, session_id):
+        self.calls.append(('get_session', session_id))
+        return copy.deepcopy(self.sessions[session_id])
+
+    def get_session_acquisitions(self, session_id, filter=None):
+        self.calls.append(('get_session_acquisitions', session_id))
+        return self._find([self.acquisitions[acq_id] for acq_id in self.session_acquisitions[session_id]], filter=filter)
+
+    def get_acquisition(self, acquisition_id):
+        self.calls.append(('get_acquisition', acquisition_id))
+        return copy.deepcopy(self.acquisitions[acquisition_id])
+
+class ExportQueryTestCases(unittest.TestCase):
+
+    def setUp(self):
+        self.outdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.outdir)
+
+    def _get_downloads(self, fw, query, **kwargs):
+        downloads = export_bids.get_bids_downloads(fw, 'project', 'project', self.outdir, query=query, **kwargs)
+        return dict((container_type, sorted(os.path.relpath(path, self.outdir) for path in paths))
+                    for container_type, paths in downloads.items())
+
+    def _count_calls(self, fw, name):
+        return len([call for call in fw.calls if call[0] == name])
+
+    def test_server_filters(self):
+        client_fw = FakeFlywheel(20, ['anat', 'func', 'func'])
+        server_fw = FakeFlywheel(20, ['anat', 'func', 'func'])
+        filters = {'subjects': ['03', '11'], 'sessions': ['ses-1'], 'folders': ['anat']}
+        expected = self._get_downloads(client_fw, export_query.ClientQueryBackend(client_fw), **filters)
+        downloads = self._get_downloads(server_fw, export_query.ServerQueryBackend(server_fw), **filters)
+
+        self.assertEqual(downloads, expected)
+        self.assertEqual(downloads['acquisition'], ['sub-03/anat/sub-03_run-0_T1w.nii.gz',
+                                                    'sub-11/anat/sub-11_run-0_T1w.nii.gz'])
+        # Only the matching sessions and acquisitions are retrieved
+        self.assertEqual(self._count_calls(server_fw, 'get_session'), 2)
+        self.assertEqual(self._count_calls(server_fw, 'get_acquisition'), 2)
+        self.assertEqual(self._count_calls(client_fw, 'get_acquisition'), 6)
+
+    def test_server_filters_rejected(self):
+        fw = FakeFlywheel(5, ['anat', 'func'], supports_filters=False)
+        query = export_query.ServerQueryBackend(fw)
+        downloads = self._get_downloads(fw, query, subjects=['02'], folders=['func'])
+        self.assertFalse(query.server_filters)
+        self.assertEqual(downloads['acquisition'], ['sub-02/func/sub-02_run-1_bold.nii.gz'])
+
+        # Other errors are raised
+        def get_project_sessions(project_id, filter=None):
+            raise flywheel.ApiException(status=500, reason='Server error')
+        fw.get_project_sessions = get_project_sessions
+        with self.assertRaises(flywheel.ApiException):
+            export_query.ServerQueryBackend(fw).get_project_sessions('project', subjects=['02'])
+
+    def test_sdk_without_filters(self):
+        fw = FakeFlywheel(5, ['anat', 'func'])
+        def get_project_sessions(project_id, **kwargs):
+            if kwargs:
+                raise TypeError("Got an unexpected keyword argument 'filter' to method get_project_sessions")
+            return FakeFlywheel.get_project_sessions(fw, project_id)
+        fw.get_project_sessions = get_project_sessions
+        query = export_query.ServerQueryBackend(fw)
+        downloads = self._get_downloads(fw, query, subjects=['02'], folders=['func'])
+        self.assertFalse(query.server_filters)
+        self.assertEqual(downloads['acquisition'], ['sub-02/func/sub-02_run-1_bold.nii.gz'])
+
+        # Other type errors are raised
+        def get_session_acquisitions(session_id, filter=None):
+            raise TypeError('unsupported operand')
+        fw.get_session_acquisitions = get_session_acquisitions
+        with self.assertRaises(TypeError):
+            export_query.ServerQueryBackend(fw).get_session_acquisitions('ses02', folders=['func'])
+
+    def test_no_filters(self):
+        fw = FakeFlywheel(3, ['anat'])
+        downloads = self._get_downloads(fw, export_query.ServerQueryBackend(fw))
+        self.assertEqual(len(downloads['acquisition']), 3)
+        self.assertEqual(self._count_calls(fw, 'get_project_sessions'), 1)
+
+    def test_get_filter(self):
+        self.assertEqual(export_query.get_filter('subject.code', ['01']), 'subject.code=~^(01)$')
+        query = export_query.get_filter('label', ['ses-1', 'a.b', 'x,y'])
+        self.assertEqual(query, 'label=~^(ses-1|a\\.b|x\\,y)$')
+        pattern = query.split('=~', 1)[1].replace('\\,', ',')
+        self.assertTrue(re.match(pattern, 'x,y'))
+        self.assertFalse(re.match(pattern, 'axb'))
+
+
+if __name__ == "__main__":
+
+    unittest.main()
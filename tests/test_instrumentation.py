@@ -0,0 +1,92 @@
+import json
+import os
+import shutil
+import tempfile
+import unittest
+
+from flywheel_bids import curate_bids
+from flywheel_bids.benchmarks import synthetic
+from flywheel_bids.supporting_files import instrumentation
+
+try:
+    from unittest import mock
+except ImportError:
+    import mock
+
+class InstrumentationTestCases(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmpdir)
+        self.addCleanup(instrumentation.stop)
+
+    def test_instrumented_client(self):
+        fw = mock.MagicMock()
+        path = os.path.join(self.tmpdir, 'file.nii.gz')
+        def download_file_from_acquisition(acq_id, name, dest):
+            with open(dest, 'wb') as f:
+                f.write(b'x' * 100)
+        fw.download_file_from_acquisition.side_effect = download_file_from_acquisition
+        fw.get_session.side_effect = IOError('Connection reset')
+        fw.api_client = mock.NonCallableMagicMock()
+
+        recorder = instrumentation.start()
+        client = instrumentation.instrument(fw)
+        self.assertIs(instrumentation.instrument(client), client)
+        self.assertIs(client.api_client, fw.api_client)
+
+        client.download_file_from_acquisition('acq', 'file.nii.gz', path)
+        client.replace_session_info('ses', {'BIDS': {'Label': 'ses'}})
+        client.replace_session_info('ses', {})
+        with self.assertRaises(IOError):
+            client.get_session('ses')
+
+        calls = recorder.report()['api']
+        self.assertEqual(calls['count'], 4)
+        self.assertEqual(calls['errors'], 1)
+        self.assertEqual(calls['bytes'], 100 + len('{"BIDS": {"Label": "ses"}}') + len('{}'))
+        self.assertEqual(calls['methods']['download_file_from_acquisition']['bytes'], 100)
+        self.assertEqual(calls['methods']['replace_session_info']['count'], 2)
+        self.assertEqual(calls['methods']['get_session']['errors'], 1)
+
+    def test_disabled(self):
+        fw = mock.MagicMock()
+        self.assertIs(instrumentation.instrument(fw), fw)
+        with instrumentation.phase('matching'):
+            pass
+        with instrumentation.recording(None) as recorder:
+            self.assertIsNone(recorder)
+        self.assertIsNone(instrumentation.get_recorder())
+
+    def test_recording_curate(self):
+        path = os.path.join(self.tmpdir, 'report.json')
+        project = synthetic.generate_project(subjects=2, sessions=1, acquisitions=2, files=1)
+        with instrumentation.recording(path):
+            fw = instrumentation.instrument(mock.MagicMock())
+            curate_bids.curate_bids_tree(fw, project)
+        self.assertIsNone(instrumentation.get_recorder())
+
+        with open(path, 'r') as f:
+            report = json.load(f)
+        self.assertEqual(set(report['phases']), set(['template_load', 'matching', 'resolution', 'write_back']))
+        self.assertEqual(report['phases']['resolution']['count'], 3)
+        self.assertEqual(report['api']['methods']['replace_session_info']['count'], 2)
+        self.assertGreaterEqual(report['seconds'], report['phases']['matching']['seconds'])
+
+    def test_recording_failure(self):
+        path = os.path.join(self.tmpdir, 'report.json')
+        with self.assertRaises(ValueError):
+            with instrumentation.recording(path):
+                with instrumentation.phase('upload'):
+                    raise ValueError('Failed')
+
+        # The report is still written
+        with open(path, 'r') as f:
+            report = json.load(f)
+        self.assertEqual(report['phases']['upload']['count'], 1)
+        self.assertEqual(report['api']['count'], 0)
+
+
+if __name__ == "__main__":
+
+    unittest.main()
@@ -0,0 +1,127 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+from flywheel_bids.supporting_files import project_tree
+
+from mock_flywheel import mock_project_fw
+
+
+class ProjectTreeTestCases(unittest.TestCase):
+
+    def test_get_project_tree_concurrent(self):
+        fw = mock_project_fw(5, 3)
+        serial = project_tree.get_project_tree(fw, 'project')
+        concurrent = project_tree.get_project_tree(fw, 'project', jobs=4)
+
+        self.assertEqual(serial.to_json(), concurrent.to_json())
+        self.assertEqual(len(concurrent.children), 6)
+        self.assertEqual(concurrent.children[0].type, 'file')
+        session = concurrent.children[1]
+        self.assertEqual(session['label'], 'ses0')
+        # Acquisitions are sorted by creation time, followed by their files
+        self.assertEqual([acq['label'] for acq in session.children],
+                         ['ses0_acq0', 'ses0_acq1', 'ses0_acq2'])
+        self.assertEqual(session.children[0].children[0]['name'], 'ses0_acq0.nii.gz')
+
+    def test_get_project_tree_single_session(self):
+        fw = mock_project_fw(5, 2)
+        project = project_tree.get_project_tree(fw, 'project', session_id='ses3', session_only=True, jobs=4)
+
+        sessions = [child for child in project.children if child.type == 'session']
+        self.assertEqual([session['label'] for session in sessions], ['ses3'])
+        self.assertEqual(fw.get_session.call_count, 1)
+        self.assertEqual(fw.get_acquisition.call_count, 2)
+
+    def test_from_json(self):
+        fw = mock_project_fw(2, 2)
+        project = project_tree.get_project_tree(fw, 'project')
+        loaded = project_tree.TreeNode.from_json(project.to_json())
+        self.assertEqual(loaded.to_json(), project.to_json())
+        self.assertEqual(loaded.children[1].children[0].type, 'acquisition')
+
+    def test_get_project_tree_cache(self):
+        cache_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, cache_dir)
+        fw = mock_project_fw(3, 2)
+        first = project_tree.get_project_tree(fw, 'project', cache_dir=cache_dir)
+        self.assertTrue(os.path.isfile(os.path.join(cache_dir, 'project.json')))
+        self.assertEqual(fw.get_session.call_count, 3)
+        self.assertEqual(fw.get_acquisition.call_count, 6)
+
+        # Nothing changed, everything is loaded from the cache
+        fw.get_session.reset_mock()
+        fw.get_acquisition.reset_mock()
+        cached = project_tree.get_project_tree(fw, 'project', cache_dir=cache_dir)
+        fw.get_session.assert_not_called()
+        fw.get_acquisition.assert_not_called()
+        self.assertEqual(cached.to_json(), first.to_json())
+
+        # Only the modified acquisition is retrieved again
+        fw.acquisitions['ses1_acq0']['modified'] = '2018-02-01T00:00:00Z'
+        fw.acquisitions['ses1_acq0']['files'][0]['info'] = {'changed': True}
+        refreshed = project_tree.get_project_tree(fw, 'project', cache_dir=cache_dir)
+        fw.get_session.assert_not_called()
+        fw.get_acquisition.assert_called_once_with('ses1_acq0')
+        acq = refreshed.children[2].children[0]
+        self.assertEqual(acq['label'], 'ses1_acq0')
+        self.assertEqual(acq.children[0]['info'], {'changed': True})
+        self.assertEqual(len(list(cached.context_iter())), len(list(refreshed.context_iter())))
+
+    def test_get_project_tree_lazy(self):
+        fw = mock_project_fw(3, 2)
+        eager = project_tree.get_project_tree(fw, 'project')
+        fw.get_session.reset_mock()
+        fw.get_acquisition.reset_mock()
+
+        project = project_tree.get_project_tree(fw, 'project', lazy=True, jobs=2)
+        fw.get_session.assert_not_called()
+        session = project.children[1]
+        self.assertEqual(session['label'], 'ses0')
+        self.assertEqual(session.children, [])
+
+        # Sessions are retrieved as they are iterated
+        self.assertEqual(len(list(project.context_iter())), len(list(eager.context_iter())))
+        self.assertEqual(project.to_json(), eager.to_json())
+        self.assertEqual(fw.get_session.call_count, 3)
+        self.assertEqual(fw.get_acquisition.call_count, 6)
+
+        session.release()
+        self.assertEqual(session.children, [])
+        self.assertFalse(session.loaded)
+
+        # The cache holds the whole tree, so can't be used lazily
+        with self.assertRaises(ValueError):
+            project_tree.get_project_tree(fw, 'project', lazy=True, cache_dir='cache')
+
+    def test_is_dirty(self):
+        node = project_tree.TreeNode('file', {'name': 'test.nii.gz', 'info': {
+            'BIDS': {'Filename': 'test.nii.gz', 'Run': 1}, 'EchoTime': 0.03}})
+        self.assertFalse(node.is_dirty())
+        self.assertEqual(node.changed_keys(), set())
+
+        # Nested modifications are detected, without a copy of the original
+        node['info']['BIDS']['Run'] = 2
+        self.assertTrue(node.is_dirty())
+        self.assertEqual(node.changed_keys(), set(['BIDS']))
+
+        # Changing back is no longer dirty
+        node['info']['BIDS']['Run'] = 1
+        self.assertFalse(node.is_dirty())
+
+        # Added and removed keys
+        node['info']['IntendedFor'] = []
+        del node['info']['EchoTime']
+        self.assertEqual(node.changed_keys(), set(['IntendedFor', 'EchoTime']))
+
+    def test_is_dirty_no_info(self):
+        node = project_tree.TreeNode('file', {'name': 'test.nii.gz'})
+        self.assertFalse(node.is_dirty())
+        node['info'] = {}
+        self.assertTrue(node.is_dirty())
+
+
+if __name__ == "__main__":
+
+    unittest.main()
@@ -0,0 +1,86 @@
+import unittest
+
+from flywheel_bids.supporting_files import project_tree, resolver
+
+
+def bids_file(name, folder, **fields):
+    info = {'BIDS': dict(Filename=name, Folder=folder, **fields)}
+    return project_tree.TreeNode('file', {'name': name, 'info': info})
+
+def session_tree(files):
+    session = project_tree.TreeNode('session', {
+        'label': 'ses1', 'subject': {'code': 'sub1'}, 'info': {'BIDS': {'Label': '1'}}})
+    acq = project_tree.TreeNode('acquisition', {'label': 'acq'})
+    session.children.append(acq)
+    acq.children.extend(files)
+    return session
+
+RESOLVER = {
+    'id': 'bids_intended_for',
+    'templates': ['fieldmap_file'],
+    'update': 'file.info.IntendedFor',
+    'filter': 'file.info.BIDS.IntendedFor',
+    'resolveFor': 'session',
+    'type': 'file',
+    'format': '{file.info.BIDS.Folder}/{file.info.BIDS.Filename}'
+}
+
+class ResolverTestCases(unittest.TestCase):
+
+    def resolve(self, session, fmap):
+        context = {'container_type': 'file', 'session': session, 'file': fmap}
+        resolver.Resolver('BIDS', RESOLVER).resolve(context)
+        return fmap['info']['IntendedFor']
+
+    def test_resolve_intended_for(self):
+        fmap = bids_file('fmap.nii.gz', 'fmap', IntendedFor=[{'Folder': 'func'}, {'Folder': 'anat', 'Run': [1, 2]}])
+        session = session_tree([
+            bids_file('bold.nii.gz', 'func', Run=1),
+            bids_file('t1.nii.gz', 'anat', Run=1),
+            bids_file('t1_run3.nii.gz', 'anat', Run=3),
+            bids_file('dwi.nii.gz', 'dwi'),
+            fmap
+        ])
+
+        self.assertEqual(self.resolve(session, fmap), ['func/bold.nii.gz', 'anat/t1.nii.gz'])
+        self.assertIsNotNone(session.context_index)
+
+    def test_resolve_order_and_duplicates(self):
+        # Contexts that match multiple filters are added once per filter, in tree order
+        fmap = bids_file('fmap.nii.gz', 'fmap', IntendedFor=[{'Folder': 'anat'}, {'Folder': ['func', 'anat']}])
+        session = session_tree([
+            bids_file('t1.nii.gz', 'anat'),
+            bids_file('bold.nii.gz', 'func'),
+            fmap
+        ])
+
+        self.assertEqual(self.resolve(session, fmap),
+                         ['anat/t1.nii.gz', 'anat/t1.nii.gz', 'func/bold.nii.gz'])
+
+    def test_resolve_unhashable_values(self):
+        fmap = bids_file('fmap.nii.gz', 'fmap', IntendedFor=[{'Folder': 'func', 'Echo': [[1, 2]]}])
+        session = session_tree([
+            bids_file('bold.nii.gz', 'func', Echo=[1, 2]),
+            bids_file('bold2.nii.gz', 'func', Echo=[3]),
+            fmap
+        ])
+
+        self.assertEqual(self.resolve(session, fmap), ['func/bold.nii.gz'])
+
+    def test_context_index_invalidate(self):
+        fmap = bids_file('fmap.nii.gz', 'fmap', IntendedFor=[{'Folder': 'func'}])
+        session = session_tree([bids_file('bold.nii.gz', 'func'), fmap])
+        index = resolver.get_context_index(session)
+        self.assertIs(resolver.get_context_index(session), index)
+
+        index.bucket('file.info.BIDS.Folder')
+        index.bucket('file.info.IntendedFor')
+        index.invalidate('file.info.IntendedFor')
+        self.assertEqual(list(index.buckets.keys()), ['file.info.BIDS.Folder'])
+        index.invalidate('file.info')
+        self.assertEqual(index.buckets, {})
+
+
+if __name__ == "__main__":
+
+    unittest.main()
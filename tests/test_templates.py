@@ -1,11 +1,18 @@
 import os
 import json
+import pickle
 import re
 import shutil
+import tempfile
 import unittest
 
 from flywheel_bids.supporting_files import utils, templates
 
+try:
+    from unittest import mock
+except ImportError:
+    import mock
+
 class RuleTestCases(unittest.TestCase):
 
     def test_rule_initialize_switch(self):
@@ -238,3 +245,180 @@ class RuleTestCases(unittest.TestCase):
         context = {'x': 'Something'}
         self.assertTrue(rule.test(context))
 
+    def test_rule_where_or_and(self):
+        rule = templates.Rule({
+            'template': 'test',
+            'where': {
+                'container_type': 'file',
+                '$or': [
+                    ['x', {'$regex': 'topup'}],
+                    ['y', 'fmap']
+                ],
+                '$and': [
+                    ['z', {'$not': 'ignore'}]
+                ]
+            }
+        })
+        self.assertTrue(rule.test({'container_type': 'file', 'x': 'a_topup', 'z': 'keep'}))
+        self.assertTrue(rule.test({'container_type': 'file', 'x': 'other', 'y': ['fmap'], 'z': 'keep'}))
+        self.assertFalse(rule.test({'container_type': 'file', 'x': 'other', 'y': 'func', 'z': 'keep'}))
+        self.assertFalse(rule.test({'container_type': 'file', 'x': 'a_topup', 'z': 'ignore'}))
+
+    def test_template_get_rules(self):
+        template = templates.Template({
+            'rules': [
+                {'id': 'file_rule', 'template': 'test', 'where': {'container_type': 'file', 'x': 1}},
+                {'id': 'acq_rule', 'template': 'test', 'where': {'container_type': 'acquisition'}},
+                {'id': 'any_rule', 'template': 'test', 'where': {'x': 1}},
+                {'id': 'session_file_rule', 'template': 'test', 'where': {
+                    'container_type': {'$in': ['file']}, 'parent_container_type': 'session'}}
+            ],
+            'upload_rules': [
+                {'id': 'upload_rule', 'template': 'test', 'where': {'container_type': 'file'}}
+            ]
+        })
+
+        rules = template.get_rules('file', 'acquisition')
+        self.assertEqual([rule.id for rule in rules], ['file_rule', 'any_rule'])
+        self.assertIs(template.get_rules('file', 'acquisition'), rules)
+
+        rules = template.get_rules('file', 'session', upload=True)
+        self.assertEqual([rule.id for rule in rules],
+                         ['file_rule', 'any_rule', 'session_file_rule', 'upload_rule'])
+
+        rules = template.get_rules('acquisition', 'session')
+        self.assertEqual([rule.id for rule in rules], ['acq_rule', 'any_rule'])
+
+
+    def test_lazy_templates(self):
+        with mock.patch('flywheel_bids.supporting_files.templates.loadTemplates') as loadTemplates:
+            loadTemplates.return_value = {'test': 'template'}
+            lazy = templates.LazyTemplates('/templates')
+            loadTemplates.assert_not_called()
+            self.assertFalse(lazy.loaded)
+
+            self.assertEqual(lazy['test'], 'template')
+            self.assertEqual(dict(lazy), {'test': 'template'})
+            loadTemplates.assert_called_once_with('/templates')
+
+    def test_lazy_template(self):
+        template = templates.LazyTemplate(templates.BIDS_TEMPLATE_NAME)
+        self.assertEqual(template.namespace, 'BIDS')
+        self.assertIs(template.load(), templates.DEFAULT_TEMPLATES[templates.BIDS_TEMPLATE_NAME])
+
+        # Only the name is pickled
+        loaded = pickle.loads(pickle.dumps(template))
+        self.assertIsInstance(loaded, templates.LazyTemplate)
+        self.assertIs(loaded.load(), template.load())
+
+    def test_load_template_cache(self):
+        cache_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, cache_dir)
+        path = os.path.join(cache_dir, 'project-template.json')
+        data = {
+            'extends': 'bids-v1',
+            'definitions': {'test': {'type': 'object', 'properties': {'x': {'$ref': '#/definitions/x'}}},
+                            'x': {'type': 'string'}},
+            'rules': [{'id': 'test_rule', 'template': 'test', 'where': {'container_type': 'file'}}]
+        }
+        with open(path, 'w') as f:
+            json.dump(data, f)
+
+        with mock.patch('flywheel_bids.supporting_files.templates.TEMPLATE_CACHE_DIR', cache_dir):
+            template = templates.loadTemplate(path)
+            self.assertEqual(len([name for name in os.listdir(cache_dir) if name.endswith('.pickle')]), 1)
+
+            # The compiled template is loaded from the cache
+            with mock.patch.object(templates.Template, 'compile_rules') as compile_rules:
+                cached = templates.loadTemplate(path)
+                compile_rules.assert_not_called()
+            self.assertEqual(cached.fingerprint, template.fingerprint)
+            self.assertEqual(cached.namespace, 'BIDS')
+            self.assertEqual(cached.definitions['test']['properties']['x'], {'type': 'string'})
+            self.assertIn('test_rule', [rule.id for rule in cached.get_rules('file', 'acquisition')])
+            self.assertEqual(cached.validate(cached.definitions['test'], {'x': 1})[0].message,
+                             "1 is not of type 'string'")
+
+            # A different parent template is extended again
+            parent = templates.Template({'namespace': 'Other'})
+            cached = templates.loadTemplate(path, {'bids-v1': parent})
+            self.assertEqual(cached.namespace, 'Other')
+
+            # Changed content is compiled again
+            data['namespace'] = 'Changed'
+            with open(path, 'w') as f:
+                json.dump(data, f)
+            changed = templates.loadTemplate(path)
+            self.assertEqual(changed.namespace, 'Changed')
+            self.assertEqual(len([name for name in os.listdir(cache_dir) if name.endswith('.pickle')]), 2)
+            cached = templates.loadTemplate(path)
+            self.assertEqual(cached.namespace, 'Changed')
+
+    def test_load_template_cache_by_content(self):
+        cache_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, cache_dir)
+        data = {'namespace': 'Test', 'definitions': {}, 'rules': []}
+
+        # Project templates are downloaded to a new temporary file every run
+        with mock.patch('flywheel_bids.supporting_files.templates.TEMPLATE_CACHE_DIR', cache_dir):
+            with mock.patch.object(templates.Template, 'compile_rules', autospec=True,
+                                   side_effect=templates.Template.compile_rules) as compile_rules:
+                for i in range(3):
+                    path = os.path.join(cache_dir, 'template{0}.json'.format(i))
+                    with open(path, 'w') as f:
+                        json.dump(data, f)
+                    self.assertEqual(templates.loadTemplate(path).namespace, 'Test')
+                self.assertEqual(compile_rules.call_count, 1)
+        self.assertEqual(len([name for name in os.listdir(cache_dir) if name.endswith('.pickle')]), 1)
+
+    def test_load_template_cache_untrusted(self):
+        cache_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, cache_dir)
+        path = os.path.join(cache_dir, 'template.json')
+        with open(path, 'w') as f:
+            json.dump({'namespace': 'Test', 'definitions': {}, 'rules': []}, f)
+
+        with mock.patch('flywheel_bids.supporting_files.templates.TEMPLATE_CACHE_DIR', cache_dir):
+            templates.loadTemplate(path)
+            cache_path = os.path.join(cache_dir, [name for name in os.listdir(cache_dir) if name.endswith('.pickle')][0])
+            self.assertTrue(templates.is_trusted_cache_file(cache_path))
+
+            # Cache files that other users can write to are not unpickled
+            os.chmod(cache_path, 0o664)
+            self.assertFalse(templates.is_trusted_cache_file(cache_path))
+            with mock.patch('pickle.load') as load:
+                self.assertEqual(templates.loadTemplate(path).namespace, 'Test')
+                load.assert_not_called()
+
+    def test_prune_template_cache(self):
+        cache_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, cache_dir)
+        for i in range(5):
+            path = os.path.join(cache_dir, '{0}.pickle'.format(i))
+            open(path, 'w').close()
+            os.utime(path, (i, i))
+        open(os.path.join(cache_dir, 'other.txt'), 'w').close()
+
+        templates.prune_template_cache(cache_dir, 3)
+        self.assertEqual(sorted(os.listdir(cache_dir)), ['2.pickle', '3.pickle', '4.pickle', 'other.txt'])
+
+    def test_template_validators(self):
+        template = templates.Template({
+            'definitions': {'test': {'type': 'object', 'required': ['x'], 'properties': {
+                'x': {'type': 'string', 'minLength': 1}, 'y': {'type': 'integer'}}}}
+        })
+        definition = template.definitions['test']
+        validator = template.get_validator(definition)
+        self.assertIs(template.get_validator(definition), validator)
+        self.assertNotIn('_validator', definition)
+
+        self.assertTrue(template.is_valid(definition, {'x': 'a', 'y': 1}))
+        self.assertEqual(template.validate(definition, {'x': 'a', 'y': 1}), [])
+        self.assertFalse(template.is_valid(definition, {'x': '', 'y': 'b'}))
+        errors = template.validate(definition, {'x': '', 'y': 'b'})
+        self.assertEqual(sorted(err.validator for err in errors), ['minLength', 'type'])
+
+        # Validators are not pickled, and are created again after loading
+        loaded = pickle.loads(pickle.dumps(template))
+        self.assertEqual(loaded.validators, {})
+        self.assertFalse(loaded.is_valid(loaded.definitions['test'], {}))
@@ -15,6 +15,8 @@ try:
 except ImportError:
     import mock
 
+from mock_flywheel import MockContainer
+
 class BidsUploadTestCases(unittest.TestCase):
 
     def setUp(self):
@@ -1099,6 +1101,99 @@ class BidsUploadTestCases(unittest.TestCase):
         fw.set_acquisition_file_info.assert_any_call('acq2', 'sub-control01_task-motor_bold.nii.gz',
             {'acq_time': '1889-06-15T13:55:33'})
 
+    def test_upload_files_parallel(self):
+        fw = mock_upload_fw()
+        context = {'project': {'id': 'project_id'}, 'subject': {'code': 'sub-01'}}
+        tasks = []
+        for i in range(3):
+            context['session'] = {'id': 'session{}'.format(i), 'label': 'ses-{}'.format(i)}
+            for fname in ['sub-01_ses-{}_scans.tsv'.format(i), 'notes{}.txt'.format(i)]:
+                tasks.append(upload_bids.file_upload_task(context, 'session', 'session', fname,
+                                                          '/tmp/' + fname, 'sub-01/ses-{}'.format(i)))
+
+        upload_bids.upload_files(fw, tasks, True, jobs=3)
+
+        self.assertEqual(fw.upload_file_to_session.call_count, 6)
+        # Each session is retrieved once for the file objects, rather than once per file
+        self.assertEqual(fw.get_session.call_count, 3)
+        info_calls = sorted((args[0], args[1]) for args, kwargs in fw.set_session_file_info.call_args_list)
+        self.assertEqual(info_calls, sorted((task['context']['session']['id'], task['fname']) for task in tasks))
+
+    def test_upload_files_from_response(self):
+        fw = mock.MagicMock()
+        def upload(container_id, full_fname):
+            entry = mock.MagicMock()
+            entry.to_dict.return_value = {'name': os.path.basename(full_fname), 'type': 'tabular data'}
+            return [entry]
+        fw.upload_file_to_session.side_effect = upload
+
+        context = {'project': {'id': 'project_id'}, 'session': {'id': 'session_id'}}
+        tasks = [
+            upload_bids.file_upload_task(context, 'session', 'session', fname, '/tmp/' + fname, 'sub-01')
+            for fname in ['a.txt', 'b.txt']
+        ]
+        upload_bids.upload_files(fw, tasks, True)
+
+        fw.get_session.assert_not_called()
+        self.assertEqual(fw.set_session_file_info.call_count, 2)
+
+    def test_uploaded_file_entry(self):
+        result = [{'name': 'other.nii.gz'}, {'name': 'T1w.nii.gz', 'size': 10}]
+        self.assertEqual(upload_bids.uploaded_file_entry(result, '/tmp/anat/T1w.nii.gz'),
+                         {'name': 'T1w.nii.gz', 'size': 10})
+        self.assertIsNone(upload_bids.uploaded_file_entry(result, '/tmp/anat/T2w.nii.gz'))
+        self.assertIsNone(upload_bids.uploaded_file_entry(None, '/tmp/anat/T1w.nii.gz'))
+
+    def test_upload_bids_dir_container_lookups(self):
+        fw = mock_container_fw()
+        bids_hierarchy = {
+            'project_label': {
+                'files': [],
+                'sub-01': {
+                    'files': [],
+                    'ses-1': {
+                        'files': [],
+                        'anat': {'files': ['sub-01_ses-1_T1w.nii.gz', 'sub-01_ses-1_T2w.nii.gz']},
+                        'func': {'files': ['sub-01_ses-1_task-rest_bold.nii.gz']}},
+                    'ses-2': {
+                        'files': [],
+                        'anat': {'files': ['sub-01_ses-2_T1w.nii.gz']}}},
+                'sub-02': {
+                    'files': [],
+                    'anat': {'files': ['sub-02_T1w.nii.gz']}}}}
+
+        upload_bids.upload_bids_dir(fw, bids_hierarchy, 'group_id', '/bids', 'BIDS', True, True)
+
+        # Existing containers are listed once, and the children of created containers never are
+        self.assertEqual(fw.get_all_projects.call_count, 1)
+        self.assertEqual(fw.get_project_subjects.call_count, 0)
+        self.assertEqual(fw.get_project_sessions.call_count, 0)
+        self.assertEqual(fw.get_session_acquisitions.call_count, 0)
+        # And each container is created once
+        self.assertEqual(fw.add_subject.call_count, 2)
+        self.assertEqual(fw.add_session.call_count, 3)
+        self.assertEqual(fw.add_acquisition.call_count, 4)
+        self.assertEqual(fw.upload_file_to_acquisition.call_count, 5)
+
+    def test_upload_files_failures(self):
+        fw = mock_upload_fw()
+        upload = fw.upload_file_to_session.side_effect
+        def failing_upload(container_id, full_fname):
+            if 'bad' in full_fname:
+                raise IOError('Connection reset')
+            upload(container_id, full_fname)
+        fw.upload_file_to_session.side_effect = failing_upload
+
+        context = {'project': {'id': 'project_id'}, 'session': {'id': 'session_id'}}
+        tasks = [
+            upload_bids.file_upload_task(context, 'session', 'session', fname, '/tmp/' + fname, 'sub-01')
+            for fname in ['bad.txt', 'good.txt']
+        ]
+        with self.assertRaises(upload_bids.BIDSImportError):
+            upload_bids.upload_files(fw, tasks, True, jobs=2)
+        # The remaining file in the container is still uploaded
+        fw.set_session_file_info.assert_called_once_with('session_id', 'good.txt', mock.ANY)
+
 
 def write_tsv(rows):
     csv_out = tempfile.NamedTemporaryFile(mode='w', suffix='.tsv')
@@ -1138,6 +1233,57 @@ def mock_attach_tsv(container_type, containers, tsv_rows):
 
     return fw
 
+def mock_upload_fw():
+    fw = mock.MagicMock()
+    uploads = {}
+
+    def upload(container_id, full_fname):
+        uploads.setdefault(container_id, []).append(os.path.basename(full_fname))
+
+    def get_session(session_id):
+        m = mock.MagicMock()
+        m.to_dict.return_value = {
+            'id': session_id,
+            'files': [{'name': name, 'type': 'tabular data'} for name in uploads.get(session_id, [])]
+        }
+        return m
+
+    fw.upload_file_to_session.side_effect = upload
+    fw.get_session.side_effect = get_session
+    return fw
+
+def mock_container_fw():
+    fw = mock.MagicMock()
+    containers = {}
+
+    def add(container_type):
+        def add_container(data):
+            container_id = '{}{}'.format(container_type, len(containers))
+            container = MockContainer(data, id=container_id, files=[])
+            container.setdefault('info', {})
+            if container_type == 'session':
+                container['subject'] = MockContainer(data['subject'])
+            containers[container_id] = container
+            return container_id
+        return add_container
+
+    for container_type in ('project', 'subject', 'session', 'acquisition'):
+        getattr(fw, 'add_' + container_type).side_effect = add(container_type)
+        getattr(fw, 'get_' + container_type).side_effect = containers.get
+
+    def upload(container_id, full_fname):
+        entry = {'name': os.path.basename(full_fname), 'type': 'nifti', 'info': {}}
+        containers[container_id]['files'].append(entry)
+        return [entry]
+
+    fw.upload_file_to_acquisition.side_effect = upload
+    fw.get_all_projects.return_value = []
+    fw.get_project_subjects.return_value = []
+    fw.get_project_sessions.return_value = []
+    fw.get_session_acquisitions.return_value = []
+    fw.get_project_rules.return_value = []
+    return fw
+
 
 if __name__ == "__main__":
 
@@ -6,6 +6,11 @@ import unittest
 import flywheel
 from flywheel_bids.supporting_files import utils
 
+try:
+    from unittest import mock
+except ImportError:
+    import mock
+
 class UtilsTestCases(unittest.TestCase):
 
     def setUp(self):
@@ -17,6 +22,66 @@ class UtilsTestCases(unittest.TestCase):
         if os.path.exists(self.testdir):
             shutil.rmtree(self.testdir)
 
+    def test_dict_lookup_and_set(self):
+        obj = {'a': {'b': [{'c': 1}, {'c': 2}]}, 'd': None}
+        self.assertEqual(utils.dict_lookup(obj, 'a.b.1.c'), 2)
+        self.assertEqual(utils.dict_lookup(obj, 'a.b.2.c', 'default'), 'default')
+        self.assertEqual(utils.dict_lookup(obj, 'a.x', 'default'), 'default')
+        self.assertIsNone(utils.dict_lookup(obj, 'd'))
+        self.assertEqual(utils.dict_lookup(obj, 'd.e', 'default'), 'default')
+        with self.assertRaises(ValueError):
+            utils.dict_lookup(obj, 'a.b.c')
+
+        utils.dict_set(obj, 'a.b.0.c', 3)
+        utils.dict_set(obj, 'a.e', 4)
+        self.assertEqual(obj['a']['b'][0], {'c': 3})
+        self.assertEqual(obj['a']['e'], 4)
+        with self.assertRaises(ValueError):
+            utils.dict_set(obj, 'x.y', 5)
+
+        # Accessors are compiled once per path
+        self.assertIs(utils.get_path_accessor('a.b.1.c'), utils.get_path_accessor('a.b.1.c'))
+
+    def test_process_string_template_compiled(self):
+        """ Compiled string templates give the same results as replacing each token """
+        context = {
+            'subject': {'code': 'sub-01'},
+            'session': {'label': 'pre_op', 'info': {'BIDS': {'Label': ''}}},
+            'acquisition': {'label': 'T1w-MPR'},
+            'file': {'info': {'BIDS': {'Folder': 'anat', 'Acq': 'mp', 'Run': 2, 'Value': '<acquisition.label>'}}},
+            'ext': '.nii.gz'
+        }
+        cases = [
+            ('sub-<subject.code>_ses-<session.label>_acq-<acquisition.label>{ext}', 'sub-01_ses-preop_acq-T1wMPR.nii.gz'),
+            ('[ses-{session.info.BIDS.Label}/]{file.info.BIDS.Folder}/x', 'anat/x'),
+            ('x[_acq-{file.info.BIDS.Acq}][_run-{file.info.BIDS.Run}][_echo-{file.info.BIDS.Echo}]', 'x_acq-mp_run-2'),
+            # Values after the first one of an optional group are kept as tokens if not found
+            ('x[_acq-{file.info.BIDS.Acq}{file.info.BIDS.Echo}]', 'x_acq-mp{file.info.BIDS.Echo}'),
+            ('{file.info.BIDS.Missing}_x', '{file.info.BIDS.Missing}_x'),
+            # Templates and values that can't be rendered in a single pass
+            ('{ext}{ext}', '.nii.gz.nii.gz'),
+            ('{file.info.BIDS.Value}_<acquisition.label>', 'T1wMPR_T1wMPR'),
+        ]
+        for template, expected in cases:
+            self.assertEqual(utils.process_string_template(template, context), expected)
+            self.assertEqual(utils.replace_string_template(template, context), expected)
+
+        self.assertIsNotNone(utils.compile_string_template(cases[0][0]))
+        self.assertIsNone(utils.compile_string_template('{ext}{ext}'))
+
+    def test_compile_string_template_cache(self):
+        utils.STRING_TEMPLATE_CACHE.clear()
+        compiled = utils.compile_string_template('{a}_{b}')
+        self.assertIs(utils.compile_string_template('{a}_{b}'), compiled)
+        self.assertEqual(compiled.render({'a': 'x'}), 'x_{b}')
+
+        with mock.patch.object(utils, 'STRING_TEMPLATE_CACHE_SIZE', 2):
+            utils.compile_string_template('{c}')
+            utils.compile_string_template('{a}_{b}')
+            utils.compile_string_template('{d}')
+            # The least recently used template is dropped
+            self.assertEqual(list(utils.STRING_TEMPLATE_CACHE.keys()), ['{a}_{b}', '{d}'])
+
     def test_get_extension_nii(self):
         """ Get extension if .nii """
         fname = 'T1w.nii'